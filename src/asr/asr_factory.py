@@ -7,6 +7,7 @@ class ASRFactory:
         if type == "whisper":
             return WhisperASR(**kwargs)
         if type == "faster_whisper":
-            return FasterWhisperASR(**kwargs)
+            # The class behind the deployment, to run the model outside Ray Serve
+            return FasterWhisperASR.func_or_class(**kwargs)
         else:
             raise ValueError(f"Unknown ASR pipeline type: {type}")
@@ -0,0 +1,304 @@
+import os
+import json
+import math
+import time
+import heapq
+import asyncio
+import itertools
+
+from ray import serve
+from ray.serve import metrics
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+
+class ASRJob:
+    """
+    A chunk waiting for, or being transcribed by, an ASR replica.
+
+    Attributes:
+        job_id (int): Unique id of the job in the scheduler.
+        client_id (str): The client the chunk belongs to, the unit of fairness.
+        priority (str): The priority class of the client.
+        deadline (float): Time by which the transcription should be back, as returned by time.time().
+        client (Client): The snapshot of the client holding the chunk.
+        kwargs (dict): Additional arguments of the transcribe call.
+        future (asyncio.Future): Resolved with the transcription.
+        enqueued_at (float): Time at which the job was queued.
+        dispatched_at (float): Time at which a replica took the job, None while queued.
+    """
+
+    def __init__(self, job_id, client_id, priority, deadline, client, kwargs):
+        self.job_id = job_id
+        self.client_id = client_id
+        self.priority = priority
+        self.deadline = deadline
+        self.client = client
+        self.kwargs = kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.time()
+        self.dispatched_at = None
+        self.cancelled = False
+
+
+class FairEDFQueue:
+    """
+    Earliest-deadline-first queue with a cap on the jobs each client has in flight.
+
+    A client that already has `max_in_flight_per_client` jobs on replicas is
+    skipped until one of them completes, so a client with long utterances cannot
+    occupy every replica while the chunks of others wait.
+
+    Attributes:
+        max_in_flight_per_client (int): Jobs a client may have on replicas at once.
+        in_flight (dict): Number of dispatched jobs per client.
+    """
+
+    def __init__(self, max_in_flight_per_client=2):
+        self.max_in_flight_per_client = max_in_flight_per_client
+        self.heap = []
+        self.sequence = itertools.count()
+        self.in_flight = {}
+        self.queued = 0
+
+    def __len__(self):
+        return self.queued
+
+    def push(self, job):
+        heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+        self.queued += 1
+
+    def remove(self, job):
+        """
+        Removes a queued job; it is dropped lazily from the heap.
+        """
+        if not job.cancelled and job.dispatched_at is None:
+            job.cancelled = True
+            self.queued -= 1
+
+    def pop(self):
+        """
+        Takes the queued job with the earliest deadline whose client is under its cap.
+
+        Returns:
+            ASRJob: The job, now counted in flight, or None if no job can be dispatched.
+        """
+        skipped = []
+        job = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[2].cancelled:
+                continue
+            if self.in_flight.get(entry[2].client_id, 0) >= self.max_in_flight_per_client:
+                skipped.append(entry)
+                continue
+            job = entry[2]
+            break
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+
+        if job is not None:
+            self.queued -= 1
+            job.dispatched_at = time.time()
+            self.in_flight[job.client_id] = self.in_flight.get(job.client_id, 0) + 1
+        return job
+
+    def complete(self, job):
+        """
+        Releases the slot of a dispatched job.
+        """
+        remaining = self.in_flight.get(job.client_id, 0) - 1
+        if remaining > 0:
+            self.in_flight[job.client_id] = remaining
+        else:
+            self.in_flight.pop(job.client_id, None)
+
+
+@serve.deployment(max_concurrent_queries=10000)
+class ASRScheduler:
+    """
+    Orders the chunks of all clients for the ASR replicas, which pull them.
+
+    Each chunk gets a real-time deadline: the time its last audio arrived plus the
+    latency budget of the priority class of its client, set with the 'priority'
+    key of the client config. Replicas always get the chunk with the earliest
+    deadline among the clients that are under their in-flight cap. Chunks that
+    are already too late to be useful are shed instead of taking GPU time.
+
+    Configured with the environment variables:
+        ASR_SCHEDULER_PRIORITY_BUDGETS: JSON object mapping priority classes to latency budgets in seconds.
+        ASR_SCHEDULER_DEFAULT_PRIORITY: Priority class of clients that do not set one.
+        ASR_SCHEDULER_MAX_IN_FLIGHT_PER_CLIENT: Jobs a client may have on replicas at once.
+        ASR_SCHEDULER_MAX_LATENESS_SECONDS: How far past its deadline a queued job is shed.
+        ASR_SCHEDULER_LEASE_SECONDS: How long a replica may hold a job before it is failed.
+    """
+
+    def __init__(self, **kwargs):
+        self.priority_budgets = os.environ.get('ASR_SCHEDULER_PRIORITY_BUDGETS')
+        if not self.priority_budgets:
+            self.priority_budgets = kwargs.get('priority_budgets', {"interactive": 1.5, "standard": 4.0, "batch": 30.0})
+        elif isinstance(self.priority_budgets, str):
+            self.priority_budgets = json.loads(self.priority_budgets)
+
+        self.default_priority = os.environ.get('ASR_SCHEDULER_DEFAULT_PRIORITY')
+        if not self.default_priority:
+            self.default_priority = kwargs.get('default_priority', "interactive")
+
+        max_in_flight_per_client = os.environ.get('ASR_SCHEDULER_MAX_IN_FLIGHT_PER_CLIENT')
+        if not max_in_flight_per_client:
+            max_in_flight_per_client = kwargs.get('max_in_flight_per_client', 2)
+
+        self.max_lateness_seconds = os.environ.get('ASR_SCHEDULER_MAX_LATENESS_SECONDS')
+        if not self.max_lateness_seconds:
+            self.max_lateness_seconds = kwargs.get('max_lateness_seconds', 8.0)
+        self.max_lateness_seconds = float(self.max_lateness_seconds)
+
+        self.lease_seconds = os.environ.get('ASR_SCHEDULER_LEASE_SECONDS')
+        if not self.lease_seconds:
+            self.lease_seconds = kwargs.get('lease_seconds', 30.0)
+        self.lease_seconds = float(self.lease_seconds)
+
+        self.queue = FairEDFQueue(int(max_in_flight_per_client))
+        self.job_ids = itertools.count()
+        self.dispatched = {}
+        # When each replica last asked for a job
+        self.replicas_seen = {}
+        self.job_available = asyncio.Condition()
+
+        self.queue_depth = metrics.Gauge("asr_scheduler_queue_depth", description="Chunks waiting for an ASR replica.")
+        self.queue_wait = metrics.Histogram(
+            "asr_scheduler_queue_wait_seconds", description="Time chunks waited for an ASR replica.",
+            boundaries=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10], tag_keys=("priority",))
+        self.deadline_misses = metrics.Counter(
+            "asr_scheduler_deadline_misses", description="Chunks whose transcription came back after their deadline.",
+            tag_keys=("priority",))
+        self.shed_jobs = metrics.Counter(
+            "asr_scheduler_shed_jobs", description="Chunks dropped because they were too late to be useful.",
+            tag_keys=("priority",))
+
+    def deadline(self, client, priority):
+        """
+        Returns the real-time deadline of the chunk of a client snapshot.
+        """
+        audio_seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        now = time.time()
+        started_at = getattr(client, 'trace_started_at', None) or now
+        arrived_at = min(started_at + audio_seconds, now)
+        budget = self.priority_budgets.get(priority, self.priority_budgets.get(self.default_priority, 1.5))
+        return arrived_at + float(budget)
+
+    async def transcribe(self, client, **kwargs):
+        """
+        Queues a chunk and returns its transcription once a replica produced it.
+
+        Called by the ingress in place of the ASR deployment. Arguments for the
+        replicas other than the client are passed on, except hedging hints, which
+        the scheduler replaces.
+
+        Raises:
+            asyncio.TimeoutError: If the chunk was shed, or its replica did not answer in time.
+        """
+        kwargs.pop('avoid_replicas', None)
+        kwargs.pop('max_real_time_factor', None)
+        priority = client.config.get('priority') or self.default_priority
+        if priority not in self.priority_budgets:
+            priority = self.default_priority
+        job = ASRJob(next(self.job_ids), client.client_id, priority, self.deadline(client, priority), client, kwargs)
+
+        async with self.job_available:
+            self.queue.push(job)
+            self.queue_depth.set(len(self.queue))
+            self.job_available.notify()
+        try:
+            result = await job.future
+        except asyncio.CancelledError:
+            # The client is gone: a queued chunk is dropped, a dispatched one
+            # still holds its replica until it completes.
+            self.queue.remove(job)
+            self.queue_depth.set(len(self.queue))
+            raise
+        if time.time() > job.deadline:
+            self.deadline_misses.inc(tags={"priority": priority})
+        return result
+
+    async def next_job(self, replica_tag, timeout_seconds=5.0):
+        """
+        Called by ASR replicas to take the next chunk. Waits up to `timeout_seconds`
+        for one, so that idle replicas poll cheaply.
+
+        The transcribe arguments include the number of chunks queued per replica,
+        which replicas use to pick their decoding profile.
+
+        Returns:
+            Tuple[int, Client, dict]: The job id, the client snapshot and the transcribe arguments, or None.
+        """
+        self.replicas_seen[replica_tag] = time.monotonic()
+        deadline = time.monotonic() + timeout_seconds
+        async with self.job_available:
+            while True:
+                self.expire_leases()
+                job = self.queue.pop()
+                if job is not None and time.time() > job.deadline + self.max_lateness_seconds:
+                    self.queue.complete(job)
+                    self.shed_jobs.inc(tags={"priority": job.priority})
+                    if not job.future.done():
+                        job.future.set_exception(asyncio.TimeoutError(
+                            f"Chunk of {job.client_id} shed, {time.time() - job.deadline:.1f}s past its deadline"))
+                    continue
+                if job is not None:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.job_available.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+
+        self.queue_depth.set(len(self.queue))
+        self.queue_wait.observe(job.dispatched_at - job.enqueued_at, tags={"priority": job.priority})
+        self.dispatched[job.job_id] = (job, replica_tag)
+        return job.job_id, job.client, dict(job.kwargs, queue_depth=self.queue_depth_per_replica())
+
+    def queue_depth_per_replica(self):
+        now = time.monotonic()
+        self.replicas_seen = {replica_tag: seen_at for replica_tag, seen_at in self.replicas_seen.items()
+                              if now - seen_at < self.lease_seconds}
+        return math.ceil(len(self.queue) / max(1, len(self.replicas_seen)))
+
+    async def complete(self, job_id, result=None, error=None):
+        """
+        Called by ASR replicas with the transcription of a job, or the error it raised.
+        """
+        if job_id not in self.dispatched:
+            # The lease expired, the job was already failed
+            return
+        job, _ = self.dispatched.pop(job_id)
+        async with self.job_available:
+            self.queue.complete(job)
+            # The client may be under its cap again
+            self.job_available.notify_all()
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(RuntimeError(error))
+        else:
+            job.future.set_result(result)
+
+    def expire_leases(self):
+        now = time.time()
+        for job_id, (job, replica_tag) in list(self.dispatched.items()):
+            if now - job.dispatched_at > self.lease_seconds:
+                logger.warning(f"Replica {replica_tag} did not complete job {job_id} within {self.lease_seconds}s")
+                del self.dispatched[job_id]
+                self.queue.complete(job)
+                if not job.future.done():
+                    job.future.set_exception(asyncio.TimeoutError(f"Replica {replica_tag} did not complete the chunk in time"))
+
+    async def stats(self):
+        return {
+            "queued": len(self.queue),
+            "dispatched": len(self.dispatched),
+            "in_flight_per_client": dict(self.queue.in_flight),
+        }
@@ -0,0 +1,106 @@
+import time
+
+# Decoding settings of FasterWhisperASR, from the most accurate to the cheapest.
+# 'accurate' is the faster-whisper default. Without word timestamps, transcriptions
+# have no words, so text carried over as context cannot be deduplicated.
+DECODING_PROFILES = {
+    "accurate": {
+        "beam_size": 5,
+        "best_of": 5,
+        "word_timestamps": True,
+        "temperature": [0.0, 0.2, 0.4, 0.6, 0.8, 1.0],
+        "condition_on_previous_text": True,
+    },
+    "balanced": {
+        "beam_size": 2,
+        "best_of": 2,
+        "word_timestamps": True,
+        "temperature": [0.0, 0.4, 0.8],
+        "condition_on_previous_text": True,
+    },
+    "fast": {
+        "beam_size": 1,
+        "best_of": 1,
+        "word_timestamps": True,
+        "temperature": 0.0,
+        "condition_on_previous_text": False,
+    },
+    "fastest": {
+        "beam_size": 1,
+        "best_of": 1,
+        "word_timestamps": False,
+        "temperature": 0.0,
+        "condition_on_previous_text": False,
+    },
+}
+
+# The profiles used unless configured otherwise. 'fastest' is opt-in: the buffering
+# strategies rely on word timestamps to drop the words repeated from the context.
+DEFAULT_DECODING_PROFILES = ["accurate", "balanced", "fast"]
+
+
+class DecodingProfileController:
+    """
+    Picks the decoding profile of an ASR replica from its load.
+
+    The replica steps down to the next cheaper profile when its queue depth or the
+    moving average of its real-time factor passes the step-down thresholds, and back
+    up when both are under the lower step-up thresholds. Each change is held for at
+    least `hold_seconds`, so that the real-time factor measured with the new profile
+    drives the next decision.
+
+    Attributes:
+        profiles (list): The names of the profiles in use, from the most accurate to the cheapest,
+            DEFAULT_DECODING_PROFILES by default.
+        level (int): The index of the current profile.
+        step_down_real_time_factor (float): Real-time factor above which a cheaper profile is used.
+        step_down_queue_depth (int): Queue depth above which a cheaper profile is used.
+        step_up_real_time_factor (float): Real-time factor under which a more accurate profile may be used.
+        step_up_queue_depth (int): Queue depth at or under which a more accurate profile may be used.
+        hold_seconds (float): Minimum time between two changes.
+    """
+
+    def __init__(self, profiles=None, step_down_real_time_factor=0.5, step_down_queue_depth=4,
+                 step_up_real_time_factor=0.2, step_up_queue_depth=1, hold_seconds=5.0):
+        self.profiles = list(profiles or DEFAULT_DECODING_PROFILES)
+        unknown = [name for name in self.profiles if name not in DECODING_PROFILES]
+        if unknown or not self.profiles:
+            raise ValueError(f"Unknown decoding profiles: {unknown}")
+        self.level = 0
+        self.step_down_real_time_factor = step_down_real_time_factor
+        self.step_down_queue_depth = step_down_queue_depth
+        self.step_up_real_time_factor = step_up_real_time_factor
+        self.step_up_queue_depth = step_up_queue_depth
+        self.hold_seconds = hold_seconds
+        self.changed_at = 0.0
+
+    @property
+    def profile(self):
+        return self.profiles[self.level]
+
+    def update(self, queue_depth, real_time_factor, now=None):
+        """
+        Moves one profile down or up if the load calls for it.
+
+        Args:
+            queue_depth (int): Chunks waiting for this replica.
+            real_time_factor (float): Moving average of the processing seconds per audio second.
+            now (float): The current time, as returned by time.monotonic().
+
+        Returns:
+            int: -1 if a cheaper profile was picked, 1 if a more accurate one was, 0 otherwise.
+        """
+        now = time.monotonic() if now is None else now
+        if now - self.changed_at < self.hold_seconds:
+            return 0
+        overloaded = queue_depth > self.step_down_queue_depth or real_time_factor > self.step_down_real_time_factor
+        underloaded = queue_depth <= self.step_up_queue_depth and real_time_factor < self.step_up_real_time_factor
+        if overloaded and self.level < len(self.profiles) - 1:
+            self.level += 1
+            self.changed_at = now
+            return -1
+        if underloaded and self.level > 0:
+            self.level -= 1
+            self.changed_at = now
+            return 1
+        return 0
@@ -1,13 +1,25 @@
 import os
+import time
+import asyncio
+import logging
 from faster_whisper import WhisperModel
 
 from .asr_interface import ASRInterface
+from .decoding_profiles import DECODING_PROFILES, DEFAULT_DECODING_PROFILES, DecodingProfileController
+from .hedged_asr import ReplicaDegradedError
+from .log_mel import PrecomputedFeatureExtractor, pcm_to_float, whisper_features
 from src.audio_utils import save_audio_to_file
+from src.introspection import replica_tag
+from src.tracing import get_tracer
+from src.weight_sharing import report_model_load
 
 
 from ray import serve
+from ray.serve import metrics
 from ray.serve.handle import DeploymentHandle
 
+logger = logging.getLogger("ray.serve")
+
 language_codes = {
     "afrikaans": "af",
     "amharic": "am",
@@ -118,31 +130,282 @@ language_codes = {
 class FasterWhisperASR(ASRInterface):
     def __init__(self, **kwargs):
         model_size = kwargs.get('model_size', "large-v3")
-        # Run on GPU with FP16
+        start = time.time()
+        # The model is not staged in the weight sharing directory: CTranslate2 copies
+        # the weights into its own memory, so a copy in tmpfs would only add to the
+        # memory of the node. The model directory is read through the page cache.
+        # Run on GPU with FP16 by default, e.g. 'cpu' and 'int8' for the batch CLI on a CPU host
         self.asr_pipeline = WhisperModel(
-            model_size, device="cuda", compute_type="float16")
+            model_size, device=kwargs.get('device', "cuda"), compute_type=kwargs.get('compute_type', "float16"))
+        report_model_load(f"faster-whisper-{model_size}", time.time() - start)
+        # Uses the log-mel frames the ingress computed, when a request comes with them
+        self.asr_pipeline.feature_extractor = PrecomputedFeatureExtractor(self.asr_pipeline.feature_extractor)
+        self.n_mels = self.asr_pipeline.feature_extractor.mel_filters.shape[0]
+        self.precomputed_features = metrics.Counter(
+            "asr_precomputed_features", description="Transcriptions by whether the ingress computed the features.",
+            tag_keys=("precomputed",))
 
-    async def transcribe(self, client):
-        file_path = await save_audio_to_file(client.scratch_buffer, client.get_file_name())
+        self.replica_tag = replica_tag()
+        # Moving average of the processing seconds per audio second, reported with
+        # every result so the ingress can score this replica against the others.
+        # It is only trusted for a short while, so a replica that was avoided gets
+        # traffic again once it may have recovered.
+        self.real_time_factor = 0.0
+        self.real_time_factor_updated_at = 0.0
+        self.real_time_factor_ttl_seconds = float(os.environ.get('ASR_REPLICA_SCORE_TTL_SECONDS', 30.0))
+        self.tracer = get_tracer(replica=self.replica_tag)
 
-        language = None if client.config['language'] is None else language_codes.get(
-            client.config['language'].lower())
-        segments, info = self.asr_pipeline.transcribe(
-            file_path, word_timestamps=True, language=language)
+        # Cheaper decoding profiles are used while the replica is overloaded
+        profiles = os.environ.get('ASR_DECODING_PROFILES')
+        if not profiles:
+            profiles = kwargs.get('decoding_profiles', DEFAULT_DECODING_PROFILES)
+        elif isinstance(profiles, str):
+            profiles = [name.strip() for name in profiles.split(',')]
+        thresholds = {}
+        for setting in ('step_down_real_time_factor', 'step_down_queue_depth', 'step_up_real_time_factor',
+                        'step_up_queue_depth', 'hold_seconds'):
+            value = os.environ.get(f"ASR_PROFILE_{setting.upper()}")
+            if not value:
+                value = kwargs.get(setting)
+            if value is not None:
+                thresholds[setting] = float(value)
+        self.decoding_profiles = DecodingProfileController(profiles, **thresholds)
+        self.in_flight = 0
+        self.profile_level_gauge = metrics.Gauge(
+            "asr_decoding_profile_level", description="Index of the decoding profile in use, 0 being the most accurate.")
+        self.profile_level_gauge.set(self.decoding_profiles.level)
+        self.profile_changes = metrics.Counter(
+            "asr_decoding_profile_changes", description="Changes of the decoding profile, by direction.",
+            tag_keys=("direction",))
+
+        # Behind an ASRScheduler, the replica pulls its chunks instead of being sent them
+        scheduler_handle = kwargs.get('scheduler_handle')
+        self.pull_tasks = []
+        if scheduler_handle is not None:
+            concurrency = os.environ.get('ASR_SCHEDULER_REPLICA_CONCURRENCY')
+            if not concurrency:
+                concurrency = kwargs.get('scheduler_concurrency', 1)
+            loop = asyncio.get_running_loop()
+            self.pull_tasks = [loop.create_task(self.pull_jobs(scheduler_handle)) for _ in range(int(concurrency))]
+
+    def __del__(self):
+        # Called by Ray Serve when the replica shuts down, writes the spans still buffered
+        get_tracer().flush()
+
+    async def pull_jobs(self, scheduler_handle):
+        """
+        Takes chunks from the ASRScheduler, transcribes them and hands back the results.
+        """
+        while True:
+            try:
+                job = await scheduler_handle.next_job.remote(self.replica_tag)
+            except Exception:
+                logger.exception("Could not take a job from the ASR scheduler")
+                await asyncio.sleep(1.0)
+                continue
+            if job is None:
+                continue
+
+            job_id, client, kwargs = job
+            try:
+                result = await self.transcribe(client, **kwargs)
+            except Exception as e:
+                logger.exception(f"Transcription of job {job_id} failed")
+                await scheduler_handle.complete.remote(job_id, error=repr(e))
+            else:
+                await scheduler_handle.complete.remote(job_id, result=result)
+
+    def select_decoding_profile(self, queue_depth):
+        """
+        Returns the name of the decoding profile for the next chunk, after stepping
+        down or up according to the load of the replica.
+
+        Args:
+            queue_depth (int): Chunks waiting for this replica.
+        """
+        direction = self.decoding_profiles.update(queue_depth, self.real_time_factor)
+        if direction != 0:
+            self.profile_level_gauge.set(self.decoding_profiles.level)
+            self.profile_changes.inc(tags={"direction": "up" if direction > 0 else "down"})
+            logger.info(f"{self.replica_tag} switched to the '{self.decoding_profiles.profile}' decoding profile, "
+                        f"queue depth {queue_depth}, real-time factor {self.real_time_factor:.2f}")
+        return self.decoding_profiles.profile
+
+    def reject_if_degraded(self, avoid_replicas, max_real_time_factor):
+        """
+        Rejects a request that the ingress wants served by a healthier replica.
+
+        Raises:
+            ReplicaDegradedError: If this replica is in `avoid_replicas`, or slower than `max_real_time_factor`.
+        """
+        if avoid_replicas and self.replica_tag in avoid_replicas:
+            raise ReplicaDegradedError(f"{self.replica_tag} is degraded")
+        if (max_real_time_factor is not None and self.real_time_factor > max_real_time_factor
+                and time.time() - self.real_time_factor_updated_at < self.real_time_factor_ttl_seconds):
+            raise ReplicaDegradedError(f"{self.replica_tag} is degraded, real-time factor {self.real_time_factor:.2f}")
+
+    async def transcribe(self, client, avoid_replicas=None, max_real_time_factor=None, queue_depth=None):
+        """
+        Transcribes the scratch buffer of a client.
+
+        Args:
+            client (Client): The client, or the snapshot of it, holding the audio.
+            avoid_replicas (list): Replica tags that should reject the request, see HedgedASR.
+            max_real_time_factor (float): Real-time factor above which the replica rejects the request.
+            queue_depth (int): Chunks waiting per replica, when the ASRScheduler knows it; by
+                default the other requests this replica has in flight.
+        """
+        self.reject_if_degraded(avoid_replicas, max_real_time_factor)
+        if queue_depth is None:
+            queue_depth = self.in_flight
+        self.in_flight += 1
+        try:
+            return await self.transcribe_with_profile(client, self.select_decoding_profile(queue_depth))
+        finally:
+            self.in_flight -= 1
 
-        segments = list(segments)  # The transcription will actually run here.
-        os.remove(file_path)
+    async def transcribe_streaming(self, client, avoid_replicas=None, max_real_time_factor=None, queue_depth=None):
+        """
+        Transcribes the scratch buffer of a client, yielding each segment as soon as
+        it is decoded. Called through a streaming handle, see HedgedASR.
 
-        flattened_words = [
-            word for segment in segments for word in segment.words]
+        Args:
+            See transcribe().
+
+        Yields:
+            dict: A message of type 'segment' per segment, with its text, start, end and words relative
+                to the audio; then the transcription transcribe() returns.
+        """
+        self.reject_if_degraded(avoid_replicas, max_real_time_factor)
+        if queue_depth is None:
+            queue_depth = self.in_flight
+        self.in_flight += 1
+        try:
+            async for message in self.decode(client, self.select_decoding_profile(queue_depth), stream_segments=True):
+                yield message
+        finally:
+            self.in_flight -= 1
+
+    async def transcribe_with_profile(self, client, profile):
+        async for transcription in self.decode(client, profile):
+            pass
+        return transcription
+
+    def word_timestamps(self, segments, profile):
+        """
+        Returns the words of decoded segments, None if the profile has no word timestamps.
+        """
+        if not DECODING_PROFILES[profile]['word_timestamps']:
+            return None
+        return [{"word": w.word, "start": w.start, "end": w.end, "probability": w.probability}
+                for segment in segments for w in segment.words]
+
+    def start_transcription(self, audio, features, language, prompt, profile):
+        """
+        Starts a transcription with a decoding profile, in the thread that runs it.
+
+        Returns:
+            tuple: The segments, decoded lazily, and the transcription info.
+        """
+        # Set on every call, so that features left over by a failed call are never used
+        self.asr_pipeline.feature_extractor.use(features)
+        return self.asr_pipeline.transcribe(audio, language=language, initial_prompt=prompt,
+                                            **DECODING_PROFILES[profile])
+
+    def transcribe_all(self, audio, features, language, prompt, profile):
+        """
+        Runs a transcription to the end, see start_transcription().
+        """
+        segments, info = self.start_transcription(audio, features, language, prompt, profile)
+        return list(segments), info  # The transcription will actually run here.
+
+    async def decode(self, client, profile, stream_segments=False):
+        """
+        Transcribes the scratch buffer of a client with a decoding profile.
+
+        Args:
+            client (Client): The client, or the snapshot of it, holding the audio.
+            profile (str): The name of the decoding profile.
+            stream_segments (bool): Whether to yield each segment as soon as it is decoded.
+
+        Yields:
+            dict: With `stream_segments`, a message of type 'segment' per segment; then the transcription.
+        """
+        start = time.time()
+        trace_context = getattr(client, 'trace_context', None)
+        log_mel_frames = getattr(client, 'log_mel_frames', None)
+        precomputed = log_mel_frames is not None and log_mel_frames.shape[0] == self.n_mels
+        self.precomputed_features.inc(tags={"precomputed": str(precomputed).lower()})
+        if precomputed:
+            # The waveform only gives the duration, the model gets the features
+            audio = pcm_to_float(client.scratch_buffer)
+            features = whisper_features(log_mel_frames, len(audio))
+            file_path = None
+        else:
+            features = None
+            with self.tracer.span("asr.file_io", trace_context, operation="write"):
+                audio = file_path = await save_audio_to_file(client.scratch_buffer, client.get_file_name())
+
+        language = None if client.config['language'] is None else language_codes.get(
+            client.config['language'].lower())
+        audio_seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        # Seconds spent waiting for the consumer of the segments, which are not decoding time
+        consumer_seconds = 0.0
+        try:
+            # Decoding off the event loop lets the replica take other requests meanwhile,
+            # so that in_flight counts the requests waiting for this replica.
+            loop = asyncio.get_running_loop()
+            arguments = (audio, features, language, getattr(client, 'prompt', None), profile)
+            if stream_segments:
+                # Segments are decoded lazily, the replica sends each segment while the next one
+                # is decoded. Every decode step is a span of its own, step 0 starting the
+                # transcription, and the time the consumer takes to read a segment is another.
+                with self.tracer.span("asr.inference", trace_context, audio_seconds=audio_seconds,
+                                      decoding_profile=profile, decode_step=0):
+                    segments, info = await loop.run_in_executor(None, self.start_transcription, *arguments)
+                decoded = []
+                while True:
+                    with self.tracer.span("asr.inference", trace_context, audio_seconds=audio_seconds,
+                                          decoding_profile=profile, decode_step=len(decoded) + 1):
+                        segment = await loop.run_in_executor(None, next, segments, None)
+                    if segment is None:
+                        break
+                    decoded.append(segment)
+                    yielded_at = time.time()
+                    yield {
+                        "type": "segment",
+                        "text": segment.text.strip(),
+                        "start": segment.start,
+                        "end": segment.end,
+                        "words": self.word_timestamps([segment], profile),
+                    }
+                    consumer_seconds += time.time() - yielded_at
+                    self.tracer.record("asr.consumer_wait", trace_context, yielded_at, time.time(),
+                                       decode_step=len(decoded))
+                segments = decoded
+            else:
+                with self.tracer.span("asr.inference", trace_context, audio_seconds=audio_seconds,
+                                      decoding_profile=profile):
+                    segments, info = await loop.run_in_executor(None, self.transcribe_all, *arguments)
+        finally:
+            if file_path is not None:
+                with self.tracer.span("asr.file_io", trace_context, operation="remove"):
+                    os.remove(file_path)
 
         to_return = {
             "language": info.language,
             "language_probability": info.language_probability,
             "text": ' '.join([s.text.strip() for s in segments]),
-            "words":
-            [
-                {"word": w.word, "start": w.start, "end": w.end, "probability": w.probability} for w in flattened_words
-            ]
+            # Profiles without word timestamps have no words
+            "words": self.word_timestamps(segments, profile),
+            "decoding_profile": profile,
         }
-        return to_return
+
+        if audio_seconds > 0:
+            processing_seconds = time.time() - start - consumer_seconds
+            self.real_time_factor = 0.8 * self.real_time_factor + 0.2 * processing_seconds / audio_seconds
+            self.real_time_factor_updated_at = time.time()
+        to_return["replica"] = self.replica_tag
+        to_return["replica_real_time_factor"] = self.real_time_factor
+        self.tracer.record("asr.replica", trace_context, start, time.time())
+        yield to_return
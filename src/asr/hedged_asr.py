@@ -0,0 +1,279 @@
+import os
+import time
+import asyncio
+import statistics
+from collections import deque
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+
+class ReplicaDegradedError(RuntimeError):
+    """
+    Raised by an ASR replica that was asked to reject the request because the
+    ingress considers it degraded, so that the request is routed again.
+    """
+    pass
+
+
+class LatencyTracker:
+    """
+    Keeps the real-time factor (processing seconds per audio second) of the most
+    recent ASR calls and answers percentile queries over them.
+
+    Attributes:
+        real_time_factors (deque): The most recent real-time factors.
+    """
+
+    def __init__(self, window_size=200):
+        self.real_time_factors = deque(maxlen=window_size)
+
+    def record(self, real_time_factor):
+        self.real_time_factors.append(real_time_factor)
+
+    def percentile(self, percentile):
+        """
+        Returns the given percentile of the recorded real-time factors, or None if
+        too few calls were recorded to be meaningful.
+        """
+        if len(self.real_time_factors) < 10:
+            return None
+        ordered = sorted(self.real_time_factors)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+
+class ReplicaScores:
+    """
+    Short-lived slowness scores of the ASR replicas.
+
+    Every ASR result reports the replica that produced it and the replica's own
+    moving average of its real-time factor. The score of a replica is that average
+    divided by the median over all replicas heard from recently; reports that were
+    not refreshed within `ttl_seconds` are forgotten, so a replica that recovers
+    stops being avoided.
+
+    A replica that has become slow loses every hedged race and may never report
+    back, so requests also carry `max_real_time_factor()` and replicas compare it
+    against their own, always current, moving average.
+
+    Attributes:
+        ttl_seconds (float): How long a reported real-time factor is trusted.
+        threshold (float): Score above which a replica is considered degraded.
+        reports (dict): Maps replica tags to (real-time factor, report time).
+    """
+
+    def __init__(self, ttl_seconds=30.0, threshold=2.0):
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.reports = {}
+
+    def record(self, replica_tag, real_time_factor):
+        self.reports[replica_tag] = (real_time_factor, time.monotonic())
+
+    def median(self):
+        now = time.monotonic()
+        self.reports = {replica_tag: report for replica_tag, report in self.reports.items()
+                        if now - report[1] < self.ttl_seconds}
+        if not self.reports:
+            return None
+        return statistics.median(real_time_factor for real_time_factor, _ in self.reports.values())
+
+    def scores(self):
+        median = self.median()
+        if not median:
+            return {}
+        return {replica_tag: real_time_factor / median
+                for replica_tag, (real_time_factor, _) in self.reports.items()}
+
+    def degraded(self):
+        return [replica_tag for replica_tag, score in self.scores().items() if score > self.threshold]
+
+    def max_real_time_factor(self):
+        median = self.median()
+        return None if not median else median * self.threshold
+
+
+class HedgedResponse:
+    """
+    Awaitable result of a hedged call, cancellable like a DeploymentResponse.
+    """
+
+    def __init__(self, task):
+        self.task = task
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def cancel(self):
+        self.task.cancel()
+
+
+class HedgedMethod:
+    # Takes the on_segment listener of the live client, see Client.call_deployment()
+    streams_segments = True
+
+    def __init__(self, hedged_asr):
+        self.hedged_asr = hedged_asr
+
+    def remote(self, client, **kwargs):
+        return HedgedResponse(asyncio.create_task(self.hedged_asr.transcribe_hedged(client, **kwargs)))
+
+
+class HedgedASR:
+    """
+    Wraps the FasterWhisperASR deployment handle with per-chunk deadlines and
+    hedged requests.
+
+    It exposes the same `transcribe.remote(client=...)` call as the deployment
+    handle, so buffering strategies use it unchanged. When the call has an
+    `on_segment` listener, the replicas stream the segments of the transcription as
+    they are decoded, and the listener is called with each of them. A call that has not returned
+    after the configured percentile of recent latencies is hedged with a second
+    request; the first reply wins and the other request is cancelled. Requests ask
+    replicas with a high slowness score to reject them, and rejected requests are
+    sent again, which makes the Ray Serve router pick another replica.
+
+    Attributes:
+        asr_handle (DeploymentHandle): The handle of the ASR deployment.
+        deadline_seconds (float): Per-chunk deadline, unless the client config sets 'asr_deadline_seconds'.
+        hedge_percentile (float): Latency percentile after which a call is hedged, 0 disables hedging.
+        min_hedge_delay_seconds (float): Lower bound for the hedging delay.
+        max_redirects (int): How many times a request may be rejected by degraded replicas.
+        latencies (LatencyTracker): Real-time factors of the recent calls.
+        replica_scores (ReplicaScores): Slowness scores of the replicas.
+    """
+
+    def __init__(self, asr_handle, **kwargs):
+        self.asr_handle = asr_handle
+        self.transcribe = HedgedMethod(self)
+
+        self.deadline_seconds = os.environ.get('ASR_DEADLINE_SECONDS')
+        if not self.deadline_seconds:
+            self.deadline_seconds = kwargs.get('deadline_seconds', 10.0)
+        self.deadline_seconds = float(self.deadline_seconds)
+
+        self.hedge_percentile = os.environ.get('ASR_HEDGE_PERCENTILE')
+        if not self.hedge_percentile:
+            self.hedge_percentile = kwargs.get('hedge_percentile', 95)
+        self.hedge_percentile = float(self.hedge_percentile)
+
+        self.min_hedge_delay_seconds = os.environ.get('ASR_MIN_HEDGE_DELAY_SECONDS')
+        if not self.min_hedge_delay_seconds:
+            self.min_hedge_delay_seconds = kwargs.get('min_hedge_delay_seconds', 0.3)
+        self.min_hedge_delay_seconds = float(self.min_hedge_delay_seconds)
+
+        self.max_redirects = int(kwargs.get('max_redirects', 2))
+
+        self.latencies = LatencyTracker()
+        self.replica_scores = ReplicaScores(
+            ttl_seconds=float(os.environ.get('ASR_REPLICA_SCORE_TTL_SECONDS') or kwargs.get('replica_score_ttl_seconds', 30.0)),
+            threshold=float(os.environ.get('ASR_REPLICA_SCORE_THRESHOLD') or kwargs.get('replica_score_threshold', 2.0)))
+
+    async def transcribe_hedged(self, client, on_segment=None, **kwargs):
+        """
+        Transcribe the scratch buffer of `client` within its deadline.
+
+        Args:
+            client (Client): The client, or the snapshot of it, holding the audio.
+            on_segment (Callable): Coroutine function called with each segment and `client`,
+                None to get the whole transcription at once.
+
+        Returns:
+            dict: The transcription of whichever request finished first.
+
+        Raises:
+            asyncio.TimeoutError: If no request finished before the deadline.
+        """
+        audio_seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        deadline_seconds = float(client.config.get('asr_deadline_seconds') or self.deadline_seconds)
+
+        hedge_delay = None
+        if self.hedge_percentile > 0:
+            real_time_factor = self.latencies.percentile(self.hedge_percentile)
+            if real_time_factor is not None:
+                hedge_delay = max(self.min_hedge_delay_seconds, real_time_factor * audio_seconds)
+
+        # Only the segments of one request are forwarded, the first to send one
+        leader = []
+
+        def forwarder():
+            if on_segment is None:
+                return None
+            token = object()
+
+            async def forward(segment):
+                if not leader:
+                    leader.append(token)
+                if leader[0] is token:
+                    await on_segment(segment, client)
+            return forward
+
+        start = time.monotonic()
+        calls = {asyncio.create_task(self.call(client, forwarder(), **kwargs))}
+        try:
+            while True:
+                remaining = deadline_seconds - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise asyncio.TimeoutError(f"ASR deadline of {deadline_seconds}s exceeded for {client.client_id}")
+
+                timeout = remaining
+                hedging = hedge_delay is not None and len(calls) == 1
+                if hedging:
+                    timeout = min(remaining, max(0.0, hedge_delay - (time.monotonic() - start)))
+
+                done, calls = await asyncio.wait(calls, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    if call.exception() is None:
+                        self.latencies.record((time.monotonic() - start) / max(audio_seconds, 1e-3))
+                        return call.result()
+                    logger.warning(f"ASR request for {client.client_id} failed: {call.exception()}")
+
+                if not calls and not hedging:
+                    raise done.pop().exception()
+                if hedging and (not done or not calls):
+                    # Hedge once the threshold is passed, or right away if the
+                    # first request already failed.
+                    logger.debug(f"Hedging ASR request for {client.client_id} after {time.monotonic() - start:.2f}s")
+                    calls.add(asyncio.create_task(self.call(client, forwarder(), **kwargs)))
+                    hedge_delay = None
+        finally:
+            for call in calls:
+                call.cancel()
+
+    async def call(self, client, on_segment=None, **kwargs):
+        """
+        Send a single ASR request, routing it again if it lands on a degraded replica.
+
+        Args:
+            client (Client): The client, or the snapshot of it, holding the audio.
+            on_segment (Callable): Coroutine function called with each segment as it is decoded,
+                None to get the whole transcription at once.
+        """
+        for attempt in range(self.max_redirects + 1):
+            avoid_replicas, max_real_time_factor = [], None
+            if attempt < self.max_redirects:
+                avoid_replicas = self.replica_scores.degraded()
+                max_real_time_factor = self.replica_scores.max_real_time_factor()
+            try:
+                if on_segment is None:
+                    response = self.asr_handle.transcribe.remote(
+                        client = client, avoid_replicas = avoid_replicas, max_real_time_factor = max_real_time_factor, **kwargs)
+                    transcription = await response
+                else:
+                    response = self.asr_handle.options(stream=True).transcribe_streaming.remote(
+                        client = client, avoid_replicas = avoid_replicas, max_real_time_factor = max_real_time_factor, **kwargs)
+                    async for message in response:
+                        if message.get('type') == 'segment':
+                            await on_segment(message)
+                        else:
+                            transcription = message
+            except ReplicaDegradedError:
+                continue
+            except asyncio.CancelledError:
+                response.cancel()
+                raise
+            # Only the ingress needs the replica's report, the client does not get it
+            self.replica_scores.record(transcription.pop('replica'), transcription.pop('replica_real_time_factor'))
+            return transcription
+        raise ReplicaDegradedError(f"No healthy ASR replica accepted the request for {client.client_id}")
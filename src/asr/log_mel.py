@@ -0,0 +1,325 @@
+import time
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from faster_whisper.feature_extractor import FeatureExtractor
+
+# Whisper's short-time Fourier transform: 25 ms windows every 10 ms at 16 kHz,
+# centered on their frame, and 30 second model inputs.
+N_FFT = 400
+HOP_LENGTH = 160
+HALF_WINDOW = N_FFT // 2
+SAMPLING_RATE = 16000
+CHUNK_LENGTH = 30
+# The log-mel value of silence, the zero padding after the audio
+SILENCE = np.log10(1e-10)
+
+
+def pcm_to_float(pcm):
+    """
+    Converts 16-bit PCM audio to the float waveform Whisper decodes audio files to.
+    """
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def whisper_features(log_mel_frames, num_samples, chunk_length=CHUNK_LENGTH):
+    """
+    Turns the log-mel frames of some audio into the input faster-whisper computes
+    for it: the frames of the audio followed by 30 seconds of zero padding,
+    clamped to 8 (log10) below their maximum and rescaled.
+
+    Args:
+        log_mel_frames (np.ndarray): The frames that cover audio, as returned by StreamingLogMel.chunk_frames().
+        num_samples (int): The number of samples of the audio.
+
+    Returns:
+        np.ndarray: The features, n_mels x (num_samples // 160 + 3000).
+    """
+    num_frames = (num_samples + chunk_length * SAMPLING_RATE) // HOP_LENGTH
+    log_spec = np.full((log_mel_frames.shape[0], num_frames), SILENCE, dtype=np.float32)
+    log_spec[:, :log_mel_frames.shape[1]] = log_mel_frames[:, :num_frames]
+    log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+
+class StreamingLogMel:
+    """
+    Computes Whisper's log-mel frames of an audio stream as it arrives.
+
+    faster-whisper featurizes every chunk from scratch, with a Python loop over its
+    frames. The frames of a chunk only depend on the audio under their window,
+    except for the few whose window crosses the edges of the chunk, and on the
+    maximum used to clamp them, which is applied last. This class computes each
+    frame of the stream once, vectorized, as soon as the audio under its window has
+    arrived, keeping the end of the audio that the next frames need. A chunk of the
+    stream then only needs its edge frames computed to get exactly the features
+    faster-whisper would.
+
+    Frames are centered every 10 ms from the position the stream (re)started at.
+    Chunks that do not start on this grid, or whose audio is not the audio the
+    frames were computed from, are featurized whole.
+
+    The ingress receives audio on its event loop, which must not run the STFTs.
+    feed(), discard(), reset() and request_chunk_frames() only queue their work;
+    compute() runs it in order, in one batch per chunk, on the executor thread.
+    schedule() submits compute() when a chunk requests its frames, or when
+    compute_due() finds the work queued since the last submission too old or too
+    long, e.g. for audio that no chunk is sent for.
+
+    Attributes:
+        n_mels (int): The number of mel bins of the ASR model, 128 for large-v3 and 80 for the others.
+        origin (int): Stream position of the first sample, the center of frame 0.
+        end (int): Stream position after the last sample received.
+        first_frame (int): Index of the first frame kept.
+    """
+
+    # One thread computes the frames of every stream of the process. More threads
+    # would take the GIL from the event loop more often, for no more throughput.
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-mel")
+    # Bounds of the work queued between two submissions of compute()
+    max_pending_seconds = 1.0
+    max_pending_operations = 128
+
+    def __init__(self, n_mels=128):
+        self.n_mels = n_mels
+        self.mel_filters = FeatureExtractor(feature_size=n_mels).mel_filters
+        self.window = np.hanning(N_FFT + 1)[:-1]
+        self.operations = collections.deque()
+        self.pending_operations = 0
+        self.pending_since = 0.0
+        self.lock = threading.Lock()
+        self.restart(0)
+
+    def reset(self, position):
+        """
+        Restarts the stream at a position, dropping every frame.
+        """
+        self.queue(self.restart, position)
+
+    def feed(self, pcm):
+        """
+        Adds audio to the end of the stream.
+
+        Args:
+            pcm (bytes): 16-bit PCM audio.
+        """
+        self.queue(self.add_audio, pcm)
+
+    def discard(self, position):
+        """
+        Drops the frames centered before a stream position, which no chunk needs anymore.
+        """
+        self.queue(self.drop_frames, position)
+
+    def request_chunk_frames(self, position, pcm):
+        """
+        Queues chunk_frames() for a chunk of the audio fed so far.
+
+        Returns:
+            Future: The frames, once compute() has run.
+        """
+        future = Future()
+        self.queue(self.resolve_chunk_frames, position, pcm, future)
+        return future
+
+    def queue(self, operation, *args):
+        """
+        Queues an operation for compute().
+        """
+        if self.pending_operations == 0:
+            self.pending_since = time.monotonic()
+        self.pending_operations += 1
+        self.operations.append((operation, args))
+
+    def compute_due(self):
+        """
+        Whether the work queued since compute() was last scheduled should be
+        computed without waiting for the next chunk.
+        """
+        return (self.pending_operations >= self.max_pending_operations
+                or (self.pending_operations > 0
+                    and time.monotonic() - self.pending_since >= self.max_pending_seconds))
+
+    def schedule(self, loop):
+        """
+        Runs compute() on the executor thread, for the work queued so far.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The event loop queuing the work.
+        """
+        self.pending_operations = 0
+        return loop.run_in_executor(self.executor, self.compute)
+
+    def chunk_frames(self, position, pcm):
+        """
+        Returns the log-mel frames faster-whisper computes for a chunk of the stream,
+        up to the zero padding.
+
+        Args:
+            position (int): Stream position of the chunk, in samples.
+            pcm (bytes): The 16-bit PCM audio of the chunk.
+
+        Returns:
+            np.ndarray: n_mels x ceil((len + 200) / 160) frames, before clamping and
+                rescaling, see whisper_features().
+        """
+        future = self.request_chunk_frames(position, pcm)
+        self.compute()
+        return future.result()
+
+    def compute(self):
+        """
+        Runs the queued operations in the order they were queued. Safe to call from
+        any thread; the operations queued meanwhile are run by the next call.
+        """
+        with self.lock:
+            while self.operations:
+                operation, args = self.operations.popleft()
+                if operation == self.add_audio:
+                    # The messages received since the last chunk are featurized together
+                    pcm = [args[0]]
+                    while self.operations and self.operations[0][0] == self.add_audio:
+                        pcm.append(self.operations.popleft()[1][0])
+                    args = (b''.join(pcm),)
+                operation(*args)
+
+    def resolve_chunk_frames(self, position, pcm, future):
+        """
+        Sets the result of a future to the frames of a chunk, or to the error computing them.
+        """
+        try:
+            future.set_result(self.compute_chunk_frames(position, pcm))
+        except Exception as e:
+            future.set_exception(e)
+
+    def restart(self, position):
+        """
+        Drops every frame and restarts the stream at a position, see reset().
+        """
+        self.origin = position
+        self.end = position
+        # Frames 0 and 1 would need audio before the origin
+        self.first_frame = 2
+        self.next_frame = 2
+        self.tail = np.zeros(0, dtype=np.float32)
+        self.tail_start = position
+        self.blocks = []
+
+    def log_mel(self, windows):
+        """
+        Computes the log-mel frames of windows of samples, like FeatureExtractor.
+
+        Returns:
+            np.ndarray: n_mels x len(windows) frames, before clamping and rescaling.
+        """
+        stft = np.fft.rfft(windows.astype(np.float64) * self.window, axis=1).astype(np.complex64)
+        magnitudes = np.abs(stft) ** 2
+        mel_spec = self.mel_filters @ magnitudes.T
+        return np.log10(np.clip(mel_spec, a_min=1e-10, a_max=None))
+
+    def add_audio(self, pcm):
+        """
+        Adds audio to the end of the stream and computes the frames it completes.
+        """
+        self.tail = np.concatenate([self.tail, pcm_to_float(pcm)])
+        self.end += len(pcm) // 2
+
+        # Frames whose whole window has arrived
+        last_frame = (self.end - HALF_WINDOW - self.origin) // HOP_LENGTH
+        if last_frame >= self.next_frame:
+            start = self.origin + self.next_frame * HOP_LENGTH - HALF_WINDOW - self.tail_start
+            windows = sliding_window_view(self.tail[start:], N_FFT)[::HOP_LENGTH][:last_frame - self.next_frame + 1]
+            self.blocks.append(self.log_mel(windows))
+            self.next_frame = last_frame + 1
+        # Keep the audio of the next frames
+        keep_from = min(self.origin + self.next_frame * HOP_LENGTH - HALF_WINDOW, self.end)
+        self.tail = self.tail[keep_from - self.tail_start:]
+        self.tail_start = keep_from
+
+    def drop_frames(self, position):
+        """
+        Drops the frames centered before a stream position, see discard().
+        """
+        frame = max(self.first_frame, min(-(-(position - self.origin) // HOP_LENGTH), self.next_frame))
+        if frame == self.first_frame:
+            return
+        frames = self.frames()
+        self.blocks = [frames[:, frame - self.first_frame:]]
+        self.first_frame = frame
+
+    def frames(self):
+        """
+        Returns the frames kept, merged into one array.
+        """
+        if len(self.blocks) != 1:
+            self.blocks = [np.concatenate(self.blocks, axis=1) if self.blocks
+                           else np.zeros((self.n_mels, 0), dtype=np.float32)]
+        return self.blocks[0]
+
+    def compute_chunk_frames(self, position, pcm):
+        """
+        Computes the frames of a chunk from the frames of the stream, see chunk_frames().
+        """
+        waveform = pcm_to_float(pcm)
+        num_samples = len(waveform)
+        num_frames = -(-(num_samples + HALF_WINDOW) // HOP_LENGTH)
+        # Chunk frame j is centered on sample j * 160 of the chunk; the first are
+        # padded by reflecting the start of the chunk, the last with zeros.
+        start = np.pad(waveform[:HALF_WINDOW + 1], (0, max(0, HALF_WINDOW + 1 - num_samples)))
+        padded = np.concatenate([start[HALF_WINDOW:0:-1], waveform, np.zeros(2 * HALF_WINDOW, dtype=np.float32)])
+        windows = sliding_window_view(padded, N_FFT)[::HOP_LENGTH][:num_frames]
+
+        # Frames whose window lies within the chunk are frames of the stream
+        first_inner = 2
+        last_inner = (num_samples - HALF_WINDOW) // HOP_LENGTH
+        offset = position - self.origin
+        if offset % HOP_LENGTH == 0 and last_inner >= first_inner:
+            first_stream_frame = offset // HOP_LENGTH + first_inner
+            last_stream_frame = offset // HOP_LENGTH + last_inner
+            if self.first_frame <= first_stream_frame and last_stream_frame < self.next_frame:
+                frames = self.frames()[:, first_stream_frame - self.first_frame:last_stream_frame - self.first_frame + 1]
+                # Computed the same way, a frame of the same audio is identical
+                edges = self.log_mel(windows[[first_inner, last_inner]])
+                if np.array_equal(edges, frames[:, [0, -1]]):
+                    return np.concatenate([
+                        self.log_mel(windows[:first_inner]),
+                        frames,
+                        self.log_mel(windows[last_inner + 1:]),
+                    ], axis=1)
+        return self.log_mel(windows)
+
+
+class PrecomputedFeatureExtractor:
+    """
+    Stands in for the feature extractor of a WhisperModel, so that transcribe()
+    uses the features of the current thread instead of computing them.
+
+    Attributes:
+        feature_extractor (FeatureExtractor): The feature extractor of the model, used when no
+            features were given and for its settings.
+    """
+
+    def __init__(self, feature_extractor):
+        self.feature_extractor = feature_extractor
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        if name in ('feature_extractor', 'local'):
+            raise AttributeError(name)
+        return getattr(self.feature_extractor, name)
+
+    def use(self, features):
+        """
+        Sets the features returned by the next call in this thread.
+        """
+        self.local.features = features
+
+    def __call__(self, waveform, padding=True, chunk_length=None):
+        features = getattr(self.local, 'features', None)
+        self.local.features = None
+        if features is None or chunk_length is not None:
+            return self.feature_extractor(waveform, padding=padding, chunk_length=chunk_length)
+        return features
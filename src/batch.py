@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from src.asr.asr_factory import ASRFactory
+from src.vad.vad_factory import VADFactory
+from src.client import Client
+from src.sdk.sources import load_audio_file
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".m4a", ".ogg", ".opus", ".webm")
+
+# The models of the worker process or thread, see init_worker()
+worker_state = threading.local()
+
+
+def discover_inputs(input_path):
+    """
+    Lists the audio files to transcribe.
+
+    Args:
+        input_path (str): A directory, searched recursively for audio files, or a JSON
+            lines manifest with one object per file: its 'path' (relative to the
+            manifest), and optionally an 'id' and a 'language'.
+
+    Returns:
+        List[dict]: The files, each with its 'id', 'path' and 'language'.
+    """
+    if os.path.isdir(input_path):
+        paths = []
+        for directory, _, file_names in os.walk(input_path):
+            paths.extend(os.path.join(directory, file_name) for file_name in file_names
+                         if file_name.lower().endswith(AUDIO_EXTENSIONS))
+        return [{"id": os.path.relpath(path, input_path), "path": path, "language": None} for path in sorted(paths)]
+
+    items = []
+    with open(input_path) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            path = os.path.join(os.path.dirname(os.path.abspath(input_path)), entry['path'])
+            items.append({"id": str(entry.get('id', entry['path'])), "path": path, "language": entry.get('language')})
+    return items
+
+
+def completed_ids(output_path):
+    """
+    Reads the ids already transcribed by an earlier run from its output.
+
+    A line cut short by an interruption is removed from the file, so that the
+    results of this run start on a line of their own. Files that failed are
+    transcribed again.
+
+    Returns:
+        set: The ids of the files with a result.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, 'rb+') as output:
+        data = output.read()
+        complete_length = data.rfind(b"\n") + 1
+        if complete_length < len(data):
+            output.truncate(complete_length)
+
+    done = set()
+    for line in data[:complete_length].splitlines():
+        result = json.loads(line)
+        if 'error' not in result:
+            done.add(result['id'])
+    return done
+
+
+def speech_windows(vad_segments, audio_seconds, max_window_seconds=30.0, padding_seconds=0.2, max_gap_seconds=1.0):
+    """
+    Groups the speech segments of a file into windows for the ASR.
+
+    Segments closer than `max_gap_seconds` share a window as long as it stays under
+    `max_window_seconds`, Whisper's input length. Longer speech is cut into equal
+    parts.
+
+    Args:
+        vad_segments (list): The speech segments, with their 'start' and 'end' in seconds.
+        audio_seconds (float): The duration of the file.
+
+    Returns:
+        List[Tuple[float, float]]: The start and end of each window, in seconds.
+    """
+    windows = []
+    for segment in vad_segments:
+        start = max(0.0, segment['start'] - padding_seconds)
+        end = min(audio_seconds, segment['end'] + padding_seconds)
+        if windows:
+            start = max(start, windows[-1][1])
+            if start - windows[-1][1] <= max_gap_seconds and end - windows[-1][0] <= max_window_seconds:
+                windows[-1][1] = end
+                continue
+        if end > start:
+            windows.append([start, end])
+
+    split_windows = []
+    for start, end in windows:
+        parts = math.ceil((end - start) / max_window_seconds)
+        length = (end - start) / parts
+        split_windows.extend((start + part * length, start + (part + 1) * length) for part in range(parts))
+    return split_windows
+
+
+def init_worker(vad_type, vad_args, asr_type, asr_args, window_args):
+    """
+    Loads the models of a worker process or thread.
+    """
+    worker_state.vad = VADFactory.create_vad_pipeline(vad_type, **vad_args)
+    worker_state.asr = ASRFactory.create_asr_pipeline(asr_type, **asr_args)
+    worker_state.window_args = window_args
+    # Deployment methods such as serve.batch are bound to the first loop they run on
+    worker_state.loop = asyncio.new_event_loop()
+    worker_state.files = 0
+
+
+async def transcribe_audio(vad, asr, audio, item, client_id, window_args, sampling_rate=16000, samples_width=2):
+    """
+    Transcribes the PCM audio of a file, one speech window at a time.
+
+    Returns:
+        dict: The text of the file, its language and its segments with their stream-absolute words.
+    """
+    bytes_per_second = sampling_rate * samples_width
+    client = Client(client_id, sampling_rate, samples_width)
+    client.config['language'] = item['language']
+    client.scratch_buffer = bytearray(audio)
+    vad_segments = await vad.detect_activity(client)
+
+    segments = []
+    language = None
+    for start, end in speech_windows(vad_segments, len(audio) / bytes_per_second, **window_args):
+        window = client.snapshot(audio[int(start * sampling_rate) * samples_width:int(end * sampling_rate) * samples_width])
+        transcription = await asr.transcribe(window)
+        client.increment_file_counter()
+        language = language or transcription['language']
+        words = transcription['words']
+        if isinstance(words, list):
+            words = [dict(word, start=word['start'] + start, end=word['end'] + start) for word in words]
+        if transcription['text']:
+            segments.append({"start": start, "end": end, "text": transcription['text'], "words": words})
+    return {
+        "text": ' '.join(segment['text'] for segment in segments),
+        "language": language,
+        "segments": segments,
+    }
+
+
+def transcribe_file(item):
+    """
+    Transcribes one file with the models of the worker.
+
+    Returns:
+        dict: The result line of the file, with an 'error' if it failed.
+    """
+    start = time.monotonic()
+    result = {"id": item['id'], "path": item['path']}
+    try:
+        audio = load_audio_file(item['path'])
+        result['audio_seconds'] = len(audio) / (16000 * 2)
+        worker_state.files += 1
+        client_id = f"batch-{os.getpid()}-{threading.get_ident()}-{worker_state.files}"
+        result.update(worker_state.loop.run_until_complete(
+            transcribe_audio(worker_state.vad, worker_state.asr, audio, item, client_id, worker_state.window_args)))
+    except Exception as e:
+        result['error'] = repr(e)
+    result['processing_seconds'] = time.monotonic() - start
+    return result
+
+
+def run_batch(args):
+    """
+    Transcribes a directory or manifest of audio files into a JSON lines output,
+    skipping the files an earlier run already transcribed.
+
+    Returns:
+        dict: The throughput statistics of the run.
+    """
+    vad_args = json.loads(args.vad_args)
+    asr_args = json.loads(args.asr_args)
+    # Files are transcribed one window at a time, there are no concurrent requests to batch
+    vad_args.setdefault('batching_enabled', False)
+    # Nightly reprocessing wants the most accurate decoding, not the load-adaptive one
+    asr_args.setdefault('decoding_profiles', ["accurate"])
+    window_args = {"max_window_seconds": args.max_window_seconds, "padding_seconds": args.padding_seconds,
+                   "max_gap_seconds": args.max_gap_seconds}
+
+    items = discover_inputs(args.input)
+    done = completed_ids(args.output)
+    pending = [item for item in items if item['id'] not in done]
+    print(f"{len(items)} files, {len(items) - len(pending)} already transcribed, {len(pending)} to go")
+
+    initargs = (args.vad_type, vad_args, args.asr_type, asr_args, window_args)
+    if args.pool == "process":
+        # CUDA cannot be initialized again in a forked process
+        executor = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_worker, initargs=initargs)
+    else:
+        executor = ThreadPoolExecutor(args.workers, initializer=init_worker, initargs=initargs)
+
+    start = time.monotonic()
+    audio_seconds = 0.0
+    failed = 0
+    with executor, open(args.output, 'a') as output:
+        futures = [executor.submit(transcribe_file, item) for item in pending]
+        try:
+            for completed, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                # One line at a time, synced, so that an interrupted run loses at most the files in flight
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                os.fsync(output.fileno())
+                if 'error' in result:
+                    failed += 1
+                    logger.error(f"[{completed}/{len(pending)}] {result['path']} failed: {result['error']}")
+                else:
+                    audio_seconds += result['audio_seconds']
+                    logger.info(f"[{completed}/{len(pending)}] {result['path']}: {result['audio_seconds']:.1f}s "
+                                f"of audio in {result['processing_seconds']:.1f}s")
+        except KeyboardInterrupt:
+            print("Interrupted, run again with the same output to resume", file=sys.stderr)
+            for future in futures:
+                future.cancel()
+            raise
+
+    wall_seconds = time.monotonic() - start
+    stats = {
+        "files": len(pending) - failed,
+        "failed": failed,
+        "skipped": len(items) - len(pending),
+        "audio_hours": audio_seconds / 3600,
+        "wall_hours": wall_seconds / 3600,
+        "audio_hours_per_hour": audio_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+    print(f"Transcribed {stats['files']} files ({failed} failed, {stats['skipped']} skipped): "
+          f"{stats['audio_hours']:.2f} audio hours in {stats['wall_hours']:.2f} hours, "
+          f"{stats['audio_hours_per_hour']:.1f} audio-hours per hour with {args.workers} {args.pool} workers")
+    return stats
+
+
+def add_batch_arguments(parser):
+    parser.add_argument("input", type=str, help="Directory of audio files, or JSON lines manifest with a 'path' per file")
+    parser.add_argument("--output", type=str, required=True, help="JSON lines file the results are appended to; an existing one is resumed")
+    parser.add_argument("--workers", type=int, default=1, help="Number of workers, each with its own VAD and ASR models")
+    parser.add_argument("--pool", type=str, default="process", choices=["process", "thread"], help="Run the workers as processes or threads")
+    parser.add_argument("--max-window-seconds", type=float, default=30.0, help="Maximum audio transcribed at once")
+    parser.add_argument("--padding-seconds", type=float, default=0.2, help="Audio kept around each speech segment")
+    parser.add_argument("--max-gap-seconds", type=float, default=1.0, help="Maximum silence between segments transcribed together")
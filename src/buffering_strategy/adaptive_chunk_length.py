@@ -0,0 +1,62 @@
+class AdaptiveChunkLength:
+    """
+    Tunes the chunk length of a client to the latency the VAD and ASR deployments
+    currently deliver.
+
+    Each chunk costs a fixed overhead (queueing, transport, VAD, model warm-up of
+    the decoder) plus a time proportional to its audio. When the round trip of a
+    chunk takes a large share of its audio duration, the stream is close to falling
+    behind real time and longer chunks amortize the overhead better; when it takes
+    a small share, shorter chunks give lower latency. The chunk length is scaled by
+    the ratio of the observed real-time factor to the target, at most by
+    `max_step` per chunk, within the bounds. Audio that piled up in the client
+    buffer while the chunk was processed counts as pressure too.
+
+    Attributes:
+        chunk_length_seconds (float): The current chunk length.
+        min_chunk_length_seconds (float): The shortest chunk length used.
+        max_chunk_length_seconds (float): The longest chunk length used.
+        target_real_time_factor (float): The round trip time per audio second aimed at.
+        max_step (float): Maximum factor by which the chunk length changes per chunk.
+        real_time_factor (float): Moving average of the round trip time per audio second, None before the first chunk.
+    """
+
+    def __init__(self, chunk_length_seconds, min_chunk_length_seconds=1.0, max_chunk_length_seconds=10.0,
+                 target_real_time_factor=0.5, max_step=1.25, smoothing=0.3):
+        if not 0 < min_chunk_length_seconds <= max_chunk_length_seconds:
+            raise ValueError(f"Invalid chunk length bounds: {min_chunk_length_seconds}, {max_chunk_length_seconds}")
+        self.min_chunk_length_seconds = min_chunk_length_seconds
+        self.max_chunk_length_seconds = max_chunk_length_seconds
+        self.chunk_length_seconds = self.clamp(chunk_length_seconds)
+        self.target_real_time_factor = target_real_time_factor
+        self.max_step = max_step
+        self.smoothing = smoothing
+        self.real_time_factor = None
+
+    def clamp(self, chunk_length_seconds):
+        return min(max(chunk_length_seconds, self.min_chunk_length_seconds), self.max_chunk_length_seconds)
+
+    def observe(self, round_trip_seconds, audio_seconds, backlog_seconds=0.0):
+        """
+        Adjusts the chunk length after a chunk went through VAD and ASR.
+
+        Args:
+            round_trip_seconds (float): Time from the VAD request to the transcription.
+            audio_seconds (float): Duration of the transcribed audio.
+            backlog_seconds (float): Audio of the client waiting to be processed when the transcription came back.
+
+        Returns:
+            float: The new chunk length.
+        """
+        if audio_seconds <= 0:
+            return self.chunk_length_seconds
+        real_time_factor = round_trip_seconds / audio_seconds
+        if self.real_time_factor is None:
+            self.real_time_factor = real_time_factor
+        else:
+            self.real_time_factor += self.smoothing * (real_time_factor - self.real_time_factor)
+
+        pressure = max(self.real_time_factor, backlog_seconds / self.chunk_length_seconds) / self.target_real_time_factor
+        step = min(max(pressure, 1 / self.max_step), self.max_step)
+        self.chunk_length_seconds = self.clamp(self.chunk_length_seconds * step)
+        return self.chunk_length_seconds
@@ -1,11 +1,17 @@
 import os
+import numpy as np
 import asyncio
 import json
 import time
 from fastapi import WebSocket
 from src.audio_utils import save_audio_to_file
+from src.vad.energy_vad import EnergyVAD
+from src.tracing import get_tracer
 
 from .buffering_strategy_interface import BufferingStrategyInterface
+from .reorder_buffer import ReorderBuffer
+from .adaptive_chunk_length import AdaptiveChunkLength
+from ray.serve import metrics
 from ray.serve.handle import DeploymentHandle
 
 import logging
@@ -13,6 +19,141 @@ logger = logging.getLogger("ray.serve")
 logger.setLevel(logging.DEBUG)
 
 
+async def send_transcription(websocket : WebSocket, client, transcription, utterance):
+    """
+    Send a transcription to the client, tagged with the trace id of the utterance.
+
+    Transcriptions must be sent in utterance order, as they are committed to the
+    client context on the way, see Client.commit_transcription().
+
+    Args:
+        websocket (Websocket): The WebSocket connection for sending transcriptions.
+        client (Client): The client.
+        transcription (dict): The transcription returned by the ASR deployment.
+        utterance (Client): The client, or the snapshot of it, that holds the trace of the utterance.
+    """
+    if not client.commit_transcription(transcription, utterance):
+        return
+    if utterance.trace_context is not None:
+        transcription['trace_id'] = utterance.trace_context['trace_id']
+    # Where the utterance is in the audio stream, which a client acknowledges
+    # its audio against
+    transcription['stream_start_seconds'] = utterance.stream_position_seconds(utterance.scratch_offset_bytes)
+    transcription['stream_end_seconds'] = utterance.stream_position_seconds(
+        utterance.scratch_offset_bytes + len(utterance.scratch_buffer))
+    if client.journal is not None:
+        client.journal.record_event(client.client_id, "transcript", transcription)
+    with get_tracer().span("send", utterance.trace_context, client_id=utterance.client_id):
+        await websocket.send_text(json.dumps(transcription))
+
+
+async def send_segment(websocket : WebSocket, client, segment, utterance):
+    """
+    Send a segment of a transcription that is still being decoded, as soon as the
+    ASR replica decoded it.
+
+    Segments have the type 'segment' and stream-absolute timestamps. They preview
+    the transcription of their utterance, which is sent as usual once it is
+    complete and replaces them; with several utterances in flight, segments of a
+    later utterance may come before the transcription of an earlier one.
+
+    Args:
+        websocket (Websocket): The WebSocket connection for sending transcriptions.
+        client (Client): The client.
+        segment (dict): The segment streamed by the ASR deployment.
+        utterance (Client): The client, or the snapshot of it, that holds the utterance audio.
+    """
+    if not client.preview_segment(segment, utterance):
+        return
+    if utterance.trace_context is not None:
+        segment['trace_id'] = utterance.trace_context['trace_id']
+    segment['stream_start_seconds'] = utterance.stream_position_seconds(utterance.scratch_offset_bytes)
+    await websocket.send_text(json.dumps(segment))
+
+
+def context_args(kwargs):
+    """
+    Reads the context carry-over settings of a buffering strategy, overridden by
+    BUFFERING_CONTEXT_OVERLAP_SECONDS and BUFFERING_CONTEXT_PROMPT_MAX_CHARS.
+
+    Returns:
+        Tuple[float, int]: The context overlap in seconds and the maximum prompt length.
+    """
+    context_overlap_seconds = os.environ.get('BUFFERING_CONTEXT_OVERLAP_SECONDS')
+    if not context_overlap_seconds:
+        context_overlap_seconds = kwargs.get('context_overlap_seconds', 0.0)
+
+    context_prompt_max_chars = os.environ.get('BUFFERING_CONTEXT_PROMPT_MAX_CHARS')
+    if not context_prompt_max_chars:
+        context_prompt_max_chars = kwargs.get('context_prompt_max_chars', 0)
+    return float(context_overlap_seconds), int(context_prompt_max_chars)
+
+
+def adaptive_chunk_length_args(kwargs, chunk_length_seconds):
+    """
+    Reads the adaptive chunk length settings of a buffering strategy, overridden by
+    BUFFERING_ADAPTIVE_CHUNK_LENGTH, BUFFERING_MIN_CHUNK_LENGTH_SECONDS,
+    BUFFERING_MAX_CHUNK_LENGTH_SECONDS and BUFFERING_TARGET_REAL_TIME_FACTOR.
+
+    Args:
+        kwargs (dict): The arguments of the buffering strategy.
+        chunk_length_seconds (float): The configured chunk length, the initial one in adaptive mode.
+
+    Returns:
+        AdaptiveChunkLength: The controller of the chunk length, None unless adaptive mode is on.
+    """
+    adaptive = os.environ.get('BUFFERING_ADAPTIVE_CHUNK_LENGTH')
+    if not adaptive:
+        adaptive = kwargs.get('adaptive_chunk_length', False)
+    if str(adaptive).lower() != 'true':
+        return None
+
+    min_chunk_length_seconds = os.environ.get('BUFFERING_MIN_CHUNK_LENGTH_SECONDS')
+    if not min_chunk_length_seconds:
+        min_chunk_length_seconds = kwargs.get('min_chunk_length_seconds', 1.0)
+
+    max_chunk_length_seconds = os.environ.get('BUFFERING_MAX_CHUNK_LENGTH_SECONDS')
+    if not max_chunk_length_seconds:
+        max_chunk_length_seconds = kwargs.get('max_chunk_length_seconds', 10.0)
+
+    target_real_time_factor = os.environ.get('BUFFERING_TARGET_REAL_TIME_FACTOR')
+    if not target_real_time_factor:
+        target_real_time_factor = kwargs.get('target_real_time_factor', 0.5)
+    return AdaptiveChunkLength(chunk_length_seconds, float(min_chunk_length_seconds),
+                               float(max_chunk_length_seconds), float(target_real_time_factor))
+
+
+_chunk_length_histogram = None
+
+def observe_chunk_length(chunk_length_seconds):
+    """
+    Records the chunk length a client is using in the buffering_chunk_length_seconds metric.
+    """
+    global _chunk_length_histogram
+    if _chunk_length_histogram is None:
+        _chunk_length_histogram = metrics.Histogram(
+            "buffering_chunk_length_seconds", description="Chunk length in use when a chunk is taken off a client buffer.",
+            boundaries=[0.5, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15])
+    _chunk_length_histogram.observe(chunk_length_seconds)
+
+
+_forced_splits_counter = None
+
+def observe_forced_split(split_kind):
+    """
+    Counts an utterance split at the maximum length in the buffering_forced_splits metric.
+
+    Args:
+        split_kind (str): 'pause' when split in a pause between speech segments, 'energy' at the quietest frame.
+    """
+    global _forced_splits_counter
+    if _forced_splits_counter is None:
+        _forced_splits_counter = metrics.Counter(
+            "buffering_forced_splits", description="Utterances split because they reached the maximum utterance length.",
+            tag_keys=("split",))
+    _forced_splits_counter.inc(tags={"split": split_kind})
+
+
 class SilenceAtEndOfChunk(BufferingStrategyInterface):
     """
     A buffering strategy that processes audio at the end of each chunk with silence detection.
@@ -24,6 +165,13 @@ class SilenceAtEndOfChunk(BufferingStrategyInterface):
         client (Client): The client instance associated with this buffering strategy.
         chunk_length_seconds (float): Length of each audio chunk in seconds.
         chunk_offset_seconds (float): Offset time in seconds to be considered for processing audio chunks.
+        context_overlap_seconds (float): Audio at the end of a transcribed chunk that is transcribed again with the next one.
+        context_prompt_max_chars (int): Maximum length of the previous text passed to the ASR as a prompt, 0 to disable.
+        adaptive_chunk_length (AdaptiveChunkLength): Tunes `chunk_length_seconds` to the observed latency, None if
+            the chunk length is fixed.
+        max_utterance_seconds (float): Length at which speech that does not pause is split, 0 to never split.
+        split_search_seconds (float): How far before the maximum length the split point is searched for.
+        split_detector (EnergyVAD): Measures the energy of the audio around the split point.
     """
 
     def __init__(self, client, **kwargs):
@@ -32,7 +180,10 @@ class SilenceAtEndOfChunk(BufferingStrategyInterface):
 
         Args:
             client (Client): The client instance associated with this buffering strategy.
-            **kwargs: Additional keyword arguments, including 'chunk_length_seconds' and 'chunk_offset_seconds'.
+            **kwargs: Additional keyword arguments, including 'chunk_length_seconds', 'chunk_offset_seconds',
+                'context_overlap_seconds', 'context_prompt_max_chars', 'adaptive_chunk_length' with its
+                'min_chunk_length_seconds', 'max_chunk_length_seconds' and 'target_real_time_factor', and
+                'max_utterance_seconds' with its 'split_search_seconds'.
         """
         self.client = client
 
@@ -49,6 +200,24 @@ class SilenceAtEndOfChunk(BufferingStrategyInterface):
         self.error_if_not_realtime = os.environ.get('ERROR_IF_NOT_REALTIME')
         if not self.error_if_not_realtime:
             self.error_if_not_realtime = kwargs.get('error_if_not_realtime', False)
+
+        self.context_overlap_seconds, self.context_prompt_max_chars = context_args(kwargs)
+        self.adaptive_chunk_length = adaptive_chunk_length_args(kwargs, self.chunk_length_seconds)
+        if self.adaptive_chunk_length is not None:
+            self.chunk_length_seconds = self.adaptive_chunk_length.chunk_length_seconds
+
+        # Whisper transcribes 30 second windows, longer audio is cut blindly
+        self.max_utterance_seconds = os.environ.get('BUFFERING_MAX_UTTERANCE_SECONDS')
+        if not self.max_utterance_seconds:
+            self.max_utterance_seconds = kwargs.get('max_utterance_seconds', 25.0)
+        self.max_utterance_seconds = float(self.max_utterance_seconds)
+
+        self.split_search_seconds = os.environ.get('BUFFERING_SPLIT_SEARCH_SECONDS')
+        if not self.split_search_seconds:
+            self.split_search_seconds = kwargs.get('split_search_seconds', 3.0)
+        self.split_search_seconds = float(self.split_search_seconds)
+        self.split_detector = EnergyVAD(frame_duration_seconds=0.02, sampling_rate=client.sampling_rate,
+                                        samples_width=client.samples_width)
         
         self.processing_flag = False
 
@@ -70,11 +239,13 @@ class SilenceAtEndOfChunk(BufferingStrategyInterface):
                  logger.warning("Tried processing a new chunk while the previous one was still being processed")
                 #  raise RuntimeError("Error in realtime processing: tried processing a new chunk while the previous one was still being processed")
             else:
+                self.client.start_trace()
+                observe_chunk_length(self.chunk_length_seconds)
                 self.client.scratch_buffer += self.client.buffer
                 self.client.buffer.clear()
                 self.processing_flag = True
                 # Schedule the processing in a separate task
-                asyncio.create_task(self.process_audio_async(websocket, vad_handle, asr_handle))
+                self.client.create_task(self.process_audio_async(websocket, vad_handle, asr_handle))
     
     async def process_audio_async(self, websocket : WebSocket, vad_handle, asr_handle : DeploymentHandle):
         """
@@ -89,25 +260,520 @@ class SilenceAtEndOfChunk(BufferingStrategyInterface):
             asr_pipeline: The automatic speech recognition pipeline.
         """   
         start = time.time()
-        vad_results = await vad_handle.detect_activity.remote(client = self.client)
+        # How the chunk ended, None while its utterance continues in the next chunk
+        outcome = "failed"
+        try:
+            try:
+                vad_results = await self.client.call_deployment('vad', vad_handle.detect_activity, self.client)
+            except Exception:
+                # Keep the audio, it is checked again together with the next chunk.
+                logger.exception(f"Voice activity detection from {self.client.client_id} failed")
+                return
 
-        if len(vad_results) == 0:
-            self.client.scratch_buffer.clear()
-            self.client.buffer.clear()
-            self.processing_flag = False
-            return
+            if len(vad_results) == 0:
+                self.client.discard_scratch_buffer()
+                # Audio received during the VAD call is dropped with the chunk
+                self.client.scratch_offset_bytes += len(self.client.buffer)
+                self.client.buffer.clear()
+                outcome = "no_speech"
+                return
 
-        last_segment_should_end_before = ((len(self.client.scratch_buffer) / (self.client.sampling_rate * self.client.samples_width)) - self.chunk_offset_seconds)
-        if vad_results[-1]['end'] < last_segment_should_end_before:
+            last_segment_should_end_before = ((len(self.client.scratch_buffer) / (self.client.sampling_rate * self.client.samples_width)) - self.chunk_offset_seconds)
+            split_bytes = None
+            if vad_results[-1]['end'] >= last_segment_should_end_before:
+                # The speaker has not paused yet, wait for the next chunk unless the utterance is too long
+                split = self.forced_split_point(vad_results)
+                if split is None:
+                    outcome = None
+                    return
+                split_bytes, split_kind = split
+                observe_forced_split(split_kind)
+            # The whole scratch buffer, or its head when the utterance is split
+            utterance = self.client if split_bytes is None else self.client.snapshot(self.client.scratch_buffer[:split_bytes])
 
-            transcription = await asr_handle.transcribe.remote(client = self.client)
+            utterance.prompt = self.client.context_prompt(self.context_prompt_max_chars)
+            try:
+                transcription = await self.client.call_deployment('asr', asr_handle.transcribe, utterance)
+            except asyncio.TimeoutError as e:
+                # Falling further behind real time is worse than losing the chunk.
+                logger.warning(f"Dropping chunk from {self.client.client_id}: {e}")
+                self.client.discard_scratch_buffer(split_bytes)
+                outcome = "deadline_exceeded"
+                return
+            except Exception:
+                # Retrying could block the stream on a chunk that never succeeds
+                logger.exception(f"Transcription from {self.client.client_id} failed, dropping the chunk")
+                self.client.discard_scratch_buffer(split_bytes)
+                return
             self.client.increment_file_counter()
-            
+
+            # The tail of a split utterance is waiting too
+            self.observe_round_trip(time.time() - start, len(utterance.scratch_buffer),
+                                    len(self.client.scratch_buffer) - len(utterance.scratch_buffer) + len(self.client.buffer))
+            if split_bytes is not None:
+                transcription['endpoint'] = "max_utterance_length"
             if transcription['text'] != '':
                 end = time.time()
                 transcription['processing_time'] = end - start
-                json_transcription = json.dumps(transcription) 
-                await websocket.send_text(json_transcription)
-            self.client.scratch_buffer.clear()
-        
-        self.processing_flag = False
\ No newline at end of file
+                await send_transcription(websocket, self.client, transcription, utterance)
+            if split_bytes is None:
+                self.discard_transcribed_audio(vad_results)
+            else:
+                self.client.discard_scratch_buffer(split_bytes)
+            outcome = "transcribed"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            if outcome is not None:
+                self.client.end_trace(outcome)
+            self.processing_flag = False
+
+    def observe_round_trip(self, round_trip_seconds, audio_bytes, backlog_bytes):
+        """
+        Adjusts the chunk length in adaptive mode after a chunk went through VAD and ASR.
+
+        Args:
+            round_trip_seconds (float): Time from the VAD request to the transcription.
+            audio_bytes (int): Size of the transcribed audio.
+            backlog_bytes (int): Audio of the client waiting to be processed.
+        """
+        if self.adaptive_chunk_length is None:
+            return
+        self.chunk_length_seconds = self.adaptive_chunk_length.observe(
+            round_trip_seconds, self.client.stream_position_seconds(audio_bytes),
+            self.client.stream_position_seconds(backlog_bytes))
+
+    def forced_split_point(self, vad_results):
+        """
+        Picks where to split the scratch buffer once speech without a pause reaches
+        `max_utterance_seconds`.
+
+        The split point is searched for in the last `split_search_seconds` before the
+        maximum length: in the middle of the longest pause between speech segments
+        there, or else at the quietest 20 ms frame, where a word is least likely to
+        be cut.
+
+        Args:
+            vad_results (list): The speech segments of the scratch buffer.
+
+        Returns:
+            Tuple[int, str]: The length of the head in bytes and 'pause' or 'energy', None if the
+                scratch buffer is shorter than the maximum length.
+        """
+        bytes_per_second = self.client.sampling_rate * self.client.samples_width
+        if self.max_utterance_seconds <= 0 or len(self.client.scratch_buffer) < self.max_utterance_seconds * bytes_per_second:
+            return None
+        search_end = self.max_utterance_seconds
+        search_start = max(search_end - self.split_search_seconds, 0.0)
+
+        pauses = [(min(following['start'], search_end) - max(preceding['end'], search_start),
+                   (max(preceding['end'], search_start) + min(following['start'], search_end)) / 2)
+                  for preceding, following in zip(vad_results, vad_results[1:])]
+        pauses = [pause for pause in pauses if pause[0] > 0]
+        if pauses:
+            split_seconds = max(pauses)[1]
+            split_kind = "pause"
+        else:
+            start_bytes = int(search_start * self.client.sampling_rate) * self.client.samples_width
+            end_bytes = int(search_end * self.client.sampling_rate) * self.client.samples_width
+            energies = self.split_detector.frame_energies(self.client.scratch_buffer[start_bytes:end_bytes])
+            split_seconds = search_start + (int(np.argmin(energies)) + 0.5) * self.split_detector.frame_duration_seconds
+            split_kind = "energy"
+        split_bytes = int(split_seconds * self.client.sampling_rate) * self.client.samples_width
+        return max(split_bytes, self.client.samples_width), split_kind
+
+    def discard_transcribed_audio(self, vad_results):
+        """
+        Discard the audio of a transcribed chunk from the scratch buffer.
+
+        When speech reaches into the last `context_overlap_seconds` of the chunk, that
+        audio is kept and transcribed again at the start of the next chunk, so a
+        word cut at the chunk boundary is recognized whole. Words already sent are
+        deduplicated by their timestamps when the next transcription is sent.
+
+        Args:
+            vad_results (list): The speech segments of the chunk.
+        """
+        scratch_seconds = self.client.stream_position_seconds(len(self.client.scratch_buffer))
+        overlap_bytes = int(self.context_overlap_seconds * self.client.sampling_rate) * self.client.samples_width
+        if overlap_bytes and vad_results[-1]['end'] > scratch_seconds - self.context_overlap_seconds:
+            self.client.discard_scratch_buffer(len(self.client.scratch_buffer) - overlap_bytes)
+        else:
+            self.client.discard_scratch_buffer()
+
+    def close(self):
+        """
+        Report the audio waiting in the scratch buffer, including any chunk that is
+        currently being processed.
+        """
+        return len(self.client.scratch_buffer)
+
+
+class PipelinedSilenceAtEndOfChunk(SilenceAtEndOfChunk):
+    """
+    A pipelined variant of SilenceAtEndOfChunk with separate VAD and ASR stages.
+
+    Chunks taken off the client buffer get a sequence number and are queued for the
+    VAD stage, which decides utterance boundaries one chunk at a time exactly like
+    SilenceAtEndOfChunk. Committed utterances are handed to the ASR stage, which can
+    have several transcriptions in flight for the client, so VAD on chunk N+1
+    overlaps ASR on chunk N. A reorder buffer sends the transcriptions to the
+    WebSocket in sequence order.
+
+    Attributes:
+        max_asr_in_flight (int): Maximum number of concurrent transcriptions for the client.
+        next_sequence_number (int): The sequence number given to the next chunk.
+        vad_queue (asyncio.Queue): Chunks waiting for the VAD stage.
+        asr_slots (asyncio.Semaphore): Limits the transcriptions in flight.
+        reorder_buffer (ReorderBuffer): Sends the results in sequence order.
+        vad_task (asyncio.Task): The VAD stage of the client, started with the first chunk.
+        in_flight_bytes (int): Audio bytes of the utterances in the ASR stage.
+    """
+
+    def __init__(self, client, **kwargs):
+        """
+        Initialize the PipelinedSilenceAtEndOfChunk buffering strategy.
+
+        Args:
+            client (Client): The client instance associated with this buffering strategy.
+            **kwargs: Additional keyword arguments, see SilenceAtEndOfChunk, plus 'max_asr_in_flight'.
+        """
+        super().__init__(client, **kwargs)
+
+        self.max_asr_in_flight = os.environ.get('BUFFERING_MAX_ASR_IN_FLIGHT')
+        if not self.max_asr_in_flight:
+            self.max_asr_in_flight = kwargs.get('max_asr_in_flight', 2)
+        self.max_asr_in_flight = int(self.max_asr_in_flight)
+
+        self.next_sequence_number = 0
+        self.vad_queue = asyncio.Queue()
+        self.asr_slots = asyncio.Semaphore(self.max_asr_in_flight)
+        self.reorder_buffer = None
+        self.vad_task = None
+        self.in_flight_bytes = 0
+
+    def process_audio(self, websocket : WebSocket, vad_handle, asr_handle):
+        """
+        Queue the client buffer for the VAD stage once it exceeds the chunk length.
+
+        Args:
+            websocket (Websocket): The WebSocket connection for sending transcriptions.
+            vad_handle: The voice activity detection deployment handle.
+            asr_handle: The automatic speech recognition deployment handle.
+        """
+        chunk_length_in_bytes = self.chunk_length_seconds * self.client.sampling_rate * self.client.samples_width
+        if len(self.client.buffer) > chunk_length_in_bytes:
+            observe_chunk_length(self.chunk_length_seconds)
+            chunk = bytes(self.client.buffer)
+            self.client.buffer.clear()
+            self.vad_queue.put_nowait((self.next_sequence_number, chunk, self.client.buffer_started_at, time.time()))
+            self.next_sequence_number += 1
+
+            if self.vad_task is None:
+                self.reorder_buffer = ReorderBuffer(lambda result: send_transcription(websocket, self.client, *result))
+                self.vad_task = self.client.create_task(self.run_vad_stage(vad_handle, asr_handle))
+
+    async def run_vad_stage(self, vad_handle, asr_handle : DeploymentHandle):
+        """
+        Run voice activity detection on the queued chunks of the client, in order.
+
+        Chunks that queued up while the previous VAD call was running are merged
+        into one, so a slow VAD deployment does not make the stream fall further
+        behind real time. Chunks that do not close an utterance are resolved in the
+        reorder buffer straight away.
+
+        Args:
+            vad_handle: The voice activity detection deployment handle.
+            asr_handle: The automatic speech recognition deployment handle.
+        """
+        while True:
+            sequence_number, chunk, buffer_started_at, queued_at = await self.vad_queue.get()
+            self.client.start_trace(buffer_started_at, queued_at)
+            get_tracer().record("vad.queue", self.client.trace_context, queued_at, time.time(),
+                                client_id=self.client.client_id, sequence_number=sequence_number)
+            self.client.scratch_buffer += chunk
+            while not self.vad_queue.empty():
+                logger.warning("VAD stage fell behind, merging queued chunks")
+                await self.reorder_buffer.put(sequence_number, None)
+                sequence_number, chunk, _, _ = self.vad_queue.get_nowait()
+                self.client.scratch_buffer += chunk
+
+            start = time.time()
+            try:
+                vad_results = await self.client.call_deployment(
+                    'vad', vad_handle.detect_activity, self.client.snapshot(self.client.scratch_buffer))
+            except Exception:
+                # Keep the audio, it is checked again together with the next chunk.
+                logger.exception(f"Voice activity detection of chunk {sequence_number} from {self.client.client_id} failed")
+                await self.reorder_buffer.put(sequence_number, None)
+                continue
+
+            if len(vad_results) == 0:
+                self.client.discard_scratch_buffer()
+                self.client.end_trace("no_speech")
+                await self.reorder_buffer.put(sequence_number, None)
+                continue
+
+            last_segment_should_end_before = ((len(self.client.scratch_buffer) / (self.client.sampling_rate * self.client.samples_width)) - self.chunk_offset_seconds)
+            split_bytes = None
+            endpoint = None
+            if vad_results[-1]['end'] >= last_segment_should_end_before:
+                split = self.forced_split_point(vad_results)
+                if split is None:
+                    await self.reorder_buffer.put(sequence_number, None)
+                    continue
+                split_bytes, split_kind = split
+                observe_forced_split(split_kind)
+                endpoint = "max_utterance_length"
+
+            utterance = self.client.snapshot(self.client.scratch_buffer[:split_bytes])
+            utterance.prompt = self.client.context_prompt(self.context_prompt_max_chars)
+            self.client.attach_log_mel(utterance)
+            self.client.increment_file_counter()
+            if split_bytes is None:
+                self.discard_transcribed_audio(vad_results)
+            else:
+                # The tail is transcribed with the next chunks
+                self.client.discard_scratch_buffer(split_bytes)
+            # The trace now belongs to the utterance, the next chunk starts a new one
+            self.client.trace_context = None
+
+            await self.asr_slots.acquire()
+            self.client.create_task(self.run_asr_stage(sequence_number, utterance, start, asr_handle, endpoint))
+
+    async def run_asr_stage(self, sequence_number, utterance, start, asr_handle : DeploymentHandle, endpoint=None):
+        """
+        Transcribe a committed utterance and hand the result to the reorder buffer.
+
+        Args:
+            sequence_number (int): The sequence number of the chunk that closed the utterance.
+            utterance (Client): Snapshot of the client holding the utterance audio.
+            start (float): Time at which the VAD call for the chunk started.
+            asr_handle: The automatic speech recognition deployment handle.
+            endpoint (str): 'max_utterance_length' when the utterance was split without a pause.
+        """
+        result = None
+        outcome = "failed"
+        self.in_flight_bytes += len(utterance.scratch_buffer)
+        try:
+            transcription = await self.client.call_deployment('asr', asr_handle.transcribe, utterance)
+            outcome = "transcribed"
+            # Utterances still waiting for the ASR stage, and audio not yet chunked, are the backlog
+            self.observe_round_trip(time.time() - start, len(utterance.scratch_buffer),
+                                    self.in_flight_bytes - len(utterance.scratch_buffer) + len(self.client.buffer))
+            if transcription['text'] != '':
+                transcription['processing_time'] = time.time() - start
+                transcription['sequence_number'] = sequence_number
+                if endpoint is not None:
+                    transcription['endpoint'] = endpoint
+                result = (transcription, utterance)
+        except Exception:
+            # The sequence number still has to be resolved, or every later
+            # transcription of the client would wait for it forever.
+            logger.exception(f"Transcription of chunk {sequence_number} from {self.client.client_id} failed")
+        finally:
+            self.in_flight_bytes -= len(utterance.scratch_buffer)
+            self.asr_slots.release()
+        await self.reorder_buffer.put(sequence_number, result)
+        utterance.end_trace(outcome)
+
+    def close(self):
+        """
+        Stop the VAD stage of the client and drop the chunks queued for it.
+        """
+        if self.vad_task is not None:
+            self.vad_task.cancel()
+
+        dropped_bytes = len(self.client.scratch_buffer) + self.in_flight_bytes
+        while not self.vad_queue.empty():
+            _, chunk, _, _ = self.vad_queue.get_nowait()
+            dropped_bytes += len(chunk)
+        return dropped_bytes
+
+
+class Endpointing(BufferingStrategyInterface):
+    """
+    An event-driven buffering strategy that finalizes utterances as soon as the
+    speaker stops.
+
+    Instead of waiting for a fixed chunk length, every incoming frame is classified
+    as speech or silence by a cheap frame-level detector running inline. An
+    utterance starts at the first speech frame and is sent for transcription as
+    soon as `end_silence_seconds` of trailing silence are seen, or when it reaches
+    `max_utterance_seconds`. Utterances shorter than `min_utterance_seconds` are
+    discarded as noise. Several transcriptions can be in flight; a reorder buffer
+    sends them to the WebSocket in utterance order.
+
+    Attributes:
+        client (Client): The client instance associated with this buffering strategy.
+        end_silence_seconds (float): Trailing silence that ends an utterance.
+        min_utterance_seconds (float): Minimum speech duration of an utterance.
+        max_utterance_seconds (float): Duration after which an utterance is finalized anyway.
+        pre_speech_seconds (float): Audio kept before the first speech frame of an utterance.
+        context_overlap_seconds (float): Audio at the end of an utterance split at the maximum length that starts the next one.
+        context_prompt_max_chars (int): Maximum length of the previous text passed to the ASR as a prompt, 0 to disable.
+        detector (EnergyVAD): The frame-level speech detector.
+        in_utterance (bool): Whether an utterance is currently open.
+        speech_seconds (float): Speech duration of the open utterance.
+        trailing_silence_seconds (float): Silence since the last speech frame of the open utterance.
+        next_sequence_number (int): The sequence number given to the next utterance.
+        reorder_buffer (ReorderBuffer): Sends the results in utterance order.
+        in_flight_bytes (int): Audio bytes of the utterances being transcribed.
+    """
+
+    def __init__(self, client, **kwargs):
+        """
+        Initialize the Endpointing buffering strategy.
+
+        Args:
+            client (Client): The client instance associated with this buffering strategy.
+            **kwargs: Additional keyword arguments, including 'end_silence_seconds', 'min_utterance_seconds',
+                'max_utterance_seconds', 'pre_speech_seconds', 'detector_args' for the EnergyVAD,
+                'context_overlap_seconds' and 'context_prompt_max_chars', see SilenceAtEndOfChunk.
+        """
+        self.client = client
+
+        self.end_silence_seconds = os.environ.get('ENDPOINTING_END_SILENCE_SECONDS')
+        if not self.end_silence_seconds:
+            self.end_silence_seconds = kwargs.get('end_silence_seconds', 0.5)
+        self.end_silence_seconds = float(self.end_silence_seconds)
+
+        self.min_utterance_seconds = os.environ.get('ENDPOINTING_MIN_UTTERANCE_SECONDS')
+        if not self.min_utterance_seconds:
+            self.min_utterance_seconds = kwargs.get('min_utterance_seconds', 0.3)
+        self.min_utterance_seconds = float(self.min_utterance_seconds)
+
+        self.max_utterance_seconds = os.environ.get('ENDPOINTING_MAX_UTTERANCE_SECONDS')
+        if not self.max_utterance_seconds:
+            self.max_utterance_seconds = kwargs.get('max_utterance_seconds', 15)
+        self.max_utterance_seconds = float(self.max_utterance_seconds)
+
+        self.pre_speech_seconds = float(kwargs.get('pre_speech_seconds', 0.2))
+        self.context_overlap_seconds, self.context_prompt_max_chars = context_args(kwargs)
+
+        self.detector = EnergyVAD(sampling_rate=client.sampling_rate, samples_width=client.samples_width,
+                                  **kwargs.get('detector_args', {}))
+        self.in_utterance = False
+        self.speech_seconds = 0.0
+        self.trailing_silence_seconds = 0.0
+
+        self.next_sequence_number = 0
+        self.reorder_buffer = None
+        self.in_flight_bytes = 0
+
+    def process_audio(self, websocket : WebSocket, vad_handle, asr_handle):
+        """
+        Classify the complete frames of the client buffer and finalize the utterance
+        when an endpoint is detected. The VAD deployment is not used.
+
+        Args:
+            websocket (Websocket): The WebSocket connection for sending transcriptions.
+            vad_handle: The voice activity detection deployment handle, unused.
+            asr_handle: The automatic speech recognition deployment handle.
+        """
+        if self.reorder_buffer is None:
+            self.reorder_buffer = ReorderBuffer(lambda result: send_transcription(websocket, self.client, *result))
+
+        frame_length = self.detector.frame_length_bytes
+        frame_seconds = self.detector.frame_duration_seconds
+        pre_speech_bytes = int(self.pre_speech_seconds / frame_seconds) * frame_length
+
+        frame_count = len(self.client.buffer) // frame_length
+        if frame_count == 0:
+            return
+        audio_data = bytes(self.client.buffer[:frame_count * frame_length])
+        del self.client.buffer[:frame_count * frame_length]
+
+        for index, speech in enumerate(self.detector.classify(audio_data)):
+            frame = audio_data[index * frame_length:(index + 1) * frame_length]
+            self.client.scratch_buffer += frame
+
+            if not self.in_utterance:
+                if speech:
+                    self.client.start_trace()
+                    self.in_utterance = True
+                    self.speech_seconds = frame_seconds
+                    self.trailing_silence_seconds = 0.0
+                else:
+                    # Keep a little audio before the speech onset, the detector
+                    # tends to miss the first soft phonemes.
+                    self.client.discard_scratch_buffer(len(self.client.scratch_buffer) - pre_speech_bytes)
+                continue
+
+            if speech:
+                self.speech_seconds += frame_seconds
+                self.trailing_silence_seconds = 0.0
+            else:
+                self.trailing_silence_seconds += frame_seconds
+
+            utterance_seconds = len(self.client.scratch_buffer) / (self.client.sampling_rate * self.client.samples_width)
+            if self.trailing_silence_seconds >= self.end_silence_seconds:
+                if self.speech_seconds >= self.min_utterance_seconds:
+                    self.finalize_utterance("end_of_speech", asr_handle)
+                else:
+                    self.client.discard_scratch_buffer()
+                    self.client.end_trace("too_short")
+                self.in_utterance = False
+            elif utterance_seconds >= self.max_utterance_seconds:
+                self.finalize_utterance("max_utterance_length", asr_handle)
+                self.in_utterance = False
+
+    def finalize_utterance(self, reason, asr_handle):
+        """
+        Take the open utterance off the scratch buffer and schedule its transcription.
+
+        Args:
+            reason (str): Why the utterance was finalized, reported with the transcription.
+            asr_handle: The automatic speech recognition deployment handle.
+        """
+        utterance = self.client.snapshot(self.client.scratch_buffer)
+        utterance.prompt = self.client.context_prompt(self.context_prompt_max_chars)
+        self.client.attach_log_mel(utterance)
+        self.client.increment_file_counter()
+        overlap_bytes = int(self.context_overlap_seconds * self.client.sampling_rate) * self.client.samples_width
+        if reason == "max_utterance_length" and overlap_bytes:
+            # The speaker is still talking, the next utterance starts with the end of this one
+            self.client.discard_scratch_buffer(len(self.client.scratch_buffer) - overlap_bytes)
+        else:
+            self.client.discard_scratch_buffer()
+        self.client.trace_context = None
+
+        sequence_number = self.next_sequence_number
+        self.next_sequence_number += 1
+        self.client.create_task(self.transcribe_utterance(sequence_number, utterance, reason, asr_handle))
+
+    async def transcribe_utterance(self, sequence_number, utterance, reason, asr_handle : DeploymentHandle):
+        """
+        Transcribe a finalized utterance and hand the result to the reorder buffer.
+
+        Args:
+            sequence_number (int): The sequence number of the utterance.
+            utterance (Client): Snapshot of the client holding the utterance audio.
+            reason (str): Why the utterance was finalized.
+            asr_handle: The automatic speech recognition deployment handle.
+        """
+        start = time.time()
+        result = None
+        outcome = "failed"
+        self.in_flight_bytes += len(utterance.scratch_buffer)
+        try:
+            transcription = await self.client.call_deployment('asr', asr_handle.transcribe, utterance)
+            outcome = "transcribed"
+            if transcription['text'] != '':
+                transcription['processing_time'] = time.time() - start
+                transcription['sequence_number'] = sequence_number
+                transcription['endpoint'] = reason
+                result = (transcription, utterance)
+        except Exception:
+            logger.exception(f"Transcription of utterance {sequence_number} from {self.client.client_id} failed")
+        finally:
+            self.in_flight_bytes -= len(utterance.scratch_buffer)
+        await self.reorder_buffer.put(sequence_number, result)
+        utterance.end_trace(outcome)
+
+    def close(self):
+        """
+        Report the audio of the open utterance and of the utterances being transcribed.
+        """
+        return len(self.client.scratch_buffer) + self.in_flight_bytes
@@ -1,4 +1,4 @@
-from .buffering_strategies import SilenceAtEndOfChunk
+from .buffering_strategies import SilenceAtEndOfChunk, PipelinedSilenceAtEndOfChunk, Endpointing
 
 class BufferingStrategyFactory:
     """
@@ -22,7 +22,8 @@ class BufferingStrategyFactory:
         recognized, it raises a ValueError.
 
         Args:
-            type (str): The type of buffering strategy to create. Currently supports 'silence_at_end_of_chunk'.
+            type (str): The type of buffering strategy to create. Currently supports 'silence_at_end_of_chunk',
+                'pipelined_silence_at_end_of_chunk' and 'endpointing'.
             client (Client): The client instance to be associated with the buffering strategy.
             **kwargs: Additional keyword arguments specific to the buffering strategy being created.
 
@@ -37,5 +38,9 @@ class BufferingStrategyFactory:
         """
         if type == "silence_at_end_of_chunk":
             return SilenceAtEndOfChunk(client, **kwargs)
+        elif type == "pipelined_silence_at_end_of_chunk":
+            return PipelinedSilenceAtEndOfChunk(client, **kwargs)
+        elif type == "endpointing":
+            return Endpointing(client, **kwargs)
         else:
             raise ValueError(f"Unknown buffering strategy type: {type}")
@@ -11,6 +11,7 @@ class BufferingStrategyInterface:
 
     Methods:
         process_audio: Process audio data. This method should be implemented by subclasses.
+        close: Release any background work owned by the strategy.
     """
 
     def process_audio(self, websocket, vad_pipeline, asr_pipeline):
@@ -29,3 +30,15 @@ class BufferingStrategyInterface:
             NotImplementedError: If the method is not implemented in the subclass.
         """
         raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def close(self):
+        """
+        Release any background work owned by the strategy.
+
+        Called when the strategy is replaced after a configuration update and when
+        the client disconnects.
+
+        Returns:
+            int: Bytes of audio held by the strategy that will not be transcribed.
+        """
+        return 0
@@ -0,0 +1,55 @@
+import asyncio
+
+
+class ReorderBuffer:
+    """
+    Releases results strictly in sequence-number order.
+
+    Pipelined buffering strategies let several chunks of the same client be in
+    flight at once, so their results can complete out of order. Every chunk gets
+    a sequence number when it is taken off the client buffer; whoever resolves a
+    chunk puts its result (or None if the chunk produced nothing to send) under
+    that number, and the buffer hands the results to `deliver` in order.
+
+    Attributes:
+        deliver (Callable): Coroutine function awaited with each in-order result.
+        next_sequence_number (int): The sequence number expected to be delivered next.
+        pending (dict): Results that arrived ahead of `next_sequence_number`.
+    """
+
+    def __init__(self, deliver, first_sequence_number=0):
+        """
+        Initialize the reorder buffer.
+
+        Args:
+            deliver (Callable): Coroutine function awaited with each result, in order.
+            first_sequence_number (int): The sequence number of the first chunk.
+        """
+        self.deliver = deliver
+        self.next_sequence_number = first_sequence_number
+        self.pending = {}
+        self.lock = asyncio.Lock()
+
+    async def put(self, sequence_number, result):
+        """
+        Store the result of a chunk and deliver every result that is now in order.
+
+        Args:
+            sequence_number (int): The sequence number of the resolved chunk.
+            result: The result to deliver, or None to only advance past the chunk.
+        """
+        if sequence_number < self.next_sequence_number:
+            raise ValueError(f"Sequence number {sequence_number} was already delivered")
+        self.pending[sequence_number] = result
+
+        # Delivery is serialized so that a slow send cannot be overtaken by a
+        # result that completes while it is being awaited.
+        async with self.lock:
+            while self.next_sequence_number in self.pending:
+                result = self.pending.pop(self.next_sequence_number)
+                self.next_sequence_number += 1
+                if result is not None:
+                    await self.deliver(result)
+
+    def __len__(self):
+        return len(self.pending)
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import uuid
+import random
+import struct
+import asyncio
+
+from ray.serve import metrics
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+# A capture file starts with this line, followed by records
+CAPTURE_MAGIC = b"WHISPER-STREAMING-CAPTURE 1\n"
+# Record header: kind, session, microseconds since the capture started, size of
+# the frame received, length of the payload that follows
+RECORD_HEADER = struct.Struct("<BIQII")
+
+OPEN = 1
+CONFIG = 2
+AUDIO = 3
+CLOSE = 4
+
+
+def read_capture(path):
+    """
+    Reads the sessions of a capture file.
+
+    A file cut short, e.g. because its replica was killed, is read up to its last
+    complete record; sessions without a close end at their last record.
+
+    Args:
+        path (str): The capture file.
+
+    Returns:
+        List[dict]: The sessions in the order they were opened, each with its
+            'session' number, 'open_seconds' (since the capture started),
+            'sampling_rate', 'samples_width', 'close_seconds' and 'events': the
+            (seconds, kind, size, payload) of its config and audio records. The
+            payload of an audio record is empty when the audio was not captured.
+            Streams of a multiplexed connection also have the 'connection' number
+            and the 'stream_id' they had on it; both are None for other sessions.
+    """
+    with open(path, 'rb') as capture_file:
+        data = capture_file.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError(f"{path} is not a capture file")
+
+    sessions = {}
+    position = len(CAPTURE_MAGIC)
+    while position + RECORD_HEADER.size <= len(data):
+        kind, session, micros, size, length = RECORD_HEADER.unpack_from(data, position)
+        payload_start = position + RECORD_HEADER.size
+        if payload_start + length > len(data):
+            break
+        payload = data[payload_start:payload_start + length]
+        position = payload_start + length
+        seconds = micros / 1e6
+
+        if kind == OPEN:
+            settings = json.loads(payload)
+            sessions[session] = {"session": session, "open_seconds": seconds, "close_seconds": None,
+                                 "sampling_rate": settings['sampling_rate'],
+                                 "samples_width": settings['samples_width'],
+                                 "connection": settings.get('connection'), "stream_id": settings.get('stream_id'),
+                                 "events": []}
+        elif session in sessions:
+            if kind == CLOSE:
+                sessions[session]['close_seconds'] = seconds
+            else:
+                sessions[session]['events'].append((seconds, kind, size, payload))
+
+    for session in sessions.values():
+        if session['close_seconds'] is None:
+            session['close_seconds'] = session['events'][-1][0] if session['events'] else session['open_seconds']
+    return sorted(sessions.values(), key=lambda session: session['open_seconds'])
+
+
+class TrafficCapture:
+    """
+    Records the traffic of the sessions of a replica to a compact binary file, to
+    replay it later with its original timing, see src.replay.
+
+    Every frame received is recorded with its arrival time and size, and config
+    messages with their content. The audio itself is only kept when
+    `capture_audio` is set; otherwise a record takes 21 bytes and the replay
+    substitutes other audio. Client ids are not recorded: sessions are numbered in
+    the order they were opened. Streams of a multiplexed connection are recorded
+    with the number of their connection and their stream id, so that the replay
+    sends them over one connection too.
+
+    Records are appended to an in-memory buffer and written from a worker thread
+    once it holds `flush_bytes`, is `flush_interval_seconds` old or a session
+    ended. Records that do not fit the buffer while a write is in progress, or
+    beyond `max_bytes`, are dropped and counted in the capture_dropped_bytes metric.
+
+    Attributes:
+        path (str): The capture file.
+        capture_audio (bool): Whether the audio of the frames is recorded.
+        session_fraction (float): Fraction of the sessions captured, chosen at random when they open.
+        max_bytes (int): Maximum size of the capture file.
+        sessions (dict): The number of each captured session, by client id.
+        connections (dict): The number of each multiplexed connection with captured streams, by connection id.
+        captured_bytes (int): Bytes written or waiting to be written.
+    """
+
+    def __init__(self, path, capture_audio=False, session_fraction=1.0, max_bytes=1024 * 1024 * 1024,
+                 flush_bytes=1024 * 1024, flush_interval_seconds=5.0, max_buffer_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.capture_audio = capture_audio
+        self.session_fraction = session_fraction
+        self.max_bytes = max_bytes
+        self.flush_bytes = flush_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_buffer_bytes = max_buffer_bytes
+        self.random = random.Random()
+        self.sessions = {}
+        self.next_session = 0
+        self.connections = {}
+        self.next_connection = 0
+        self.started_at = time.monotonic()
+        self.buffer = bytearray(CAPTURE_MAGIC)
+        self.buffer_started_at = self.started_at
+        self.captured_bytes = len(self.buffer)
+        self.write_task = None
+
+        self.dropped_bytes = metrics.Counter(
+            "capture_dropped_bytes", description="Traffic capture bytes that were not retained.", tag_keys=("reason",))
+
+    @staticmethod
+    def from_environment():
+        """
+        Creates the capture configured by the environment, or returns None when
+        CAPTURE_ENABLED is not 'true'.
+
+        Configured with the environment variables:
+            CAPTURE_DIR: The directory of the capture files, one per replica.
+            CAPTURE_AUDIO: 'true' to record the audio too.
+            CAPTURE_SESSION_FRACTION: Fraction of the sessions captured.
+            CAPTURE_MAX_MB: Maximum size of the capture file of a replica.
+        """
+        if os.environ.get('CAPTURE_ENABLED', 'false').lower() != 'true':
+            return None
+        directory = os.environ.get('CAPTURE_DIR', '/var/lib/whisper-streaming/capture')
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:12]}.capture"
+        return TrafficCapture(
+            os.path.join(directory, name),
+            capture_audio=os.environ.get('CAPTURE_AUDIO', 'false').lower() == 'true',
+            session_fraction=float(os.environ.get('CAPTURE_SESSION_FRACTION', 1.0)),
+            max_bytes=int(float(os.environ.get('CAPTURE_MAX_MB', 1024)) * 1024 * 1024),
+        )
+
+    def record(self, kind, session, size, payload=b""):
+        length = RECORD_HEADER.size + len(payload)
+        if self.captured_bytes + length > self.max_bytes:
+            self.dropped_bytes.inc(length, tags={"reason": "max_bytes"})
+            return
+        if len(self.buffer) + length > self.max_buffer_bytes:
+            self.dropped_bytes.inc(length, tags={"reason": "buffer_full"})
+            return
+        micros = int((time.monotonic() - self.started_at) * 1e6)
+        self.buffer += RECORD_HEADER.pack(kind, session, micros, size, len(payload))
+        self.buffer += payload
+        self.captured_bytes += length
+        if len(self.buffer) >= self.flush_bytes or time.monotonic() - self.buffer_started_at >= self.flush_interval_seconds:
+            self.flush()
+
+    def open_session(self, client_id, sampling_rate, samples_width, connection_id=None, stream_id=None):
+        """
+        Starts capturing a session, unless it is not part of the sampled fraction.
+
+        Args:
+            client_id (str): The client id of the session.
+            sampling_rate (int): The sampling rate of its audio.
+            samples_width (int): The width of its samples in bytes.
+            connection_id (str): The id of the multiplexed connection of the stream, None for other sessions.
+            stream_id (int): The id of the stream on its multiplexed connection.
+        """
+        if self.random.random() >= self.session_fraction:
+            return
+        session = self.next_session
+        self.next_session += 1
+        self.sessions[client_id] = session
+        settings = {"sampling_rate": sampling_rate, "samples_width": samples_width}
+        if connection_id is not None:
+            if connection_id not in self.connections:
+                self.connections[connection_id] = self.next_connection
+                self.next_connection += 1
+            settings.update(connection=self.connections[connection_id], stream_id=stream_id)
+        self.record(OPEN, session, 0, json.dumps(settings).encode())
+
+    def close_connection(self, connection_id):
+        """
+        Forgets a multiplexed connection once it ended; its streams are closed with close_session().
+        """
+        self.connections.pop(connection_id, None)
+
+    def record_config(self, client_id, config):
+        """
+        Records a config message of a session.
+
+        Args:
+            client_id (str): The client id of the session.
+            config (dict): The data of the config message.
+        """
+        if client_id in self.sessions:
+            payload = json.dumps(config).encode()
+            self.record(CONFIG, self.sessions[client_id], len(payload), payload)
+
+    def record_audio(self, client_id, audio_data):
+        """
+        Records the arrival of an audio frame of a session, with its audio if enabled.
+        """
+        if client_id in self.sessions:
+            self.record(AUDIO, self.sessions[client_id], len(audio_data), bytes(audio_data) if self.capture_audio else b"")
+
+    def close_session(self, client_id):
+        """
+        Records the end of a session and writes the buffer, so that ended sessions reach the file.
+        """
+        if client_id in self.sessions:
+            self.record(CLOSE, self.sessions.pop(client_id), 0)
+            self.flush()
+
+    def write(self, data):
+        with open(self.path, 'ab') as capture_file:
+            capture_file.write(data)
+
+    def flush(self):
+        """
+        Hands the buffer to a worker thread to be written, unless a write is still in progress.
+        """
+        if not self.buffer or (self.write_task is not None and not self.write_task.done()):
+            return
+        data, self.buffer = bytes(self.buffer), bytearray()
+        self.buffer_started_at = time.monotonic()
+        self.write_task = asyncio.get_running_loop().run_in_executor(None, self.write, data)
+        self.write_task.add_done_callback(self.check_write)
+
+    def check_write(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Could not write traffic capture {self.path}: {task.exception()!r}")
+
+    async def close(self):
+        """
+        Writes everything that is still buffered.
+        """
+        if self.write_task is not None:
+            await asyncio.wait([self.write_task])
+        if self.buffer:
+            data, self.buffer = bytes(self.buffer), bytearray()
+            await asyncio.get_running_loop().run_in_executor(None, self.write, data)
@@ -1,7 +1,18 @@
 from src.buffering_strategy.buffering_strategy_factory import BufferingStrategyFactory
+from src.buffering_strategy.buffering_strategies import send_segment
+from src.tracing import get_tracer, new_trace_context
 from fastapi import WebSocket
+import asyncio
+import copy
+import functools
+import time
 import uuid
 
+import numpy as np
+
+# Committed text kept for prompting, Whisper only uses the last 224 prompt tokens anyway
+COMMITTED_TEXT_MAX_CHARS = 1000
+
 class Client:
     """
     Represents a client connected to the VoiceStreamAI server.
@@ -17,6 +28,24 @@ class Client:
         total_samples (int): Total number of audio samples received from this client.
         sampling_rate (int): The sampling rate of the audio data in Hz.
         samples_width (int): The width of each audio sample in bits.
+        tasks (set): Background tasks processing audio for this client.
+        pending_requests (dict): In-flight VAD/ASR deployment requests, mapped to their stage, audio size in bytes and start time.
+        closed (bool): Whether the client has disconnected.
+        connected_at (float): Time at which the client connected.
+        buffer_started_at (float): Time at which the first byte currently in the buffer arrived.
+        trace_context (dict): Trace context of the chunk or utterance being assembled, see src.tracing.
+        trace_started_at (float): Time at which the first audio of the traced chunk arrived.
+        scratch_offset_bytes (int): Position of the start of the scratch buffer in the audio stream.
+        committed_text (str): The end of the text sent to the client so far.
+        committed_until_seconds (float): Stream position of the end of the last word sent to the client.
+        prompt (str): Text passed to the ASR as the context of the audio in the scratch buffer, if any.
+        journal (Journal): The journal that transcripts are retained in, None when journaling is disabled.
+        log_mel (StreamingLogMel): Computes the ASR features of the audio as it arrives, None when the ASR
+            replicas featurize the audio themselves.
+        log_mel_frames (np.ndarray): The log-mel frames of the scratch buffer sent with an ASR request, or
+            the future computing them, see attach_log_mel().
+        segment_listener (Callable): Coroutine function that sends the segments of a transcription to the
+            WebSocket as they are decoded, None unless the client config sets 'stream_segments'.
     """
     def __init__(self, client_id, sampling_rate, samples_width):
         self.client_id = client_id
@@ -33,19 +62,169 @@ class Client:
         self.total_samples = 0
         self.sampling_rate = sampling_rate
         self.samples_width = samples_width
+        self.tasks = set()
+        self.pending_requests = {}
+        self.closed = False
+        self.connected_at = time.time()
+        self.buffer_started_at = None
+        self.trace_context = None
+        self.trace_started_at = None
+        self.scratch_offset_bytes = 0
+        self.committed_text = ""
+        self.committed_until_seconds = 0.0
+        self.prompt = None
+        self.journal = None
+        self.log_mel = None
+        self.log_mel_frames = None
+        self.segment_listener = None
         self.buffering_strategy = BufferingStrategyFactory.create_buffering_strategy(self.config['processing_strategy'], self, **self.config['processing_args'])
 
     def update_config(self, config_data):
-        self.config.update(config_data)
-        self.buffering_strategy = BufferingStrategyFactory.create_buffering_strategy(self.config['processing_strategy'], self, **self.config['processing_args'])
+        """
+        Applies the data of a config message.
+
+        Raises:
+            TypeError, ValueError: If the config is invalid, e.g. names an unknown processing
+                strategy. The client then keeps its config and buffering strategy.
+        """
+        config = dict(self.config, **config_data)
+        offset_samples = None
+        if 'stream_offset_seconds' in config_data:
+            offset_samples = int(round(float(config_data['stream_offset_seconds']) * self.sampling_rate))
+        buffering_strategy = BufferingStrategyFactory.create_buffering_strategy(
+            config['processing_strategy'], self, **config['processing_args'])
+
+        self.config = config
+        if offset_samples is not None:
+            # A client resuming a stream after a reconnect resends its audio from
+            # this position, the stream position of the next audio it sends.
+            self.scratch_offset_bytes = (offset_samples * self.samples_width
+                                         - len(self.scratch_buffer) - len(self.buffer))
+            if self.log_mel is not None:
+                self.log_mel.reset(offset_samples)
+        self.buffering_strategy.close()
+        self.buffering_strategy = buffering_strategy
 
     def append_audio_data(self, audio_data):
+        if not self.buffer:
+            self.buffer_started_at = time.time()
         self.buffer.extend(audio_data)
         self.total_samples += len(audio_data) / self.samples_width
+        if self.log_mel is not None:
+            self.log_mel.feed(audio_data)
 
     def clear_buffer(self):
         self.buffer.clear()
 
+    def discard_scratch_buffer(self, length=None):
+        """
+        Removes audio that is done with from the start of the scratch buffer.
+
+        Args:
+            length (int): Number of bytes to remove, by default the whole buffer.
+        """
+        if length is None:
+            length = len(self.scratch_buffer)
+        length = max(0, min(length, len(self.scratch_buffer)))
+        del self.scratch_buffer[:length]
+        self.scratch_offset_bytes += length
+        if self.log_mel is not None:
+            self.log_mel.discard(self.scratch_offset_bytes // self.samples_width)
+            # Some strategies discard on every message; the work is left queued for the
+            # next chunk unless audio that no chunk was sent for has piled up
+            if self.log_mel.compute_due():
+                self.compute_log_mel()
+
+    def stream_position_seconds(self, offset_bytes):
+        """
+        Converts a position in the audio stream from bytes to seconds.
+        """
+        return offset_bytes / (self.sampling_rate * self.samples_width)
+
+    def context_prompt(self, max_chars):
+        """
+        Returns the end of the committed text, cut at a word boundary, to prompt the
+        ASR with the context of the next utterance; None when prompting is disabled.
+
+        Args:
+            max_chars (int): Maximum length of the prompt, 0 to disable prompting.
+        """
+        if max_chars <= 0 or not self.committed_text:
+            return None
+        prompt = self.committed_text[-max_chars:]
+        if len(prompt) < len(self.committed_text) and ' ' in prompt:
+            prompt = prompt.split(' ', 1)[1]
+        return prompt
+
+    def remove_committed_words(self, transcription, utterance):
+        """
+        Makes the word timestamps of a transcription or segment stream-absolute, and
+        drops the words that were already sent, rebuilding the text from the others.
+
+        Returns:
+            list: The remaining words.
+        """
+        words = transcription['words']
+        offset_seconds = utterance.stream_position_seconds(utterance.scratch_offset_bytes)
+        new_words = []
+        for word in words:
+            word = dict(word, start=word['start'] + offset_seconds, end=word['end'] + offset_seconds)
+            if (word['start'] + word['end']) / 2 > self.committed_until_seconds:
+                new_words.append(word)
+        if len(new_words) < len(words):
+            transcription['text'] = ''.join(word['word'] for word in new_words).strip()
+        transcription['words'] = new_words
+        return new_words
+
+    def preview_segment(self, segment, utterance):
+        """
+        Prepares a segment of a transcription that is still being decoded for
+        sending, like commit_transcription() but without committing it: the final
+        transcription of the utterance replaces its segments.
+
+        Args:
+            segment (dict): A segment streamed by the ASR deployment, with its start and end relative to the utterance.
+            utterance (Client): The client, or the snapshot of it, that holds the utterance audio.
+
+        Returns:
+            bool: Whether anything is left to send.
+        """
+        offset_seconds = utterance.stream_position_seconds(utterance.scratch_offset_bytes)
+        segment['start'] += offset_seconds
+        segment['end'] += offset_seconds
+        if isinstance(segment.get('words'), list):
+            self.remove_committed_words(segment, utterance)
+        elif segment['end'] <= self.committed_until_seconds:
+            return False
+        return segment['text'] != ''
+
+    def commit_transcription(self, transcription, utterance):
+        """
+        Prepares a transcription for sending, in utterance order.
+
+        Word timestamps are made stream-absolute. Words in audio that was already
+        transcribed with the previous utterance, because the buffering strategy
+        carried it over as context, are dropped, and the text is rebuilt from the
+        remaining words.
+
+        Args:
+            transcription (dict): The transcription returned by the ASR deployment.
+            utterance (Client): The client, or the snapshot of it, that holds the utterance audio.
+
+        Returns:
+            bool: Whether anything is left to send.
+        """
+        words = transcription.get('words')
+        if isinstance(words, list):
+            new_words = self.remove_committed_words(transcription, utterance)
+            if new_words:
+                self.committed_until_seconds = max(self.committed_until_seconds, new_words[-1]['end'])
+
+        if transcription['text']:
+            committed_text = f"{self.committed_text} {transcription['text']}".strip()
+            self.committed_text = committed_text[-COMMITTED_TEXT_MAX_CHARS:]
+        return transcription['text'] != ''
+
     def increment_file_counter(self):
         self.file_counter += 1
 
@@ -55,5 +234,182 @@ class Client:
 
         return f"{self.client_id}_{self.file_counter}.wav"
     
+    def snapshot(self, scratch_buffer):
+        """
+        Returns a copy of the client that carries its own scratch buffer.
+
+        Pipelined buffering strategies keep filling the live client while earlier
+        chunks are still waiting for the VAD or ASR deployments, so each request
+        gets a snapshot that later audio cannot modify.
+
+        The snapshot is copied through __getstate__(), like a pickled client. It has
+        the configuration, stream position, trace context and prompt of the client,
+        but an empty buffer and none of its runtime attributes: no buffering strategy,
+        tasks, pending requests, journal, log-mel state or segment listener. Anything
+        that needs those must use the live client.
+        """
+        snapshot = copy.copy(self)
+        snapshot.config = dict(self.config)
+        snapshot.scratch_buffer = bytearray(scratch_buffer)
+        return snapshot
+
+    def attach_log_mel(self, utterance):
+        """
+        Attaches the log-mel frames of the audio of a snapshot, so that the ASR
+        replica does not featurize it. The frames are computed in a worker thread,
+        in order with the audio received and discarded, and call_deployment() waits
+        for them. They must be attached before the audio is discarded from the
+        scratch buffer, or they are computed again from scratch.
+
+        Args:
+            utterance (Client): This client or a snapshot of it.
+        """
+        if self.log_mel is not None:
+            utterance.log_mel_frames = asyncio.wrap_future(self.log_mel.request_chunk_frames(
+                utterance.scratch_offset_bytes // self.samples_width, bytes(utterance.scratch_buffer)))
+            self.compute_log_mel()
+
+    def compute_log_mel(self):
+        """
+        Runs the log-mel work queued for the stream off the event loop, see StreamingLogMel.
+        """
+        self.log_mel.schedule(asyncio.get_running_loop())
+
+    def start_trace(self, started_at=None, buffered_until=None):
+        """
+        Starts the trace of a new chunk or utterance, unless one is already open.
+
+        The trace starts when its first audio arrived, so it includes the time spent
+        buffering. Snapshots taken afterwards carry the trace context to the VAD and
+        ASR replicas.
+
+        Args:
+            started_at (float): Time at which the first audio arrived, by default the start of the buffer.
+            buffered_until (float): Time at which the audio left the buffer, by default now.
+        """
+        if self.trace_context is None:
+            self.trace_context = new_trace_context()
+            self.trace_started_at = started_at or self.buffer_started_at or time.time()
+            get_tracer().record("chunk.buffering", self.trace_context, self.trace_started_at,
+                                buffered_until or time.time(), client_id=self.client_id)
+
+    def end_trace(self, outcome):
+        """
+        Records the root span of the current trace and closes it.
+
+        Args:
+            outcome (str): How the chunk ended, e.g. 'transcribed' or 'no_speech'.
+        """
+        get_tracer().record("chunk", self.trace_context, self.trace_started_at or time.time(), time.time(),
+                            root=True, client_id=self.client_id, outcome=outcome)
+        self.trace_context = None
+        self.trace_started_at = None
+
+    def create_task(self, coro):
+        """
+        Schedules audio processing for this client and keeps track of the task,
+        so that it is cancelled when the client disconnects.
+        """
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def call_deployment(self, stage, method, client, **kwargs):
+        """
+        Calls a VAD or ASR deployment method on the audio of `client`, which is
+        this client or a snapshot of it.
+
+        The request is tracked under `stage` until it completes, so that close() can
+        cancel it in Ray Serve and stats() can report it; requests are not sent at
+        all once the client has disconnected. ASR methods that stream segments get
+        the segment listener of this client, which snapshots do not carry.
+        """
+        if self.closed:
+            raise asyncio.CancelledError(f"Client {self.client_id} disconnected")
+        if stage == 'asr' and client.log_mel_frames is None:
+            self.attach_log_mel(client)
+        if stage == 'asr' and self.segment_listener is not None and getattr(method, 'streams_segments', False):
+            # Snapshots have no segment listener, it is taken from the live client
+            kwargs['on_segment'] = self.segment_listener
+        if client.log_mel_frames is not None:
+            # With 128 mel bins, float16 frames are 0.8 times the size of the 16-bit PCM
+            # and float32 ones 1.6 times. Rounded to float16, the features whisper_features()
+            # computes are off by less than 0.002, which a float16 model does not resolve.
+            client.log_mel_frames = (await client.log_mel_frames).astype(np.float16)
+        response = method.remote(client = client, **kwargs)
+        started_at = time.time()
+        self.pending_requests[response] = (stage, len(client.scratch_buffer), started_at)
+        try:
+            return await response
+        except asyncio.CancelledError:
+            response.cancel()
+            raise
+        finally:
+            del self.pending_requests[response]
+            client.log_mel_frames = None
+            # Request time minus the time spent in the replica is queueing,
+            # serialization and transport.
+            get_tracer().record(f"{stage}.request", client.trace_context, started_at, time.time(),
+                                client_id=self.client_id, audio_bytes=len(client.scratch_buffer))
+
+    def stats(self):
+        """
+        Returns the buffering state and the work in flight of the client.
+        """
+        now = time.time()
+        bytes_per_second = self.sampling_rate * self.samples_width
+        return {
+            "client_id": self.client_id,
+            "processing_strategy": self.config['processing_strategy'],
+            "chunk_length_seconds": getattr(self.buffering_strategy, 'chunk_length_seconds', None),
+            "connected_seconds": now - self.connected_at,
+            "received_audio_seconds": self.total_samples / self.sampling_rate,
+            "buffer_bytes": len(self.buffer),
+            "buffer_age_seconds": now - self.buffer_started_at if self.buffer else 0.0,
+            "scratch_buffer_bytes": len(self.scratch_buffer),
+            "tasks": len(self.tasks),
+            "in_flight": [
+                {"stage": stage, "audio_seconds": audio_bytes / bytes_per_second, "age_seconds": now - started_at}
+                for stage, audio_bytes, started_at in self.pending_requests.values()
+            ],
+        }
+
+    def close(self):
+        """
+        Cancels all the work in flight for a disconnected client.
+
+        Queued chunks are dropped before they reach the models, local processing
+        tasks are cancelled and pending deployment requests are cancelled in Ray Serve.
+
+        Returns:
+            float: Seconds of received audio that will not be transcribed.
+        """
+        self.closed = True
+        cancelled_bytes = len(self.buffer) + self.buffering_strategy.close()
+        for response in list(self.pending_requests):
+            response.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        self.buffer.clear()
+        self.scratch_buffer.clear()
+        return cancelled_bytes / (self.sampling_rate * self.samples_width)
+
+    def __getstate__(self):
+        # The client is passed by value to the VAD and ASR deployments. They only
+        # need the audio and the configuration; the buffering strategy, tasks and
+        # requests are event-loop state that cannot be pickled.
+        state = self.__dict__.copy()
+        for runtime_attribute in ('buffering_strategy', 'tasks', 'pending_requests', 'journal', 'log_mel',
+                                  'segment_listener'):
+            state.pop(runtime_attribute, None)
+        # Audio received after the utterance stays at the ingress, so that the size
+        # of a request does not grow with the backlog of the client.
+        state['buffer'] = bytearray()
+        return state
+
     def process_audio(self, websocket : WebSocket, vad_handle, asr_handle):
+        self.segment_listener = None
+        if self.config.get('stream_segments'):
+            self.segment_listener = functools.partial(send_segment, websocket, self)
         self.buffering_strategy.process_audio(websocket, vad_handle, asr_handle)
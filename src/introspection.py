@@ -0,0 +1,152 @@
+import os
+import asyncio
+import time
+import tracemalloc
+from collections import deque
+
+from ray import serve
+from ray.serve.exceptions import RayServeException
+
+
+class EventLoopLagMonitor:
+    """
+    Measures how late the event loop runs a timer that should fire every `interval_seconds`.
+
+    A lag well above zero means that something, for example audio processing that
+    runs inline in a receive loop, is blocking the loop and every connection
+    served by it.
+
+    Attributes:
+        interval_seconds (float): How often the loop is probed.
+        lags (deque): The most recent lags in seconds.
+        max_lag_seconds (float): The largest lag seen since the monitor started.
+        task (asyncio.Task): The probing task, once started.
+    """
+
+    def __init__(self, interval_seconds=0.1, window_size=600):
+        self.interval_seconds = interval_seconds
+        self.lags = deque(maxlen=window_size)
+        self.max_lag_seconds = 0.0
+        self.task = None
+
+    def start(self):
+        """
+        Start probing the running event loop; does nothing if already started.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval_seconds)
+            lag = max(0.0, time.monotonic() - start - self.interval_seconds)
+            self.lags.append(lag)
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+
+    def stats(self):
+        """
+        Returns the latest, mean, p99 and maximum lag in seconds.
+        """
+        if not self.lags:
+            return {"interval_seconds": self.interval_seconds, "samples": 0}
+        ordered = sorted(self.lags)
+        return {
+            "interval_seconds": self.interval_seconds,
+            "samples": len(ordered),
+            "latest_lag_seconds": self.lags[-1],
+            "mean_lag_seconds": sum(ordered) / len(ordered),
+            "p99_lag_seconds": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+            "max_lag_seconds": self.max_lag_seconds,
+        }
+
+
+class MemoryTracer:
+    """
+    Takes tracemalloc snapshots on demand and reports the top allocation sites.
+
+    Tracing slows allocations down noticeably, so it only runs between start()
+    and stop(). Each snapshot is compared with the previous one, which shows
+    where memory is growing between two calls.
+
+    Attributes:
+        previous_snapshot (tracemalloc.Snapshot): The snapshot taken by the last call to top().
+    """
+
+    def __init__(self):
+        self.previous_snapshot = None
+
+    def start(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.previous_snapshot = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous_snapshot = None
+
+    def top(self, limit=20, group_by="lineno"):
+        """
+        Returns the `limit` largest allocation sites and, from the second call on,
+        the sites that grew the most since the previous call.
+
+        Raises:
+            RuntimeError: If tracing was not started.
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not tracing, start it first")
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "top": [
+                {"site": str(statistic.traceback), "size_bytes": statistic.size, "count": statistic.count}
+                for statistic in snapshot.statistics(group_by)[:limit]
+            ],
+        }
+        if self.previous_snapshot is not None:
+            result["growth"] = [
+                {"site": str(statistic.traceback), "size_diff_bytes": statistic.size_diff, "count_diff": statistic.count_diff}
+                for statistic in snapshot.compare_to(self.previous_snapshot, group_by)[:limit]
+            ]
+        self.previous_snapshot = snapshot
+        return result
+
+
+def process_memory():
+    """
+    Returns the resident memory of this process in bytes, split into anonymous
+    memory, file-backed pages (e.g. memory-mapped weights) and shared memory, as
+    reported by /proc/self/status; empty where that is not available.
+    """
+    fields = {"VmRSS": "rss_bytes", "RssAnon": "anonymous_bytes", "RssFile": "file_bytes", "RssShmem": "shared_memory_bytes"}
+    memory = {}
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    memory[fields[key]] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+def replica_tag():
+    """
+    Returns the tag of the Ray Serve replica running this code, or a tag naming the
+    process when the model runs outside Ray Serve, e.g. in the batch CLI.
+    """
+    try:
+        return serve.get_replica_context().replica_tag
+    except RayServeException:
+        return f"local-{os.getpid()}"
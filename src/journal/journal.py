@@ -0,0 +1,290 @@
+import os
+import json
+import gzip
+import time
+import uuid
+import asyncio
+from collections import deque
+
+from ray.serve import metrics
+
+from .journal_backend_factory import JournalBackendFactory
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+
+def read_segment(data):
+    """
+    Reads the records of a journal segment.
+
+    A segment is a gzip stream of records, each a JSON header line with the
+    session id, type, time and payload length, followed by the payload: raw PCM
+    for 'audio' records, JSON for the others.
+
+    Args:
+        data (bytes): The compressed segment, as written to the backend.
+
+    Yields:
+        Tuple[dict, bytes]: The header and payload of each record.
+    """
+    raw = gzip.decompress(data)
+    position = 0
+    while position < len(raw):
+        end_of_header = raw.index(b"\n", position)
+        header = json.loads(raw[position:end_of_header])
+        position = end_of_header + 1 + header['length']
+        yield header, raw[end_of_header + 1:position]
+
+
+class Journal:
+    """
+    Retains the audio and transcripts of every session without writing on the hot path.
+
+    Events are appended to a bounded in-memory queue. A background task moves them
+    into a segment, which is compressed and handed to the backend from a worker
+    thread once it reaches `segment_bytes` or is `flush_interval_seconds` old, so
+    storage sees a few large sequential writes instead of one per audio frame.
+    Each written segment is then recorded in the index, with the audio range and
+    transcript count of every session it holds.
+
+    When storage falls behind and the queue is full, audio is either dropped
+    ('drop' policy) or the receive loop of the session waits for room, up to
+    `block_timeout_seconds`, which slows the client down through TCP flow control
+    ('block' policy). Transcript and session events never wait. Everything that
+    is not retained is counted in the journal_dropped_bytes metric.
+
+    Attributes:
+        backend (JournalBackendInterface): Where segments are written.
+        max_queue_bytes (int): Maximum payload bytes waiting for the writer.
+        segment_bytes (int): Uncompressed size at which a segment is written.
+        flush_interval_seconds (float): Maximum age of a segment before it is written.
+        overflow_policy (str): 'drop' or 'block'.
+        queued_bytes (int): Payload bytes waiting for the writer.
+        audio_offsets (dict): Stream position of the next audio of each open session, in bytes.
+    """
+
+    def __init__(self, backend, max_queue_bytes=64 * 1024 * 1024, segment_bytes=16 * 1024 * 1024,
+                 flush_interval_seconds=10.0, overflow_policy="drop", block_timeout_seconds=1.0, compression_level=6):
+        if overflow_policy not in ("drop", "block"):
+            raise ValueError(f"Unknown journal overflow policy: {overflow_policy}")
+        self.backend = backend
+        self.max_queue_bytes = max_queue_bytes
+        self.segment_bytes = segment_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+        self.overflow_policy = overflow_policy
+        self.block_timeout_seconds = block_timeout_seconds
+        self.compression_level = compression_level
+        self.writer_id = uuid.uuid4().hex[:12]
+        self.segment_sequence = 0
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.audio_offsets = {}
+        self.event_available = asyncio.Event()
+        self.space_available = asyncio.Event()
+        self.task = None
+        self.closing = False
+        self.new_segment()
+
+        self.queue_bytes_gauge = metrics.Gauge("journal_queue_bytes", description="Journal bytes waiting for the writer.")
+        self.dropped_bytes = metrics.Counter(
+            "journal_dropped_bytes", description="Journal bytes that were not retained.", tag_keys=("type", "reason"))
+        self.written_bytes = metrics.Counter(
+            "journal_written_bytes", description="Journal bytes written to storage.", tag_keys=("kind",))
+        self.write_seconds = metrics.Histogram(
+            "journal_write_seconds", description="Time taken to compress and store a journal segment.",
+            boundaries=[0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30])
+        self.blocked_seconds = metrics.Counter(
+            "journal_blocked_seconds", description="Time receive loops waited for room in the journal queue.")
+
+    @staticmethod
+    def from_environment():
+        """
+        Creates the journal configured by the environment, or returns None when
+        JOURNAL_ENABLED is not 'true'.
+
+        Configured with the environment variables:
+            JOURNAL_BACKEND: The backend type, 'local' by default.
+            JOURNAL_DIR: The directory of the 'local' backend.
+            JOURNAL_MAX_QUEUE_MB: Maximum size of the in-memory queue.
+            JOURNAL_SEGMENT_MB: Uncompressed size at which a segment is written.
+            JOURNAL_FLUSH_INTERVAL_SECONDS: Maximum age of a segment before it is written.
+            JOURNAL_OVERFLOW_POLICY: 'drop' or 'block'.
+        """
+        if os.environ.get('JOURNAL_ENABLED', 'false').lower() != 'true':
+            return None
+        backend_kwargs = {}
+        if os.environ.get('JOURNAL_DIR'):
+            backend_kwargs['directory'] = os.environ['JOURNAL_DIR']
+        backend = JournalBackendFactory.create_journal_backend(os.environ.get('JOURNAL_BACKEND', 'local'), **backend_kwargs)
+        return Journal(
+            backend,
+            max_queue_bytes=int(float(os.environ.get('JOURNAL_MAX_QUEUE_MB', 64)) * 1024 * 1024),
+            segment_bytes=int(float(os.environ.get('JOURNAL_SEGMENT_MB', 16)) * 1024 * 1024),
+            flush_interval_seconds=float(os.environ.get('JOURNAL_FLUSH_INTERVAL_SECONDS', 10.0)),
+            overflow_policy=os.environ.get('JOURNAL_OVERFLOW_POLICY', 'drop'),
+        )
+
+    def start(self):
+        """
+        Start the writer on the running event loop; does nothing if already started.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def enqueue(self, session_id, type, payload, **fields):
+        header = dict(session_id=session_id, type=type, time=time.time(), length=len(payload), **fields)
+        self.queue.append((header, payload))
+        self.queued_bytes += len(payload)
+        self.queue_bytes_gauge.set(self.queued_bytes)
+        self.event_available.set()
+
+    def drop(self, type, length, reason):
+        self.dropped_bytes.inc(length, tags={"type": type, "reason": reason})
+
+    async def record_audio(self, session_id, audio_data):
+        """
+        Journals audio received from a session.
+
+        Args:
+            session_id (str): The client id of the session.
+            audio_data (bytes): The raw PCM audio.
+        """
+        offset_bytes = self.audio_offsets.get(session_id, 0)
+        # The stream position advances even if the audio is dropped, so that gaps show in the index
+        self.audio_offsets[session_id] = offset_bytes + len(audio_data)
+        if self.queued_bytes + len(audio_data) > self.max_queue_bytes and self.overflow_policy == "block":
+            started_at = time.monotonic()
+            deadline = started_at + self.block_timeout_seconds
+            while self.queued_bytes + len(audio_data) > self.max_queue_bytes and time.monotonic() < deadline:
+                self.space_available.clear()
+                try:
+                    await asyncio.wait_for(self.space_available.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+            self.blocked_seconds.inc(time.monotonic() - started_at)
+        if self.queued_bytes + len(audio_data) > self.max_queue_bytes:
+            self.drop("audio", len(audio_data), "queue_full")
+            return
+        self.enqueue(session_id, "audio", bytes(audio_data), offset_bytes=offset_bytes)
+
+    def record_event(self, session_id, type, data):
+        """
+        Journals a transcript or a session event without waiting.
+
+        Args:
+            session_id (str): The client id of the session.
+            type (str): The type of the record, e.g. 'transcript', 'open', 'config' or 'close'.
+            data (dict): The JSON payload of the record.
+        """
+        payload = json.dumps(data).encode()
+        if self.queued_bytes + len(payload) > self.max_queue_bytes:
+            self.drop(type, len(payload), "queue_full")
+            return
+        self.enqueue(session_id, type, payload)
+
+    def end_session(self, session_id, **data):
+        """
+        Journals the end of a session and forgets its stream position.
+        """
+        audio_bytes = self.audio_offsets.pop(session_id, 0)
+        self.record_event(session_id, "close", dict(data, audio_bytes=audio_bytes))
+
+    def new_segment(self):
+        self.segment = []
+        self.segment_size = 0
+        self.segment_sessions = {}
+        self.segment_started_at = None
+
+    def add_to_segment(self, header, payload):
+        if self.segment_started_at is None:
+            self.segment_started_at = time.monotonic()
+        record = json.dumps(header).encode() + b"\n"
+        self.segment.append(record)
+        self.segment.append(payload)
+        self.segment_size += len(record) + len(payload)
+
+        session = self.segment_sessions.setdefault(header['session_id'], {
+            "first_time": header['time'], "audio_records": 0, "audio_start_bytes": None,
+            "audio_end_bytes": None, "transcripts": 0, "events": 0})
+        session['last_time'] = header['time']
+        if header['type'] == "audio":
+            session['audio_records'] += 1
+            if session['audio_start_bytes'] is None:
+                session['audio_start_bytes'] = header['offset_bytes']
+            session['audio_end_bytes'] = header['offset_bytes'] + header['length']
+        elif header['type'] == "transcript":
+            session['transcripts'] += 1
+        else:
+            session['events'] += 1
+
+    async def run(self):
+        while True:
+            if not self.queue and not self.closing:
+                timeout = None
+                if self.segment:
+                    timeout = max(0.0, self.segment_started_at + self.flush_interval_seconds - time.monotonic())
+                self.event_available.clear()
+                try:
+                    await asyncio.wait_for(self.event_available.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            while self.queue and self.segment_size < self.segment_bytes:
+                header, payload = self.queue.popleft()
+                self.queued_bytes -= len(payload)
+                self.add_to_segment(header, payload)
+            self.queue_bytes_gauge.set(self.queued_bytes)
+            self.space_available.set()
+
+            if self.segment and (self.segment_size >= self.segment_bytes or self.closing
+                                 or time.monotonic() - self.segment_started_at >= self.flush_interval_seconds):
+                await self.flush()
+            if self.closing and not self.queue:
+                return
+
+    async def flush(self):
+        """
+        Writes the current segment, if any, and starts a new one.
+
+        Compression and storage run in a worker thread. A segment that cannot be
+        written is dropped; the writer moves on rather than holding it in memory.
+        """
+        if not self.segment:
+            return
+        segment, segment_size, sessions = self.segment, self.segment_size, self.segment_sessions
+        self.new_segment()
+        self.segment_sequence += 1
+        # The segment and its index entry go under the same day, even across midnight
+        written_at = time.gmtime()
+        day = time.strftime('%Y-%m-%d', written_at)
+        name = f"{time.strftime('%H%M%S', written_at)}-{self.writer_id}-{self.segment_sequence:06d}.journal.gz"
+        loop = asyncio.get_running_loop()
+        started_at = time.monotonic()
+        try:
+            data = await loop.run_in_executor(None, gzip.compress, b"".join(segment), self.compression_level)
+            await loop.run_in_executor(None, self.backend.write_segment, day, name, data)
+            await loop.run_in_executor(None, self.backend.append_index, day, {
+                "segment": name,
+                "written_at": time.time(),
+                "records": len(segment) // 2,
+                "raw_bytes": segment_size,
+                "compressed_bytes": len(data),
+                "sessions": sessions,
+            })
+        except Exception:
+            logger.exception(f"Could not write journal segment {name}, {segment_size} bytes dropped")
+            self.drop("segment", segment_size, "write_failed")
+            return
+        self.write_seconds.observe(time.monotonic() - started_at)
+        self.written_bytes.inc(segment_size, tags={"kind": "raw"})
+        self.written_bytes.inc(len(data), tags={"kind": "compressed"})
+
+    async def close(self):
+        """
+        Writes everything that is still queued and stops the writer.
+        """
+        self.closing = True
+        self.event_available.set()
+        self.start()
+        await self.task
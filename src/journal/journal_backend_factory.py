@@ -0,0 +1,23 @@
+from .local_filesystem_backend import LocalFilesystemBackend
+
+class JournalBackendFactory:
+    """
+    Factory for creating instances of journal storage backends.
+    """
+
+    @staticmethod
+    def create_journal_backend(type, **kwargs):
+        """
+        Creates a journal backend based on the specified type.
+
+        Args:
+            type (str): The type of backend to create (e.g., 'local').
+            kwargs: Additional arguments for the backend creation.
+
+        Returns:
+            JournalBackendInterface: An instance of a class that implements JournalBackendInterface.
+        """
+        if type == "local":
+            return LocalFilesystemBackend(**kwargs)
+        else:
+            raise ValueError(f"Unknown journal backend type: {type}")
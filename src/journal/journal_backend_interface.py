@@ -0,0 +1,28 @@
+class JournalBackendInterface:
+    """
+    Interface for the storage that journal segments are written to.
+
+    Methods are called from a worker thread of the journal, never on the event
+    loop, so implementations may block.
+    """
+
+    def write_segment(self, day, name, data):
+        """
+        Stores a complete segment.
+
+        Args:
+            day (str): The UTC day of the segment, 'YYYY-MM-DD'; the index entry of the segment has the same day.
+            name (str): The name of the segment, unique across replicas.
+            data (bytes): The compressed segment.
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def append_index(self, day, entry):
+        """
+        Records a stored segment in the index, after write_segment() succeeded.
+
+        Args:
+            day (str): The UTC day the segment was written under.
+            entry (dict): The index entry of the segment, see Journal.
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
@@ -0,0 +1,44 @@
+import os
+import json
+
+from .journal_backend_interface import JournalBackendInterface
+
+
+class LocalFilesystemBackend(JournalBackendInterface):
+    """
+    Writes journal segments to a local directory, e.g. a persistent volume.
+
+    Segments go to one subdirectory per day, under a temporary name until they
+    are complete. The index of a day is a JSON lines file next to its segments,
+    so a reader only ever sees complete segments in it.
+
+    Attributes:
+        directory (str): The root directory of the journal.
+        fsync (bool): Whether segments and index entries are synced to disk before they count as written.
+    """
+
+    def __init__(self, directory="/var/lib/whisper-streaming/journal", fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+
+    def day_directory(self, day):
+        directory = os.path.join(self.directory, day)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def write_segment(self, day, name, data):
+        path = os.path.join(self.day_directory(day), name)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'wb') as segment_file:
+            segment_file.write(data)
+            if self.fsync:
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+        os.rename(temporary_path, path)
+
+    def append_index(self, day, entry):
+        with open(os.path.join(self.day_directory(day), "index.jsonl"), 'a') as index_file:
+            index_file.write(json.dumps(entry) + "\n")
+            if self.fsync:
+                index_file.flush()
+                os.fsync(index_file.fileno())
@@ -2,9 +2,10 @@ import argparse
 import asyncio
 import json
 
-from .server import Server
 from src.asr.asr_factory import ASRFactory
 from src.vad.vad_factory import VADFactory
+from src.batch import add_batch_arguments, run_batch
+from src.replay import add_compare_arguments, add_replay_arguments, run_compare, run_replay
 
 def parse_args():
     parser = argparse.ArgumentParser(description="VoiceStreamAI Server: Real-time audio transcription using self-hosted Whisper and WebSocket")
@@ -14,6 +15,10 @@ def parse_args():
     parser.add_argument("--asr-args", type=str, default='{"model_size": "large-v3"}', help="JSON string of additional arguments for ASR pipeline")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Host for the WebSocket server")
     parser.add_argument("--port", type=int, default=8765, help="Port for the WebSocket server")
+    subparsers = parser.add_subparsers(dest="command", help="Without a command, the WebSocket server is started")
+    add_batch_arguments(subparsers.add_parser("batch", help="Transcribe a directory or manifest of audio files into a JSON lines file"))
+    add_replay_arguments(subparsers.add_parser("replay", help="Replay captured traffic against a deployment and measure its latency"))
+    add_compare_arguments(subparsers.add_parser("compare", help="Compare the latencies of two replays"))
     return parser.parse_args()
 
 def main():
@@ -26,6 +31,19 @@ def main():
         print(f"Error parsing JSON arguments: {e}")
         return
 
+    if args.command == "batch":
+        run_batch(args)
+        return
+    if args.command == "replay":
+        run_replay(args)
+        return
+    if args.command == "compare":
+        run_compare(args)
+        return
+
+    # Imported here so that the batch command does not depend on the standalone server
+    from .server import Server
+
     vad_pipeline = VADFactory.create_vad_pipeline(args.vad_type, **vad_args)
     asr_pipeline = ASRFactory.create_asr_pipeline(args.asr_type, **asr_args)
 
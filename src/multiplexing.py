@@ -0,0 +1,71 @@
+import asyncio
+import json
+import struct
+
+# Binary frames of a multiplexed connection start with the stream id, a 32-bit
+# unsigned big-endian integer, followed by the PCM audio of that stream.
+STREAM_ID_HEADER = struct.Struct("!I")
+
+
+def encode_frame(stream_id, audio_data):
+    """
+    Prefixes audio with the header of its stream.
+    """
+    return STREAM_ID_HEADER.pack(stream_id) + audio_data
+
+
+def decode_frame(frame):
+    """
+    Splits a binary frame of a multiplexed connection into its stream id and audio.
+
+    Returns:
+        Tuple[int, memoryview]: The stream id and the audio, without copying it.
+
+    Raises:
+        ValueError: If the frame is too short to carry a header.
+    """
+    if len(frame) < STREAM_ID_HEADER.size:
+        raise ValueError(f"Frame of {len(frame)} bytes has no stream id header")
+    (stream_id,) = STREAM_ID_HEADER.unpack_from(frame)
+    return stream_id, memoryview(frame)[STREAM_ID_HEADER.size:]
+
+
+class MultiplexedConnection:
+    """
+    The shared websocket of multiplexed streams.
+
+    Buffering strategies of different streams send concurrently from their own
+    tasks, so sends are serialized on one lock.
+
+    Attributes:
+        websocket (WebSocket): The underlying connection.
+        send_lock (asyncio.Lock): Serializes the messages of all streams.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.send_lock = asyncio.Lock()
+
+    async def send_json(self, message):
+        async with self.send_lock:
+            await self.websocket.send_text(json.dumps(message))
+
+    def stream(self, stream_id):
+        return StreamWebSocket(self, stream_id)
+
+
+class StreamWebSocket:
+    """
+    What the buffering strategies of one stream see as their websocket: the
+    messages they send are tagged with the stream id and go out on the shared
+    connection.
+    """
+
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.stream_id = stream_id
+
+    async def send_text(self, text):
+        message = json.loads(text)
+        message["stream_id"] = self.stream_id
+        await self.connection.send_json(message)
@@ -0,0 +1,362 @@
+import json
+import time
+import bisect
+import asyncio
+import urllib.parse
+
+import websockets
+
+from src.capture import AUDIO, CONFIG, read_capture
+from src.multiplexing import encode_frame
+from src.sdk.sources import load_audio_file
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+
+def latency_summary(latencies):
+    """
+    Summarizes latencies in seconds: their count, mean, percentiles and maximum.
+    """
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+class SyntheticAudio:
+    """
+    Stands in for the audio of captures recorded without it: a file played in a
+    loop, or silence without one.
+
+    Attributes:
+        audio (bytes): The PCM audio played, empty for silence.
+        position (int): The next byte played.
+    """
+
+    def __init__(self, path=None):
+        self.audio = load_audio_file(path) if path else b""
+        self.position = 0
+
+    def take(self, size):
+        if not self.audio:
+            return bytes(size)
+        chunk = bytearray()
+        while len(chunk) < size:
+            piece = self.audio[self.position:self.position + size - len(chunk)]
+            chunk += piece
+            self.position = (self.position + len(piece)) % len(self.audio)
+        return bytes(chunk)
+
+
+class SessionReplay:
+    """
+    The replay of one captured session: sends its config messages and audio frames
+    at their original times, scaled down by `speedup`, and measures the latency of
+    the transcriptions it receives.
+
+    The latency of a transcription is the time from sending the frame that
+    completed its audio, up to its stream_end_seconds, to receiving it.
+
+    Attributes:
+        session (dict): The session, as read by read_capture().
+        result (dict): The 'session', its transcription 'latencies', 'segments' received and 'error' if it failed.
+        received (asyncio.Event): Set whenever a message for the session is received.
+    """
+
+    def __init__(self, session, started_at, speedup=1.0, fill_audio=None):
+        self.session = session
+        self.started_at = started_at
+        self.speedup = speedup
+        self.fill_audio = fill_audio
+        self.result = {"session": session['session'], "latencies": [], "segments": 0, "transcriptions": 0}
+        # Stream position at the end of every frame sent, and when it was sent
+        self.sent_ends, self.sent_times = [], []
+        self.offset_bytes = 0
+        self.received = asyncio.Event()
+
+    async def sleep_until(self, seconds):
+        """
+        Waits until the replay reaches a time of the capture.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0.0, self.started_at + seconds / self.speedup - loop.time()))
+
+    def receive(self, message):
+        """
+        Counts a message received for the session, and measures its latency if it is a transcription.
+        """
+        received_at = asyncio.get_running_loop().time()
+        self.received.set()
+        if message.get('type') == 'segment':
+            self.result['segments'] += 1
+            return
+        if message.get('type') == 'error':
+            self.result['error'] = message.get('message')
+            return
+        if 'stream_end_seconds' not in message:
+            return
+        self.result['transcriptions'] += 1
+        sampling_rate, samples_width = self.session['sampling_rate'], self.session['samples_width']
+        end_bytes = int(round(message['stream_end_seconds'] * sampling_rate)) * samples_width - self.offset_bytes
+        index = bisect.bisect_left(self.sent_ends, end_bytes)
+        if index < len(self.sent_times):
+            self.result['latencies'].append(received_at - self.sent_times[index])
+
+    async def send_events(self, send_config, send_audio):
+        """
+        Sends the config messages and audio frames of the session at their times, then
+        waits for the end of the session.
+
+        Args:
+            send_config (Callable): Sends the data of a config message, returns an awaitable.
+            send_audio (Callable): Sends an audio frame, returns an awaitable.
+        """
+        loop = asyncio.get_running_loop()
+        for seconds, kind, size, payload in self.session['events']:
+            await self.sleep_until(seconds)
+            if kind == CONFIG:
+                config = json.loads(payload)
+                if 'stream_offset_seconds' in config:
+                    self.offset_bytes = (int(config['stream_offset_seconds'] * self.session['sampling_rate'])
+                                         * self.session['samples_width'])
+                    self.sent_ends, self.sent_times = [], []
+                await send_config(config)
+            elif kind == AUDIO:
+                await send_audio(payload if payload else self.fill_audio.take(size))
+                self.sent_ends.append((self.sent_ends[-1] if self.sent_ends else 0) + size)
+                self.sent_times.append(loop.time())
+        await self.sleep_until(self.session['close_seconds'])
+
+    async def drain(self, receiver, drain_seconds):
+        """
+        Waits until no message came for the session for `drain_seconds`, or `receiver`, the
+        task receiving the messages of the connection, ended.
+        """
+        while not receiver.done():
+            self.received.clear()
+            try:
+                await asyncio.wait_for(self.received.wait(), drain_seconds)
+            except asyncio.TimeoutError:
+                break
+
+
+def mux_url(url):
+    """
+    Returns the URL of the multiplexed endpoint of the server at a WebSocket URL.
+    """
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit(parts._replace(path=parts.path.rstrip('/') + '/mux'))
+
+
+async def replay_session(url, session, started_at, speedup=1.0, fill_audio=None, drain_seconds=5.0):
+    """
+    Replays one captured session against a server, see SessionReplay. After the
+    captured session ended, the connection stays open until no message came for
+    `drain_seconds`.
+
+    Args:
+        url (str): The WebSocket URL of the server.
+        session (dict): The session, as read by read_capture().
+        started_at (float): Event loop time the replay started at, the start of the capture.
+        speedup (float): How many times faster than captured the session is replayed.
+        fill_audio (SyntheticAudio): Audio sent for frames captured without their audio.
+
+    Returns:
+        dict: The 'session', its transcription 'latencies', 'segments' received and 'error' if it failed.
+    """
+    replay = SessionReplay(session, started_at, speedup, fill_audio)
+
+    async def receive(websocket):
+        try:
+            async for message in websocket:
+                replay.receive(json.loads(message))
+        except websockets.ConnectionClosedError as e:
+            replay.result['error'] = repr(e)
+
+    await replay.sleep_until(session['open_seconds'])
+    try:
+        async with websockets.connect(url, max_size=None) as websocket:
+            receiver = asyncio.ensure_future(receive(websocket))
+            await replay.send_events(lambda config: websocket.send(json.dumps({"type": "config", "data": config})),
+                                     websocket.send)
+            await replay.drain(receiver, drain_seconds)
+            receiver.cancel()
+    except (OSError, websockets.WebSocketException) as e:
+        replay.result['error'] = repr(e)
+    return replay.result
+
+
+async def replay_connection(url, sessions, started_at, speedup=1.0, fill_audio=None, drain_seconds=5.0):
+    """
+    Replays the captured streams of one multiplexed connection over one connection
+    to the `/mux` endpoint of a server, see replay_session(). The connection opens
+    with the first stream and closes after the last one. Every stream is opened, sent
+    and, once drained, closed at its original times, with its index as stream id.
+
+    Args:
+        sessions (List[dict]): The streams of the connection, as read by read_capture().
+        See replay_session() for the others.
+
+    Returns:
+        List[dict]: The result of every stream, see replay_session().
+    """
+    replays = [SessionReplay(session, started_at, speedup, fill_audio) for session in sessions]
+
+    async def receive(websocket):
+        try:
+            async for message in websocket:
+                message = json.loads(message)
+                stream_id = message.get('stream_id')
+                if isinstance(stream_id, int) and 0 <= stream_id < len(replays):
+                    replays[stream_id].receive(message)
+        except websockets.ConnectionClosedError as e:
+            for replay in replays:
+                replay.result['error'] = repr(e)
+
+    async def replay_stream(websocket, receiver, stream_id, replay):
+        def send_config(config, action="update"):
+            return websocket.send(json.dumps({"type": "config", "stream_id": stream_id, "action": action,
+                                              "data": config}))
+
+        await replay.sleep_until(replay.session['open_seconds'])
+        await send_config({}, action="open")
+        await replay.send_events(send_config, lambda audio: websocket.send(encode_frame(stream_id, audio)))
+        await replay.drain(receiver, drain_seconds)
+        if not receiver.done():
+            await send_config({}, action="close")
+
+    await replays[0].sleep_until(min(session['open_seconds'] for session in sessions))
+    try:
+        async with websockets.connect(mux_url(url), max_size=None) as websocket:
+            receiver = asyncio.ensure_future(receive(websocket))
+            outcomes = await asyncio.gather(*[replay_stream(websocket, receiver, stream_id, replay)
+                                              for stream_id, replay in enumerate(replays)], return_exceptions=True)
+            receiver.cancel()
+            for replay, outcome in zip(replays, outcomes):
+                if isinstance(outcome, Exception):
+                    replay.result['error'] = repr(outcome)
+    except (OSError, websockets.WebSocketException) as e:
+        for replay in replays:
+            replay.result['error'] = repr(e)
+    return [replay.result for replay in replays]
+
+
+async def replay_capture(path, url, speedup=1.0, fill_audio_path=None, drain_seconds=5.0, max_sessions=None):
+    """
+    Replays the sessions of a capture file against a server, with their original
+    timing and therefore their original concurrency. Streams captured on the same
+    multiplexed connection are replayed over one connection to `/mux`.
+
+    Returns:
+        dict: The run, with the latency summary of its transcriptions and the latencies of every session.
+    """
+    sessions = read_capture(path)[:max_sessions]
+    fill_audio = SyntheticAudio(fill_audio_path)
+    connections = {}
+    for session in sessions:
+        if session['connection'] is not None:
+            connections.setdefault(session['connection'], []).append(session)
+    logger.info(f"Replaying {len(sessions)} sessions of {path}, {len(connections)} multiplexed connections, "
+                f"against {url} at {speedup}x")
+
+    started_at = asyncio.get_running_loop().time()
+    wall_start = time.monotonic()
+    replays = [replay_session(url, session, started_at, speedup, fill_audio, drain_seconds)
+               for session in sessions if session['connection'] is None]
+    replays += [replay_connection(url, streams, started_at, speedup, fill_audio, drain_seconds)
+                for streams in connections.values()]
+    results = []
+    for result in await asyncio.gather(*replays):
+        results += result if isinstance(result, list) else [result]
+    results.sort(key=lambda result: result['session'])
+
+    latencies = [latency for result in results for latency in result['latencies']]
+    return {
+        "capture": path,
+        "url": url,
+        "speedup": speedup,
+        "sessions": len(results),
+        "multiplexed_connections": len(connections),
+        "failed_sessions": sum(1 for result in results if 'error' in result),
+        "transcriptions": sum(result['transcriptions'] for result in results),
+        "segments": sum(result['segments'] for result in results),
+        "wall_seconds": time.monotonic() - wall_start,
+        "latency_seconds": latency_summary(latencies),
+        "session_results": results,
+    }
+
+
+def compare_runs(baseline, candidate):
+    """
+    Compares the latencies of two replays of the same capture, e.g. before and after a change.
+
+    Returns:
+        dict: For every statistic, its 'baseline' and 'candidate' values, their
+            'difference' and the difference 'relative' to the baseline.
+    """
+    comparison = {}
+    statistics = [(name, baseline['latency_seconds'][name], candidate['latency_seconds'][name])
+                  for name in ("count", "mean", "p50", "p90", "p99", "max")]
+    statistics += [(name, baseline[name], candidate[name]) for name in ("transcriptions", "failed_sessions")]
+    for name, baseline_value, candidate_value in statistics:
+        difference = None
+        relative = None
+        if baseline_value is not None and candidate_value is not None:
+            difference = candidate_value - baseline_value
+            relative = difference / baseline_value if baseline_value else None
+        comparison[name] = {"baseline": baseline_value, "candidate": candidate_value,
+                            "difference": difference, "relative": relative}
+    return comparison
+
+
+def run_replay(args):
+    results = asyncio.run(replay_capture(args.capture, args.url, speedup=args.speedup,
+                                         fill_audio_path=args.fill_audio, drain_seconds=args.drain_seconds,
+                                         max_sessions=args.max_sessions))
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    latency = results['latency_seconds']
+    print(f"Replayed {results['sessions']} sessions ({results['failed_sessions']} failed) in "
+          f"{results['wall_seconds']:.1f}s: {results['transcriptions']} transcriptions, latency "
+          f"p50 {latency['p50'] or 0:.3f}s, p99 {latency['p99'] or 0:.3f}s")
+    return results
+
+
+def run_compare(args):
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+    if (baseline['capture'], baseline['speedup']) != (candidate['capture'], candidate['speedup']):
+        logger.warning("The runs did not replay the same capture at the same speed")
+    comparison = compare_runs(baseline, candidate)
+    print(f"{'':<16}{'baseline':>12}{'candidate':>12}{'difference':>12}{'relative':>10}")
+    for name, values in comparison.items():
+        cells = ["-" if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+                 for value in (values['baseline'], values['candidate'], values['difference'])]
+        relative = "-" if values['relative'] is None else f"{values['relative']:+.1%}"
+        print(f"{name:<16}{cells[0]:>12}{cells[1]:>12}{cells[2]:>12}{relative:>10}")
+    return comparison
+
+
+def add_replay_arguments(parser):
+    parser.add_argument("capture", type=str, help="Capture file recorded with CAPTURE_ENABLED")
+    parser.add_argument("--url", type=str, default="ws://localhost:8000", help="WebSocket URL of the deployment to replay against")
+    parser.add_argument("--output", type=str, required=True, help="JSON file the results of the run are written to")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Replay this many times faster than captured")
+    parser.add_argument("--fill-audio", type=str, default=None, help="Audio file played in a loop for frames captured without audio; silence by default")
+    parser.add_argument("--drain-seconds", type=float, default=5.0, help="How long a session waits for more transcriptions after its end")
+    parser.add_argument("--max-sessions", type=int, default=None, help="Only replay the first sessions of the capture")
+
+
+def add_compare_arguments(parser):
+    parser.add_argument("baseline", type=str, help="Results of the baseline run")
+    parser.add_argument("candidate", type=str, help="Results of the run compared to the baseline")
@@ -0,0 +1,3 @@
+from .pool import ConnectionPool, PooledConnection
+from .sources import file_chunks, load_audio_file, paced, pcm_chunks
+from .stream import StreamError, TranscriptionStream
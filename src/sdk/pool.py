@@ -0,0 +1,264 @@
+import asyncio
+import json
+import logging
+
+import websockets
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+from src.multiplexing import encode_frame
+from .sources import pcm_chunks
+from .stream import StreamError, TranscriptionStream
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """
+    A multiplexed connection to the /mux route of the server, shared by many streams.
+
+    Sends and reconnects happen under one lock, so that after a reconnect every
+    stream is reopened and its unacknowledged audio is resent before any new audio.
+
+    Attributes:
+        url (str): The URL of the /mux route.
+        streams (dict): The open streams, by stream id.
+        websocket: The current websocket, None until connected.
+        reconnect_attempts (int): Connection attempts before the streams fail.
+        reconnect_backoff_seconds (float): Delay before the second attempt, doubled for every further attempt.
+    """
+
+    def __init__(self, url, reconnect_attempts=5, reconnect_backoff_seconds=0.5, **connect_kwargs):
+        self.url = url
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_backoff_seconds = reconnect_backoff_seconds
+        self.connect_kwargs = connect_kwargs
+        self.streams = {}
+        self.next_stream_id = 0
+        self.websocket = None
+        self.receiver = None
+        self.lock = asyncio.Lock()
+        self.closing = False
+
+    def add_stream(self, **kwargs):
+        stream = TranscriptionStream(self, self.next_stream_id, **kwargs)
+        self.next_stream_id = (self.next_stream_id + 1) % 2 ** 32
+        self.streams[stream.stream_id] = stream
+        return stream
+
+    def remove_stream(self, stream):
+        self.streams.pop(stream.stream_id, None)
+
+    async def open_stream(self, stream):
+        await self.send(json.dumps(stream.open_message()))
+
+    async def close_stream(self, stream):
+        async with self.lock:
+            if self.websocket is None:
+                # Nothing is open on the server
+                self.remove_stream(stream)
+                stream.end()
+                return
+            try:
+                await self.websocket.send(json.dumps({"type": "config", "stream_id": stream.stream_id, "action": "close"}))
+            except ConnectionClosed:
+                self.remove_stream(stream)
+                stream.end()
+
+    async def send_audio(self, stream, audio_data):
+        await self.send(encode_frame(stream.stream_id, audio_data))
+
+    async def send(self, message):
+        """
+        Sends a message, reconnecting first if needed.
+
+        A message lost with a dropped connection is not sent again as is: the
+        reconnect reopens the streams and resends their unacknowledged audio.
+        """
+        async with self.lock:
+            if self.websocket is None:
+                # Opening the streams and resending their audio covers the message
+                await self.reconnect()
+                return
+            try:
+                await self.websocket.send(message)
+            except ConnectionClosed as e:
+                logger.warning(f"Connection to {self.url} lost while sending: {e}")
+                await self.reconnect()
+
+    async def reconnect(self):
+        """
+        (Re)connects, then reopens every stream at its resend position and resends
+        its unacknowledged audio. Must be called with the lock held.
+
+        Raises:
+            ConnectionError: If every attempt failed; the streams are failed as well.
+        """
+        if self.websocket is not None:
+            await self.websocket.close()
+            self.websocket = None
+
+        error = None
+        for attempt in range(self.reconnect_attempts):
+            if attempt > 0:
+                await asyncio.sleep(self.reconnect_backoff_seconds * 2 ** (attempt - 1))
+            for stream in [stream for stream in self.streams.values() if stream.closing]:
+                self.remove_stream(stream)
+                stream.end()
+            try:
+                websocket = await websockets.connect(self.url, **self.connect_kwargs)
+                for stream in list(self.streams.values()):
+                    await websocket.send(json.dumps(stream.open_message(resume=True)))
+                    for _, chunk in stream.unacknowledged:
+                        await websocket.send(encode_frame(stream.stream_id, chunk))
+                break
+            except (OSError, WebSocketException) as e:
+                logger.warning(f"Connection attempt {attempt + 1} to {self.url} failed: {e}")
+                error = e
+        else:
+            for stream in list(self.streams.values()):
+                stream.fail(StreamError(f"Could not reconnect to {self.url}: {error}"))
+            self.streams.clear()
+            raise ConnectionError(f"Could not connect to {self.url}") from error
+
+        self.websocket = websocket
+        self.receiver = asyncio.create_task(self.receive(websocket))
+
+    async def receive(self, websocket):
+        """
+        Dispatches the messages of the connection to their streams, and
+        reconnects when the connection drops while streams are open.
+        """
+        try:
+            async for message in websocket:
+                self.dispatch(json.loads(message))
+        except ConnectionClosed as e:
+            logger.warning(f"Connection to {self.url} lost: {e}")
+
+        async with self.lock:
+            if self.websocket is websocket and not self.closing:
+                self.websocket = None
+                if self.streams:
+                    try:
+                        await self.reconnect()
+                    except ConnectionError:
+                        logger.exception(f"Giving up on {self.url}")
+
+    def dispatch(self, message):
+        stream = self.streams.get(message.get("stream_id"))
+        if stream is None:
+            if message.get("type") == "error":
+                logger.error(f"Error from {self.url}: {message.get('message')}")
+            return
+        message_type = message.get("type")
+        if message_type == "closed":
+            self.remove_stream(stream)
+            stream.end()
+        elif message_type == "error":
+            self.remove_stream(stream)
+            stream.fail(StreamError(message.get("message")))
+        else:
+            stream.acknowledge(message)
+
+    async def close(self):
+        self.closing = True
+        for stream in list(self.streams.values()):
+            await stream.close()
+        async with self.lock:
+            if self.websocket is not None:
+                await self.websocket.close()
+                self.websocket = None
+        if self.receiver is not None:
+            await asyncio.gather(self.receiver, return_exceptions=True)
+
+
+class ConnectionPool:
+    """
+    Asyncio client of the transcription server, for backend services.
+
+    Streams are multiplexed over a pool of reusable connections to the /mux route
+    of the server, so that opening a stream costs one message instead of a
+    connection and TLS handshake. Connections are opened on first use and
+    re-established transparently, see TranscriptionStream.
+
+    Example:
+        async with ConnectionPool("ws://localhost:8000/mux") as pool:
+            async for transcription in pool.transcribe(file_chunks("call.wav")):
+                print(transcription["text"])
+
+    Attributes:
+        url (str): The URL of the /mux route.
+        size (int): Maximum number of connections.
+        connections (list): The pooled connections.
+    """
+
+    def __init__(self, url, size=4, max_resend_seconds=30.0, sampling_rate=16000, samples_width=2, **connection_kwargs):
+        """
+        Args:
+            url (str): The URL of the /mux route, e.g. "ws://localhost:8000/mux".
+            size (int): Maximum number of connections.
+            max_resend_seconds (float): Unacknowledged audio kept per stream for resending after a reconnect.
+            sampling_rate (int): The sampling rate of the audio in Hz.
+            samples_width (int): The width of each audio sample in bytes.
+            **connection_kwargs: Arguments of PooledConnection, e.g. reconnect_attempts,
+                and keyword arguments of websockets.connect().
+        """
+        self.url = url
+        self.size = size
+        self.max_resend_seconds = max_resend_seconds
+        self.sampling_rate = sampling_rate
+        self.samples_width = samples_width
+        self.connections = [PooledConnection(url, **connection_kwargs) for _ in range(size)]
+
+    async def open_stream(self, config=None):
+        """
+        Opens a stream on the connection with the fewest streams.
+
+        Args:
+            config (dict): The stream configuration, e.g. the processing strategy and its arguments.
+
+        Returns:
+            TranscriptionStream: The stream; send audio to it and iterate over it for transcriptions.
+        """
+        connection = min(self.connections, key=lambda connection: (len(connection.streams), connection.websocket is None))
+        stream = connection.add_stream(config=config, max_resend_seconds=self.max_resend_seconds,
+                                       sampling_rate=self.sampling_rate, samples_width=self.samples_width)
+        try:
+            await connection.open_stream(stream)
+        except ConnectionError:
+            connection.remove_stream(stream)
+            raise
+        return stream
+
+    async def transcribe(self, audio, config=None, **finish_kwargs):
+        """
+        Streams audio and yields its transcriptions as they arrive.
+
+        Args:
+            audio: Raw PCM bytes, or an iterable or async iterable of PCM chunks,
+                e.g. from file_chunks() or paced().
+            config (dict): The stream configuration.
+            **finish_kwargs: Arguments of TranscriptionStream.finish().
+
+        Yields:
+            dict: The transcriptions, in order.
+        """
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio = pcm_chunks(audio, sampling_rate=self.sampling_rate, samples_width=self.samples_width)
+        stream = await self.open_stream(config)
+        sender = asyncio.create_task(stream.send_all(audio, **finish_kwargs))
+        try:
+            async for transcription in stream:
+                yield transcription
+            await sender
+        finally:
+            sender.cancel()
+            await stream.close()
+
+    async def close(self):
+        await asyncio.gather(*[connection.close() for connection in self.connections])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,84 @@
+import asyncio
+import time
+import wave
+
+
+def pcm_chunks(audio_data, chunk_seconds=0.25, sampling_rate=16000, samples_width=2):
+    """
+    Splits raw PCM audio into chunks of `chunk_seconds`.
+
+    Args:
+        audio_data (bytes): Mono PCM audio at the sampling rate of the server.
+        chunk_seconds (float): Duration of each chunk.
+        sampling_rate (int): The sampling rate of the audio in Hz.
+        samples_width (int): The width of each audio sample in bytes.
+
+    Yields:
+        bytes: The chunks, the last one may be shorter.
+    """
+    chunk_length = int(chunk_seconds * sampling_rate) * samples_width
+    for start in range(0, len(audio_data), chunk_length):
+        yield bytes(audio_data[start:start + chunk_length])
+
+
+def load_audio_file(path, sampling_rate=16000, samples_width=2):
+    """
+    Loads an audio file as mono PCM audio at the sampling rate of the server.
+
+    WAV files already in that format are read with the standard library; other
+    files are converted with pydub, which must then be installed.
+
+    Returns:
+        bytes: The PCM audio.
+    """
+    try:
+        with wave.open(str(path), 'rb') as file:
+            if (file.getnchannels(), file.getframerate(), file.getsampwidth()) == (1, sampling_rate, samples_width):
+                return file.readframes(file.getnframes())
+    except (wave.Error, EOFError):
+        pass
+
+    try:
+        from pydub import AudioSegment
+    except ImportError as e:
+        raise ValueError(f"{path} is not a mono {sampling_rate} Hz WAV file, converting it needs pydub") from e
+    audio = AudioSegment.from_file(str(path))
+    return audio.set_channels(1).set_frame_rate(sampling_rate).set_sample_width(samples_width).raw_data
+
+
+def file_chunks(path, chunk_seconds=0.25, sampling_rate=16000, samples_width=2):
+    """
+    Loads an audio file and splits it into chunks, see load_audio_file() and pcm_chunks().
+    """
+    return pcm_chunks(load_audio_file(path, sampling_rate, samples_width), chunk_seconds, sampling_rate, samples_width)
+
+
+async def paced(chunks, sampling_rate=16000, samples_width=2):
+    """
+    Yields audio chunks no faster than real time, e.g. to replay a file as if it
+    were a live stream. The pace follows the audio duration sent so far, so slow
+    consumers do not make it drift.
+
+    Args:
+        chunks: An iterable or async iterable of PCM chunks.
+    """
+    start = time.monotonic()
+    sent_seconds = 0.0
+    async for chunk in iterate(chunks):
+        delay = start + sent_seconds - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield chunk
+        sent_seconds += len(chunk) / (sampling_rate * samples_width)
+
+
+async def iterate(chunks):
+    """
+    Iterates over an iterable or an async iterable of chunks.
+    """
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
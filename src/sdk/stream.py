@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .sources import iterate
+
+logger = logging.getLogger(__name__)
+
+# Ends the transcription iterator of a stream
+_END_OF_STREAM = object()
+
+
+class StreamError(RuntimeError):
+    """
+    The server rejected a stream, or its connection could not be re-established.
+    """
+
+
+class TranscriptionStream:
+    """
+    One audio stream multiplexed over a pooled connection.
+
+    Audio is kept until a transcription acknowledges it, i.e. until a transcription
+    ends after it in the stream. When the connection drops, the pool reconnects,
+    reopens the stream at the oldest unacknowledged position and resends the audio
+    from there; the server cancelled the work on it and transcribes it again.
+
+    Iterating over the stream yields its transcriptions, in order.
+
+    Attributes:
+        stream_id (int): The id of the stream on its connection.
+        config (dict): The stream configuration sent to the server.
+        sent_bytes (int): Audio bytes sent so far.
+        acknowledged_bytes (int): Stream position up to which audio was acknowledged.
+        unacknowledged (deque): The (stream position, chunk) pairs kept for resending.
+        max_resend_bytes (int): Maximum audio kept for resending; older audio is lost on reconnect.
+    """
+
+    def __init__(self, connection, stream_id, config=None, max_resend_seconds=30.0,
+                 sampling_rate=16000, samples_width=2):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.config = dict(config or {})
+        self.sampling_rate = sampling_rate
+        self.samples_width = samples_width
+        self.bytes_per_second = sampling_rate * samples_width
+        self.max_resend_bytes = int(max_resend_seconds * self.bytes_per_second)
+        self.sent_bytes = 0
+        self.acknowledged_bytes = 0
+        self.unacknowledged = deque()
+        self.unacknowledged_bytes = 0
+        self.transcriptions = asyncio.Queue()
+        self.progress = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.finished = False
+        self.closing = False
+
+    @property
+    def resend_offset_bytes(self):
+        """
+        Stream position of the oldest audio kept for resending.
+        """
+        if self.unacknowledged:
+            return self.unacknowledged[0][0]
+        return self.sent_bytes
+
+    def open_message(self, resume=False):
+        """
+        The config message that opens the stream, at the resend position when resuming.
+        """
+        data = dict(self.config)
+        if resume:
+            data['stream_offset_seconds'] = self.resend_offset_bytes / self.bytes_per_second
+        return {"type": "config", "stream_id": self.stream_id, "action": "open", "data": data}
+
+    async def send(self, audio_data):
+        """
+        Sends a chunk of PCM audio, keeping it until it is acknowledged.
+        """
+        if self.finished:
+            raise StreamError(f"Stream {self.stream_id} is finished")
+        audio_data = bytes(audio_data)
+        self.unacknowledged.append((self.sent_bytes, audio_data))
+        self.unacknowledged_bytes += len(audio_data)
+        self.sent_bytes += len(audio_data)
+        while self.unacknowledged_bytes > self.max_resend_bytes:
+            _, dropped = self.unacknowledged.popleft()
+            self.unacknowledged_bytes -= len(dropped)
+        await self.connection.send_audio(self, audio_data)
+
+    async def send_all(self, chunks, **kwargs):
+        """
+        Sends every chunk of an iterable or async iterable of PCM audio, then finishes the stream.
+
+        Args:
+            chunks: The audio, e.g. from pcm_chunks(), file_chunks() or paced().
+            **kwargs: Arguments of finish().
+        """
+        async for chunk in iterate(chunks):
+            await self.send(chunk)
+        await self.finish(**kwargs)
+
+    def acknowledge(self, transcription):
+        """
+        Releases the audio that ends before the end of a transcription and queues it.
+        """
+        if 'stream_end_seconds' in transcription:
+            end_samples = int(round(transcription['stream_end_seconds'] * self.sampling_rate))
+            self.acknowledged_bytes = max(self.acknowledged_bytes, end_samples * self.samples_width)
+            while self.unacknowledged:
+                offset, chunk = self.unacknowledged.popleft()
+                self.unacknowledged_bytes -= len(chunk)
+                if offset + len(chunk) > self.acknowledged_bytes:
+                    # Keep only the part of the chunk after the transcription
+                    acknowledged = max(0, self.acknowledged_bytes - offset)
+                    self.unacknowledged.appendleft((offset + acknowledged, chunk[acknowledged:]))
+                    self.unacknowledged_bytes += len(chunk) - acknowledged
+                    break
+        self.transcriptions.put_nowait(transcription)
+        self.progress.set()
+
+    def fail(self, error):
+        self.transcriptions.put_nowait(error)
+        self.closed.set()
+
+    def end(self):
+        self.transcriptions.put_nowait(_END_OF_STREAM)
+        self.closed.set()
+
+    async def finish(self, trailing_silence_seconds=2.0, drain_timeout_seconds=3.0, close_timeout_seconds=5.0):
+        """
+        Ends the audio of the stream, waits for its last transcriptions and closes it.
+
+        The server does not know that the speaker is done, so silence is sent to
+        close the last utterance. The stream is then closed once every audio byte
+        was acknowledged, or when no transcription came for `drain_timeout_seconds`.
+
+        Args:
+            trailing_silence_seconds (float): Silence sent after the audio.
+            drain_timeout_seconds (float): How long to wait for a transcription before closing.
+            close_timeout_seconds (float): How long to wait for the server to confirm the close.
+        """
+        if self.finished:
+            return
+        audio_end_bytes = self.sent_bytes
+        if trailing_silence_seconds > 0:
+            await self.send(bytes(int(trailing_silence_seconds * self.sampling_rate) * self.samples_width))
+        self.finished = True
+
+        deadline = time.monotonic() + drain_timeout_seconds
+        while self.acknowledged_bytes < audio_end_bytes and not self.closed.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.progress.clear()
+            try:
+                await asyncio.wait_for(self.progress.wait(), remaining)
+                deadline = time.monotonic() + drain_timeout_seconds
+            except asyncio.TimeoutError:
+                break
+        await self.close(close_timeout_seconds)
+
+    async def close(self, timeout_seconds=5.0):
+        """
+        Closes the stream; work the server still has in flight for it is cancelled.
+        """
+        self.finished = True
+        if self.closed.is_set():
+            return
+        self.closing = True
+        try:
+            await self.connection.close_stream(self)
+            await asyncio.wait_for(self.closed.wait(), timeout_seconds)
+        except (asyncio.TimeoutError, StreamError, ConnectionError):
+            logger.warning(f"Stream {self.stream_id} was not closed cleanly")
+        finally:
+            self.connection.remove_stream(self)
+            if not self.closed.is_set():
+                self.end()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.transcriptions.get()
+        if item is _END_OF_STREAM:
+            # Keep returning the end to later iterations
+            self.transcriptions.put_nowait(item)
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
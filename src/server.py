@@ -95,6 +95,7 @@ async def handle_websocket(websocket: WebSocket):
         logger.warn(f"Connection with {client_id} closed: {e}")
     finally:
         del tr_server.connected_clients[client_id]
+        client.close()
 
 
 if __name__ == "__main__":
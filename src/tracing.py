@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import queue
+import secrets
+import threading
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+
+def new_trace_context():
+    """
+    Creates the trace context of a new chunk or utterance.
+
+    The context is a plain dict so that it can travel with the client to the VAD
+    and ASR replicas. Its span id is the id of the root span of the trace.
+    """
+    return {"trace_id": secrets.token_hex(16), "span_id": secrets.token_hex(8)}
+
+
+class JsonlSpanExporter:
+    """
+    Appends finished spans to a local JSONL file, one OpenTelemetry-style span per line.
+
+    Spans are buffered and handed in batches to a writer thread, so the file is not
+    touched for every span and the event loop recording a span never waits on it.
+    The writer also takes the buffered spans once they are `flush_interval_seconds`
+    old, so the spans of an idle replica are written too.
+    Every process writes its own file; the files of all replicas can be
+    concatenated for offline analysis.
+
+    Attributes:
+        path (str): The file the spans are appended to.
+        batch_size (int): Number of spans buffered before they are written.
+        flush_interval_seconds (float): Maximum time a span stays buffered.
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval_seconds=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.spans = []
+        self.last_write = time.monotonic()
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.batches = queue.Queue()
+        self.writer = threading.Thread(target=self.run_writer, name="jsonl-span-writer", daemon=True)
+        self.writer.start()
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if (len(self.spans) < self.batch_size
+                    and time.monotonic() - self.last_write < self.flush_interval_seconds):
+                return
+            spans, self.spans = self.spans, []
+            self.last_write = time.monotonic()
+        self.batches.put(spans)
+
+    def flush(self):
+        """
+        Hands the buffered spans to the writer and waits until every batch is written.
+        """
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if spans:
+            self.batches.put(spans)
+        self.batches.join()
+
+    def run_writer(self):
+        while True:
+            try:
+                spans = self.batches.get(timeout=self.flush_interval_seconds)
+            except queue.Empty:
+                with self.lock:
+                    if not self.spans or time.monotonic() - self.last_write < self.flush_interval_seconds:
+                        continue
+                    spans, self.spans = self.spans, []
+                    self.last_write = time.monotonic()
+                # Queued, so that flush() waits for it like for any other batch
+                self.batches.put(spans)
+                continue
+            try:
+                self.write(spans)
+            except OSError:
+                logger.exception(f"Could not write {len(spans)} spans to {self.path}")
+            finally:
+                self.batches.task_done()
+
+    def write(self, spans):
+        with open(self.path, 'a') as file:
+            file.write(''.join(json.dumps(span) + '\n' for span in spans))
+
+
+class OpenTelemetrySpanExporter:
+    """
+    Re-creates the spans with the OpenTelemetry SDK, which exports them with the
+    OTLP exporter configured by the standard OTEL_EXPORTER_OTLP_* environment variables.
+
+    Requires the optional opentelemetry-sdk and opentelemetry-exporter-otlp packages.
+    """
+
+    def __init__(self, service_name):
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.id_generator import IdGenerator
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+        class RecordedIdGenerator(IdGenerator):
+            # Makes the SDK reuse the ids of the recorded span instead of drawing new ones
+            def __init__(self):
+                self.ids = threading.local()
+
+            def generate_span_id(self):
+                return self.ids.span_id
+
+            def generate_trace_id(self):
+                return self.ids.trace_id
+
+        self.trace = trace
+        self.id_generator = RecordedIdGenerator()
+        self.provider = TracerProvider(resource=Resource.create({"service.name": service_name}),
+                                       id_generator=self.id_generator)
+        self.provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self.tracer = self.provider.get_tracer(__name__)
+
+    def export(self, span):
+        trace = self.trace
+        parent = None
+        if span["parentSpanId"]:
+            parent = trace.set_span_in_context(trace.NonRecordingSpan(trace.SpanContext(
+                trace_id=int(span["traceId"], 16),
+                span_id=int(span["parentSpanId"], 16),
+                is_remote=True,
+                trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED))))
+        self.id_generator.ids.trace_id = int(span["traceId"], 16)
+        self.id_generator.ids.span_id = int(span["spanId"], 16)
+        otel_span = self.tracer.start_span(span["name"], context=parent, start_time=span["startTimeUnixNano"],
+                                           attributes=span["attributes"])
+        otel_span.end(end_time=span["endTimeUnixNano"])
+
+    def flush(self):
+        self.provider.force_flush()
+
+
+class Tracer:
+    """
+    Records the spans of a chunk as it goes through the ingress, VAD and ASR replicas.
+
+    Spans are OpenTelemetry-style dicts (traceId, spanId, parentSpanId, name,
+    start/end times in Unix nanoseconds and attributes). When no exporter is
+    configured, spans cost one attribute check.
+
+    Attributes:
+        exporter: Where finished spans go, or None to disable tracing.
+        attributes (dict): Attributes added to every span of this process, e.g. the replica.
+    """
+
+    def __init__(self, exporter=None, **attributes):
+        self.exporter = exporter
+        self.attributes = attributes
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def record(self, name, trace_context, start_time, end_time, root=False, **attributes):
+        """
+        Records a span measured by the caller.
+
+        Args:
+            name (str): The name of the span, e.g. 'asr.inference'.
+            trace_context (dict): The trace context of the chunk, see new_trace_context().
+            start_time (float): Start of the span, as returned by time.time().
+            end_time (float): End of the span, as returned by time.time().
+            root (bool): Whether this is the root span of the trace, which uses the span id of the context.
+            **attributes: Additional span attributes.
+        """
+        if self.exporter is None or trace_context is None:
+            return
+        self.exporter.export({
+            "traceId": trace_context["trace_id"],
+            "spanId": trace_context["span_id"] if root else secrets.token_hex(8),
+            "parentSpanId": None if root else trace_context["span_id"],
+            "name": name,
+            "startTimeUnixNano": int(start_time * 1e9),
+            "endTimeUnixNano": int(end_time * 1e9),
+            "attributes": dict(self.attributes, **attributes),
+        })
+
+    @contextmanager
+    def span(self, name, trace_context, **attributes):
+        """
+        Records the enclosed block as a child span of the root span of `trace_context`.
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, trace_context, start_time, time.time(), **attributes)
+
+    def flush(self):
+        if self.exporter is not None:
+            self.exporter.flush()
+
+
+_tracer = None
+
+
+def get_tracer(**attributes):
+    """
+    Returns the tracer of this process, creating it on first use from the
+    environment.
+
+    TRACING_EXPORTER selects the exporter: 'none' (default), 'jsonl' or 'otlp'.
+    TRACING_JSONL_DIR is the directory of the JSONL files, 'traces' by default.
+
+    Args:
+        **attributes: Attributes added to every span of the process, only used on first call.
+    """
+    global _tracer
+    if _tracer is not None:
+        return _tracer
+
+    exporter_type = os.environ.get('TRACING_EXPORTER', 'none').lower()
+    service_name = os.environ.get('OTEL_SERVICE_NAME', 'whisper-streaming')
+    exporter = None
+    if exporter_type == 'jsonl':
+        directory = os.environ.get('TRACING_JSONL_DIR', 'traces')
+        exporter = JsonlSpanExporter(os.path.join(directory, f"spans-{os.getpid()}.jsonl"))
+    elif exporter_type == 'otlp':
+        try:
+            exporter = OpenTelemetrySpanExporter(service_name)
+        except ImportError as e:
+            logger.error(f"TRACING_EXPORTER=otlp needs opentelemetry-sdk and opentelemetry-exporter-otlp, tracing is disabled: {e}")
+    elif exporter_type != 'none':
+        raise ValueError(f"Unknown tracing exporter type: {exporter_type}")
+
+    _tracer = Tracer(exporter, **{"service.name": service_name, "process.pid": os.getpid(), **attributes})
+    return _tracer
@@ -0,0 +1,82 @@
+import numpy as np
+
+from .vad_interface import VADInterface
+
+
+class EnergyVAD(VADInterface):
+    """
+    Frame-level energy-based implementation of the VADInterface.
+
+    Much less accurate than Pyannote, but cheap enough to classify every incoming
+    frame inline on the ingress. A frame is speech when its energy is more than
+    `threshold_db` above a running estimate of the noise floor.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Initializes the energy VAD.
+
+        Args:
+            frame_duration_seconds (float): Duration of the classified frames.
+            threshold_db (float): How far above the noise floor speech must be.
+            min_energy_db (float): Energy in dBFS below which a frame is never speech.
+            noise_adaptation (float): How fast the noise floor follows non-speech frames.
+            sampling_rate (int): The sampling rate of the audio in Hz.
+            samples_width (int): The width of each audio sample in bytes.
+        """
+        self.frame_duration_seconds = float(kwargs.get('frame_duration_seconds', 0.03))
+        self.threshold_db = float(kwargs.get('threshold_db', 12.0))
+        self.min_energy_db = float(kwargs.get('min_energy_db', -50.0))
+        self.noise_adaptation = float(kwargs.get('noise_adaptation', 0.05))
+        self.sampling_rate = int(kwargs.get('sampling_rate', 16000))
+        self.samples_width = int(kwargs.get('samples_width', 2))
+        self.frame_length_bytes = int(self.frame_duration_seconds * self.sampling_rate) * self.samples_width
+        self.noise_floor_db = None
+
+    def frame_energies(self, audio_data):
+        """
+        Computes the energy in dBFS of every complete frame of 16-bit PCM audio.
+        """
+        frame_count = len(audio_data) // self.frame_length_bytes
+        samples = np.frombuffer(audio_data, dtype=np.int16, count=frame_count * self.frame_length_bytes // 2)
+        frames = samples.reshape(frame_count, -1).astype(np.float32) / 32768.0
+        return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+
+    def classify(self, audio_data):
+        """
+        Classifies every complete frame of the audio as speech or not, updating the
+        noise floor as it goes. Trailing bytes that do not fill a frame are ignored.
+
+        Args:
+            audio_data (bytes): 16-bit PCM audio.
+
+        Returns:
+            List[bool]: Whether each frame is speech.
+        """
+        is_speech = []
+        for energy_db in self.frame_energies(audio_data):
+            if self.noise_floor_db is None or energy_db < self.noise_floor_db:
+                self.noise_floor_db = energy_db
+            speech = energy_db > max(self.noise_floor_db + self.threshold_db, self.min_energy_db)
+            if not speech:
+                self.noise_floor_db += self.noise_adaptation * (energy_db - self.noise_floor_db)
+            is_speech.append(bool(speech))
+        return is_speech
+
+    async def detect_activity(self, client):
+        detector = EnergyVAD(frame_duration_seconds=self.frame_duration_seconds,
+                             threshold_db=self.threshold_db,
+                             min_energy_db=self.min_energy_db,
+                             noise_adaptation=self.noise_adaptation,
+                             sampling_rate=client.sampling_rate,
+                             samples_width=client.samples_width)
+        vad_segments = []
+        previous_speech = False
+        for index, speech in enumerate(detector.classify(client.scratch_buffer)):
+            end = (index + 1) * detector.frame_duration_seconds
+            if speech and previous_speech:
+                vad_segments[-1]["end"] = end
+            elif speech:
+                vad_segments.append({"start": index * detector.frame_duration_seconds, "end": end, "confidence": 1.0})
+            previous_speech = speech
+        return vad_segments
@@ -1,14 +1,25 @@
 from os import remove
 import os
+import copy
+import time
+import asyncio
+from typing import List
 
+import numpy as np
+import torch
+import torch.nn.functional as F
 from pyannote.core import Segment
 from pyannote.audio import Model
 from pyannote.audio.pipelines import VoiceActivityDetection
 
 from .vad_interface import VADInterface
 from src.audio_utils import save_audio_to_file
+from src.introspection import replica_tag
+from src.tracing import get_tracer
+from src.weight_sharing import load_shared_module, report_model_load
 
 from ray import serve
+from ray.serve import metrics
 from ray.serve.handle import DeploymentHandle
 
 @serve.deployment(
@@ -18,6 +29,18 @@ from ray.serve.handle import DeploymentHandle
 class PyannoteVAD(VADInterface):
     """
     Pyannote-based implementation of the VADInterface.
+
+    Concurrent requests are batched: the audio of each request is cut into the
+    sliding windows of the segmentation model, the windows of all the requests of
+    a batch go through the model together, and each request aggregates and
+    binarizes its own outputs exactly like the pyannote pipeline does. The audio
+    is read from the client buffer instead of a WAV file.
+
+    Configured with the environment variables:
+        VAD_BATCHING_ENABLED: 'false' to run the pyannote pipeline on each request instead.
+        VAD_BATCH_MAX_SIZE: Maximum number of requests in a batch.
+        VAD_BATCH_WAIT_TIMEOUT_SECONDS: How long the first request of a batch waits for others.
+        VAD_BATCH_MAX_WINDOWS: Maximum number of windows in one forward pass.
     """
 
     def __init__(self, **kwargs):
@@ -39,18 +62,142 @@ class PyannoteVAD(VADInterface):
             raise ValueError("Missing required env var in PYANNOTE_AUTH_TOKEN or argument in --vad-args: 'auth_token'")
         
         pyannote_args = kwargs.get('pyannote_args', {"onset": 0.5, "offset": 0.5, "min_duration_on": 0.3, "min_duration_off": 0.3})
-        self.model = Model.from_pretrained(model_name, use_auth_token=auth_token)
+        start = time.time()
+        # With weight sharing, the replicas of a node map one copy of the weights
+        self.model = load_shared_module(f"pyannote-{model_name.replace('/', '--')}",
+                                        lambda: Model.from_pretrained(model_name, use_auth_token=auth_token))
+        report_model_load(model_name, time.time() - start)
         self.vad_pipeline = VoiceActivityDetection(segmentation=self.model)
         self.vad_pipeline.instantiate(pyannote_args)
+        self.tracer = get_tracer(replica=replica_tag())
+
+        self.batching_enabled = os.environ.get('VAD_BATCHING_ENABLED')
+        if not self.batching_enabled:
+            self.batching_enabled = kwargs.get('batching_enabled', True)
+        self.batching_enabled = str(self.batching_enabled).lower() == 'true'
+
+        max_batch_size = os.environ.get('VAD_BATCH_MAX_SIZE')
+        if not max_batch_size:
+            max_batch_size = kwargs.get('batch_max_size', 16)
+        self.infer_windows.set_max_batch_size(int(max_batch_size))
+
+        batch_wait_timeout_seconds = os.environ.get('VAD_BATCH_WAIT_TIMEOUT_SECONDS')
+        if not batch_wait_timeout_seconds:
+            batch_wait_timeout_seconds = kwargs.get('batch_wait_timeout_seconds', 0.01)
+        self.infer_windows.set_batch_wait_timeout_s(float(batch_wait_timeout_seconds))
+
+        self.segmentation = self.vad_pipeline._segmentation
+        self.max_windows = os.environ.get('VAD_BATCH_MAX_WINDOWS')
+        if not self.max_windows:
+            self.max_windows = kwargs.get('batch_max_windows', self.segmentation.batch_size)
+        self.max_windows = int(self.max_windows)
+        self.sample_rate = self.model.audio.sample_rate
+
+        self.batch_requests = metrics.Histogram(
+            "vad_batch_requests", description="Requests whose windows went through the model together.",
+            boundaries=[1, 2, 4, 8, 16, 32, 64])
+        self.batch_windows = metrics.Histogram(
+            "vad_batch_windows", description="Windows of a batch of requests.",
+            boundaries=[1, 4, 16, 32, 64, 128, 256, 512])
+
+    def __del__(self):
+        # Called by Ray Serve when the replica shuts down, writes the spans still buffered
+        get_tracer().flush()
 
     async def detect_activity(self, client):
-        audio_file_path = await save_audio_to_file(client.scratch_buffer, client.get_file_name())
-        vad_results = self.vad_pipeline(audio_file_path)
-        remove(audio_file_path)
+        start = time.time()
+        trace_context = getattr(client, 'trace_context', None)
+        if self.batching_enabled and client.sampling_rate == self.sample_rate and client.samples_width == 2:
+            with self.tracer.span("vad.inference", trace_context, batched=True):
+                vad_segments = await self.detect_activity_batched(client.scratch_buffer)
+            self.tracer.record("vad.replica", trace_context, start, time.time())
+            return vad_segments
+
+        with self.tracer.span("vad.file_io", trace_context, operation="write"):
+            audio_file_path = await save_audio_to_file(client.scratch_buffer, client.get_file_name())
+        with self.tracer.span("vad.inference", trace_context):
+            vad_results = self.vad_pipeline(audio_file_path)
+        with self.tracer.span("vad.file_io", trace_context, operation="remove"):
+            remove(audio_file_path)
         vad_segments = []
         if len(vad_results) > 0:
             vad_segments = [
                 {"start": segment.start, "end": segment.end, "confidence": 1.0}
                 for segment in vad_results.itersegments()
             ]
+        self.tracer.record("vad.replica", trace_context, start, time.time())
         return vad_segments
+
+    async def detect_activity_batched(self, audio):
+        """
+        Detects speech in 16-bit PCM audio at the sampling rate of the model, with
+        the windows batched together with those of concurrent requests.
+
+        Returns:
+            List: VAD result, a list of objects containing "start", "end", "confidence"
+        """
+        waveform = torch.from_numpy(np.frombuffer(bytes(audio), dtype=np.int16).astype(np.float32) / 32768.0)[None]
+        outputs = await self.infer_windows(self.windows(waveform))
+
+        # Let pyannote aggregate the overlapping windows as it would have, replaying
+        # the outputs of the batched forward passes in place of its own
+        segmentation = copy.copy(self.segmentation)
+        position = 0
+        def replay(chunks):
+            nonlocal position
+            chunk_outputs = outputs[position:position + len(chunks)]
+            position += len(chunks)
+            return chunk_outputs
+        segmentation.infer = replay
+        speech = self.vad_pipeline._binarize(segmentation.slide(waveform, self.sample_rate, hook=None))
+        return [
+            {"start": segment.start, "end": segment.end, "confidence": 1.0}
+            for segment in speech.itersegments()
+        ]
+
+    def windows(self, waveform):
+        """
+        Cuts a waveform into the windows that the pyannote Inference slides over it,
+        the last one padded with zeros.
+
+        Args:
+            waveform (torch.Tensor): The (1, num_samples) waveform.
+
+        Returns:
+            torch.Tensor: The (num_windows, 1, window_size) windows.
+        """
+        window_size = self.model.audio.get_num_samples(self.segmentation.duration)
+        step_size = round(self.segmentation.step * self.sample_rate)
+        _, num_samples = waveform.shape
+
+        windows = []
+        num_windows = 0
+        if num_samples >= window_size:
+            windows.append(waveform.unfold(1, window_size, step_size).permute(1, 0, 2))
+            num_windows = windows[0].shape[0]
+        if num_samples < window_size or (num_samples - window_size) % step_size > 0:
+            last_window = waveform[:, num_windows * step_size:]
+            windows.append(F.pad(last_window, (0, window_size - last_window.shape[1]))[None])
+        return torch.cat(windows)
+
+    @serve.batch(max_batch_size=16, batch_wait_timeout_s=0.01)
+    async def infer_windows(self, requests: List[torch.Tensor]) -> List[np.ndarray]:
+        """
+        Runs the windows of a batch of requests through the segmentation model together.
+
+        Args:
+            requests (List[torch.Tensor]): The windows of each request.
+
+        Returns:
+            List[np.ndarray]: The model outputs for the windows of each request.
+        """
+        windows = torch.cat(requests)
+        self.batch_requests.observe(len(requests))
+        self.batch_windows.observe(len(windows))
+        # The forward pass runs in a thread, so that the next batch fills up meanwhile
+        outputs = await asyncio.get_running_loop().run_in_executor(None, self.forward, windows)
+        return np.split(outputs, np.cumsum([len(request) for request in requests])[:-1])
+
+    def forward(self, windows):
+        return np.vstack([self.segmentation.infer(windows[i:i + self.max_windows])
+                          for i in range(0, len(windows), self.max_windows)])
@@ -1,4 +1,5 @@
 from .pyannote_vad import PyannoteVAD
+from .energy_vad import EnergyVAD
 
 class VADFactory:
     """
@@ -11,13 +12,16 @@ class VADFactory:
         Creates a VAD pipeline based on the specified type.
 
         Args:
-            type (str): The type of VAD pipeline to create (e.g., 'pyannote').
+            type (str): The type of VAD pipeline to create (e.g., 'pyannote', 'energy').
             kwargs: Additional arguments for the VAD pipeline creation.
 
         Returns:
             VADInterface: An instance of a class that implements VADInterface.
         """
         if type == "pyannote":
-            return PyannoteVAD(**kwargs)
+            # The class behind the deployment, to run the model outside Ray Serve
+            return PyannoteVAD.func_or_class(**kwargs)
+        elif type == "energy":
+            return EnergyVAD(**kwargs)
         else:
             raise ValueError(f"Unknown VAD pipeline type: {type}")
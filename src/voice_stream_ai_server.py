@@ -1,16 +1,27 @@
 import ray
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
 from ray import serve
+from ray.serve import metrics
 
 import websockets
+import os
+import hmac
 import uuid
 import json
 import asyncio
 import logging
 
 from src.audio_utils import save_audio_to_file
+from src.capture import TrafficCapture
 from src.client import Client
 from src.asr.faster_whisper_asr import FasterWhisperASR
+from src.asr.asr_scheduler import ASRScheduler
+from src.asr.hedged_asr import HedgedASR
+from src.asr.log_mel import StreamingLogMel
+from src.introspection import EventLoopLagMonitor, MemoryTracer
+from src.journal.journal import Journal
+from src.multiplexing import MultiplexedConnection, decode_frame
+from src.tracing import get_tracer
 from src.vad.pyannote_vad import PyannoteVAD
 
 logger = logging.getLogger("ray.serve")
@@ -39,13 +50,41 @@ class TranscriptionServer:
         connected_clients (dict): A dictionary mapping client IDs to Client objects.
     """
 
-    def __init__(self, asr_handle: DeploymentHandle, vad_handle = DeploymentHandle, sampling_rate=16000, samples_width=2):
+    def __init__(self, asr_handle: DeploymentHandle, vad_handle = DeploymentHandle, sampling_rate=16000, samples_width=2,
+                 asr_workers: DeploymentHandle = None):
 
         self.sampling_rate = sampling_rate
         self.samples_width = samples_width
         self.connected_clients = {}
-        self.asr_handle = asr_handle
+        if asr_workers is None:
+            self.asr_handle = HedgedASR(asr_handle)
+        else:
+            # asr_handle is an ASRScheduler that the ASR replicas pull chunks from.
+            # Hedging would queue every chunk twice; the scheduler sheds late chunks instead.
+            self.asr_handle = asr_handle
+        self.asr_workers = asr_workers
         self.vad_handle = vad_handle
+        get_tracer(deployment="TranscriptionServer")
+        self.event_loop_lag_monitor = EventLoopLagMonitor()
+        self.memory_tracer = MemoryTracer()
+        # Retains the audio and transcripts of every session when JOURNAL_ENABLED is 'true'
+        self.journal = Journal.from_environment()
+        # Records the timing of every session for src.replay when CAPTURE_ENABLED is 'true'
+        self.capture = TrafficCapture.from_environment()
+        # Computes the Whisper features of the audio as it arrives when set to the
+        # number of mel bins of the ASR model, 128 for large-v3 and 80 for the others
+        self.log_mel_bins = int(os.environ.get('INGEST_LOG_MEL_BINS', 0))
+        # The admin routes share the public port, so they also need a bearer token
+        self.admin_routes_enabled = os.environ.get('ADMIN_ROUTES_ENABLED', 'false').lower() == 'true'
+        self.admin_token = os.environ.get('ADMIN_TOKEN', '')
+        if self.admin_routes_enabled and not self.admin_token:
+            logger.warning("ADMIN_ROUTES_ENABLED is set without an ADMIN_TOKEN, the admin routes stay disabled")
+            self.admin_routes_enabled = False
+        self.max_streams_per_connection = int(os.environ.get('MUX_MAX_STREAMS_PER_CONNECTION', 1024))
+        self.cancelled_audio_seconds = metrics.Counter(
+            "transcription_cancelled_audio_seconds",
+            description="Seconds of received audio whose VAD/ASR processing was cancelled because the client disconnected.",
+        )
 
         from src.asr.asr_factory import ASRFactory
         from src.vad.vad_factory import VADFactory
@@ -58,14 +97,22 @@ class TranscriptionServer:
             message = await websocket.receive()
 
             if "bytes" in message.keys():
+                if self.capture is not None:
+                    self.capture.record_audio(client.client_id, message['bytes'])
                 client.append_audio_data(message['bytes'])
+                if self.journal is not None:
+                    await self.journal.record_audio(client.client_id, message['bytes'])
             # TODO: need to verify this case
             elif "text" in message.keys():
                 import json
 
                 config = json.loads(message['text'])
                 if config.get('type') == 'config':
+                    if self.capture is not None:
+                        self.capture.record_config(client.client_id, config['data'])
                     client.update_config(config['data'])
+                    if self.journal is not None:
+                        self.journal.record_event(client.client_id, "config", config['data'])
                     continue
             elif message["type"] == "websocket.disconnect":
                 raise WebSocketDisconnect
@@ -85,10 +132,10 @@ class TranscriptionServer:
     @fastapi_app.websocket("/")
     async def handle_websocket(self, websocket: WebSocket):
         await websocket.accept()
+        self.event_loop_lag_monitor.start()
 
         client_id = str(uuid.uuid4())
-        client = Client(client_id, self.sampling_rate, self.samples_width)
-        self.connected_clients[client_id] = client
+        client = self.open_client(client_id)
 
         logger.info(f"Client {client_id} connected")
 
@@ -97,7 +144,237 @@ class TranscriptionServer:
         except WebSocketDisconnect as e:
             logger.warn(f"Connection with {client_id} closed: {e}")
         finally:
-            del self.connected_clients[client_id]
+            self.close_client(client_id)
+
+    def open_client(self, client_id, connection_id=None, stream_id=None):
+        """
+        Registers a new client, and its session in the journal and the traffic capture if they are enabled.
+
+        Args:
+            client_id (str): The id of the client.
+            connection_id (str): The id of the multiplexed connection of the stream, None for other clients.
+            stream_id (int): The id of the stream on its multiplexed connection.
+        """
+        client = Client(client_id, self.sampling_rate, self.samples_width)
+        if self.log_mel_bins and (self.sampling_rate, self.samples_width) == (16000, 2):
+            client.log_mel = StreamingLogMel(self.log_mel_bins)
+        self.connected_clients[client_id] = client
+        if self.capture is not None:
+            self.capture.open_session(client_id, self.sampling_rate, self.samples_width, connection_id, stream_id)
+        if self.journal is not None:
+            self.journal.start()
+            client.journal = self.journal
+            self.journal.record_event(client_id, "open", client.config)
+        return client
+
+    def close_client(self, client_id):
+        """
+        Forgets a disconnected client and cancels its work in flight.
+
+        Returns:
+            float: Seconds of received audio that will not be transcribed.
+        """
+        client = self.connected_clients.pop(client_id)
+        if self.capture is not None:
+            self.capture.close_session(client_id)
+        cancelled_seconds = client.close()
+        if cancelled_seconds > 0:
+            self.cancelled_audio_seconds.inc(cancelled_seconds)
+            logger.info(f"Cancelled {cancelled_seconds:.2f}s of audio from {client_id}")
+        if self.journal is not None:
+            self.journal.end_session(client_id, cancelled_audio_seconds=cancelled_seconds)
+        return cancelled_seconds
+
+    async def handle_multiplexed_audio(self, connection_id, connection: MultiplexedConnection, streams):
+        websocket = connection.websocket
+        while True:
+            message = await websocket.receive()
+
+            if message.get("bytes") is not None:
+                try:
+                    stream_id, audio_data = decode_frame(message['bytes'])
+                except ValueError as e:
+                    logger.error(f"Invalid frame from {connection_id}: {e}")
+                    continue
+                if stream_id not in streams:
+                    await connection.send_json({"type": "error", "stream_id": stream_id, "message": "Stream is not open"})
+                    continue
+                client, stream_websocket = streams[stream_id]
+                if self.capture is not None:
+                    self.capture.record_audio(client.client_id, audio_data)
+                client.append_audio_data(audio_data)
+                if self.journal is not None:
+                    await self.journal.record_audio(client.client_id, audio_data)
+                client.process_audio(stream_websocket, self.vad_handle, self.asr_handle)
+            elif message.get("text") is not None:
+                # A bad message only fails itself, not the other streams of the connection
+                try:
+                    config = json.loads(message['text'])
+                    if not isinstance(config, dict):
+                        raise ValueError("not a JSON object")
+                except ValueError as e:
+                    await connection.send_json({"type": "error", "message": f"Invalid config message: {e}"})
+                    continue
+                if config.get('type') == 'config':
+                    await self.configure_stream(connection_id, connection, streams, config)
+            elif message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect
+            else:
+                logger.error(f"Unexpected message type from {connection_id}")
+
+    async def configure_stream(self, connection_id, connection: MultiplexedConnection, streams, config):
+        """
+        Opens, reconfigures or closes a stream of a multiplexed connection.
+
+        Args:
+            connection_id (str): The id of the connection.
+            connection (MultiplexedConnection): The connection.
+            streams (dict): The open streams of the connection, mapping stream ids to their client and websocket.
+            config (dict): The config message, with its stream_id, action ('open', 'update' or 'close';
+                by default the stream is opened if needed and updated) and data.
+        """
+        stream_id = config.get('stream_id')
+        action = config.get('action')
+        if not isinstance(stream_id, int):
+            await connection.send_json({"type": "error", "message": "Config message without an integer stream_id"})
+            return
+
+        if action == 'close':
+            if stream_id in streams:
+                client, _ = streams.pop(stream_id)
+                cancelled_seconds = self.close_client(client.client_id)
+                await connection.send_json({"type": "closed", "stream_id": stream_id,
+                                            "cancelled_audio_seconds": cancelled_seconds})
+            return
+
+        if stream_id not in streams:
+            if action == 'update':
+                await connection.send_json({"type": "error", "stream_id": stream_id, "message": "Stream is not open"})
+                return
+            if len(streams) >= self.max_streams_per_connection:
+                await connection.send_json({"type": "error", "stream_id": stream_id,
+                                            "message": f"Too many open streams, the limit is {self.max_streams_per_connection}"})
+                return
+            client_id = f"{connection_id}/{stream_id}"
+            client = self.open_client(client_id, connection_id, stream_id)
+            streams[stream_id] = (client, connection.stream(stream_id))
+            logger.info(f"Stream {client_id} opened")
+        if config.get('data'):
+            client = streams[stream_id][0]
+            if self.capture is not None:
+                self.capture.record_config(client.client_id, config['data'])
+            try:
+                client.update_config(config['data'])
+            except (TypeError, ValueError) as e:
+                logger.error(f"Invalid config for stream {client.client_id}: {e!r}")
+                await connection.send_json({"type": "error", "stream_id": stream_id, "message": f"Invalid config: {e}"})
+                return
+            if self.journal is not None:
+                self.journal.record_event(client.client_id, "config", config['data'])
+
+    @fastapi_app.websocket("/mux")
+    async def handle_multiplexed_websocket(self, websocket: WebSocket):
+        """
+        Serves many audio streams over one connection, e.g. all the call legs of a
+        gateway, with one receive loop.
+
+        Binary frames start with the stream id as a 32-bit unsigned big-endian
+        integer, followed by the audio of that stream. Config messages carry a
+        stream_id and open, reconfigure or close the stream. Each stream has its own
+        Client and buffering state, and its transcriptions are tagged with its stream_id.
+        """
+        await websocket.accept()
+        self.event_loop_lag_monitor.start()
+
+        connection_id = str(uuid.uuid4())
+        connection = MultiplexedConnection(websocket)
+        streams = {}
+
+        logger.info(f"Multiplexed connection {connection_id} connected")
+
+        try:
+            await self.handle_multiplexed_audio(connection_id, connection, streams)
+        except WebSocketDisconnect as e:
+            logger.warn(f"Multiplexed connection {connection_id} closed: {e}")
+        finally:
+            for client, _ in streams.values():
+                self.close_client(client.client_id)
+            if self.capture is not None:
+                self.capture.close_connection(connection_id)
+
+    async def __del__(self):
+        # Called by Ray Serve when the replica shuts down
+        if self.journal is not None:
+            await self.journal.close()
+        if self.capture is not None:
+            await self.capture.close()
+        # The spans still buffered would be lost with the writer thread
+        await asyncio.get_running_loop().run_in_executor(None, get_tracer().flush)
+
+    def check_admin_routes_enabled(self, authorization):
+        """
+        Rejects admin requests unless the routes are enabled and the request carries the admin token.
+
+        Args:
+            authorization (str): The Authorization header of the request, 'Bearer <ADMIN_TOKEN>'.
+        """
+        if not self.admin_routes_enabled:
+            raise HTTPException(status_code=404)
+        if not hmac.compare_digest((authorization or '').encode(), f"Bearer {self.admin_token}".encode()):
+            raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+
+    @fastapi_app.get("/admin/connections")
+    async def list_connections(self, authorization: str = Header(None)):
+        """
+        Lists the connected clients with their buffer sizes and the VAD/ASR requests
+        they have in flight, with their age.
+        """
+        self.check_admin_routes_enabled(authorization)
+        connections = [client.stats() for client in self.connected_clients.values()]
+        return {
+            "connections": len(connections),
+            "buffered_bytes": sum(c["buffer_bytes"] + c["scratch_buffer_bytes"] for c in connections),
+            "clients": connections,
+        }
+
+    @fastapi_app.get("/admin/event-loop")
+    async def event_loop_lag(self, authorization: str = Header(None)):
+        """
+        Reports how far behind schedule the ingress event loop runs.
+        """
+        self.check_admin_routes_enabled(authorization)
+        self.event_loop_lag_monitor.start()
+        return self.event_loop_lag_monitor.stats()
+
+    @fastapi_app.post("/admin/tracemalloc/start")
+    async def start_tracemalloc(self, frames: int = 1, authorization: str = Header(None)):
+        self.check_admin_routes_enabled(authorization)
+        self.memory_tracer.start(frames)
+        return {"tracing": True}
+
+    @fastapi_app.post("/admin/tracemalloc/stop")
+    async def stop_tracemalloc(self, authorization: str = Header(None)):
+        self.check_admin_routes_enabled(authorization)
+        self.memory_tracer.stop()
+        return {"tracing": False}
+
+    @fastapi_app.get("/admin/tracemalloc/snapshot")
+    async def tracemalloc_snapshot(self, limit: int = 20, group_by: str = "lineno",
+                                   authorization: str = Header(None)):
+        """
+        Returns the top allocation sites of this replica, and their growth since the
+        previous snapshot. Tracing must have been started first.
+        """
+        self.check_admin_routes_enabled(authorization)
+        try:
+            return self.memory_tracer.top(limit, group_by)
+        except (RuntimeError, ValueError) as e:
+            raise HTTPException(status_code=409, detail=str(e))
 
 
 entrypoint = TranscriptionServer.bind(FasterWhisperASR.bind(), PyannoteVAD.bind())
+
+# ASR replicas pull chunks from a deadline-aware scheduler instead of being routed to
+asr_scheduler = ASRScheduler.bind()
+scheduled_entrypoint = TranscriptionServer.bind(asr_scheduler, PyannoteVAD.bind(),
+                                                asr_workers=FasterWhisperASR.bind(scheduler_handle=asr_scheduler))
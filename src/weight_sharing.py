@@ -0,0 +1,90 @@
+import os
+import fcntl
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger("ray.serve")
+
+
+def weight_sharing_dir():
+    """
+    Returns the node-local directory that model weights are staged in, or None
+    when weight sharing is disabled.
+
+    WEIGHT_SHARING_ENABLED turns it on ('false' by default). WEIGHT_SHARING_DIR is
+    the directory, '/dev/shm/whisper-streaming-weights' by default; it must be
+    shared by the replicas of a node, e.g. a memory-backed emptyDir in Kubernetes.
+    """
+    if os.environ.get('WEIGHT_SHARING_ENABLED', 'false').lower() != 'true':
+        return None
+    return os.environ.get('WEIGHT_SHARING_DIR', '/dev/shm/whisper-streaming-weights')
+
+
+@contextmanager
+def node_lock(directory, name):
+    """
+    Holds an exclusive lock on `name` among the processes of the node, so that only
+    the first replica to start saves the weights.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{name}.lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_shared_module(name, build):
+    """
+    Loads a PyTorch module whose weights are memory-mapped from a node-local file,
+    so that the replicas of a node share one read-only copy of them.
+
+    The first replica of the node builds the module and saves it; the others load
+    the saved module directly, without going through the Hugging Face cache. The
+    tensors are mapped copy-on-write, which inference never triggers.
+
+    Args:
+        name (str): The name of the saved module, unique per model and configuration.
+        build (Callable[[], torch.nn.Module]): Builds the module, e.g. with from_pretrained().
+
+    Returns:
+        torch.nn.Module: The module, from build() when weight sharing is disabled.
+    """
+    directory = weight_sharing_dir()
+    if directory is None:
+        return build()
+
+    import torch
+
+    path = os.path.join(directory, f"{name}.pt")
+    with node_lock(directory, name):
+        if not os.path.exists(path):
+            module = build()
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            torch.save(module, temporary_path)
+            os.rename(temporary_path, path)
+            logger.info(f"Saved {name} to {path} for the other replicas of the node")
+    return torch.load(path, mmap=True, weights_only=False)
+
+
+def report_model_load(model, load_seconds):
+    """
+    Logs and exports the load time of a model and the memory of the replica after
+    loading it, to compare replicas with and without weight sharing.
+
+    Args:
+        model (str): The name of the model, used as a metric tag.
+        load_seconds (float): How long the model took to load.
+    """
+    from ray.serve import metrics
+    from src.introspection import process_memory
+
+    memory = process_memory()
+    metrics.Gauge("model_load_seconds", description="Time the replica took to load its model.",
+                  tag_keys=("model",)).set(load_seconds, tags={"model": model})
+    memory_gauge = metrics.Gauge("replica_memory_bytes", description="Resident memory of the replica after loading its model.",
+                                 tag_keys=("model", "kind"))
+    for kind, value in memory.items():
+        memory_gauge.set(value, tags={"model": model, "kind": kind})
+    logger.info(f"Loaded {model} in {load_seconds:.1f}s, weight sharing {'on' if weight_sharing_dir() else 'off'}, memory: {memory}")
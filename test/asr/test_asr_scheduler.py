@@ -0,0 +1,70 @@
+import unittest
+import asyncio
+import time
+
+from src.asr.asr_scheduler import ASRScheduler, FairEDFQueue
+from src.client import Client
+
+class FakeJob:
+    def __init__(self, client_id, deadline):
+        self.client_id = client_id
+        self.deadline = deadline
+        self.dispatched_at = None
+        self.cancelled = False
+
+def chunk(client_id, seconds, priority=None):
+    client = Client(client_id, 16000, 2)
+    if priority:
+        client.config['priority'] = priority
+    return client.snapshot(bytes(int(seconds * 16000) * 2))
+
+class TestFairEDFQueue(unittest.TestCase):
+    def test_earliest_deadline_of_clients_under_their_cap_first(self):
+        queue = FairEDFQueue(max_in_flight_per_client=1)
+        a1, a2, b1 = FakeJob("a", 1.0), FakeJob("a", 2.0), FakeJob("b", 3.0)
+        for job in (b1, a2, a1):
+            queue.push(job)
+
+        self.assertIs(queue.pop(), a1)
+        # a is at its cap, so b goes first despite its later deadline
+        self.assertIs(queue.pop(), b1)
+        self.assertIsNone(queue.pop())
+        queue.complete(a1)
+        self.assertIs(queue.pop(), a2)
+        self.assertEqual(len(queue), 0)
+
+class TestASRScheduler(unittest.TestCase):
+    def test_interactive_chunks_overtake_batch_chunks(self):
+        async def run():
+            scheduler = ASRScheduler.func_or_class(max_in_flight_per_client=4)
+            batch = [asyncio.create_task(scheduler.transcribe(chunk("batch", 10, "batch"))) for _ in range(3)]
+            await asyncio.sleep(0)
+            interactive = asyncio.create_task(scheduler.transcribe(chunk("caller", 1)))
+            await asyncio.sleep(0)
+
+            order = []
+            while len(order) < 4:
+                job_id, client, _ = await scheduler.next_job("replica", timeout_seconds=1.0)
+                order.append(client.client_id)
+                await scheduler.complete(job_id, result={"text": client.client_id})
+            self.assertEqual(await interactive, {"text": "caller"})
+            await asyncio.gather(*batch)
+            return order
+
+        self.assertEqual(asyncio.run(run()), ["caller", "batch", "batch", "batch"])
+
+    def test_late_chunks_are_shed(self):
+        async def run():
+            scheduler = ASRScheduler.func_or_class(max_lateness_seconds=0.0)
+            late = chunk("late", 1)
+            late.trace_started_at = time.time() - 10
+            job = asyncio.create_task(scheduler.transcribe(late))
+            await asyncio.sleep(0)
+            self.assertIsNone(await scheduler.next_job("replica", timeout_seconds=0.05))
+            with self.assertRaises(asyncio.TimeoutError):
+                await job
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from src.asr import faster_whisper_asr
+from src.asr.decoding_profiles import DECODING_PROFILES, DecodingProfileController
+
+class FakeWhisperModel:
+    """
+    Decodes one segment per transcription, blocking its thread for a fifth of a second.
+    """
+    def __init__(self, model_size, device, compute_type):
+        self.feature_extractor = SimpleNamespace(mel_filters=np.zeros((80, 201)))
+
+    def transcribe(self, audio, language=None, initial_prompt=None, **options):
+        def segments():
+            time.sleep(0.2)
+            yield SimpleNamespace(text=" hello", start=0.0, end=1.0, words=[])
+        return segments(), SimpleNamespace(language="en", language_probability=1.0)
+
+class TestDecodingProfileController(unittest.TestCase):
+    def test_steps_down_under_load_and_back_up_with_hysteresis(self):
+        controller = DecodingProfileController(["accurate", "fast", "fastest"], step_down_real_time_factor=0.5,
+                                               step_down_queue_depth=4, step_up_real_time_factor=0.2,
+                                               step_up_queue_depth=1, hold_seconds=5.0)
+        self.assertEqual(controller.profile, "accurate")
+
+        self.assertEqual(controller.update(queue_depth=8, real_time_factor=0.1, now=10.0), -1)
+        self.assertEqual(controller.profile, "fast")
+        # Held, even though the replica is still overloaded
+        self.assertEqual(controller.update(queue_depth=8, real_time_factor=0.1, now=12.0), 0)
+        self.assertEqual(controller.update(queue_depth=0, real_time_factor=0.6, now=16.0), -1)
+        self.assertEqual(controller.profile, "fastest")
+        # The cheapest profile is the floor
+        self.assertEqual(controller.update(queue_depth=8, real_time_factor=0.6, now=30.0), 0)
+
+        # Between the thresholds nothing changes
+        self.assertEqual(controller.update(queue_depth=2, real_time_factor=0.1, now=40.0), 0)
+        self.assertEqual(controller.update(queue_depth=1, real_time_factor=0.3, now=40.0), 0)
+        self.assertEqual(controller.update(queue_depth=1, real_time_factor=0.1, now=40.0), 1)
+        self.assertEqual(controller.update(queue_depth=0, real_time_factor=0.1, now=50.0), 1)
+        self.assertEqual(controller.profile, "accurate")
+        self.assertEqual(controller.update(queue_depth=0, real_time_factor=0.0, now=60.0), 0)
+
+    def test_default_profiles_keep_word_timestamps(self):
+        controller = DecodingProfileController()
+        self.assertEqual(controller.profiles, ["accurate", "balanced", "fast"])
+        for name in controller.profiles:
+            self.assertTrue(DECODING_PROFILES[name]["word_timestamps"])
+
+    def test_rejects_unknown_profiles(self):
+        with self.assertRaises(ValueError):
+            DecodingProfileController(["accurate", "greedy"])
+
+class TestReplicaQueueDepth(unittest.TestCase):
+    def test_concurrent_requests_step_the_replica_down(self):
+        with mock.patch.object(faster_whisper_asr, 'WhisperModel', FakeWhisperModel):
+            asr = faster_whisper_asr.FasterWhisperASR.func_or_class(
+                model_size="tiny", step_down_queue_depth=4, hold_seconds=0.0)
+        # One second of audio, with the log-mel frames the ingress computed: no file to write
+        client = SimpleNamespace(scratch_buffer=bytes(32000), sampling_rate=16000, samples_width=2,
+                                 config={"language": None}, log_mel_frames=np.zeros((80, 100), dtype=np.float32))
+
+        async def run():
+            # Without a queue depth from the ASRScheduler, the requests in flight are the signal
+            return await asyncio.gather(*[asr.transcribe(client) for _ in range(6)])
+
+        results = asyncio.run(run())
+        self.assertEqual([result["text"] for result in results], ["hello"] * 6)
+        self.assertEqual([result["decoding_profile"] for result in results[:5]], ["accurate"] * 5)
+        self.assertEqual(results[5]["decoding_profile"], "balanced")
+        self.assertEqual(asr.in_flight, 0)
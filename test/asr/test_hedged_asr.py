@@ -0,0 +1,129 @@
+import unittest
+import asyncio
+import time
+from types import SimpleNamespace
+
+from src.asr.hedged_asr import HedgedASR, ReplicaDegradedError, ReplicaScores
+from test.fakes import FakeMethod
+
+class FakeASRHandle:
+    """
+    Stands in for the FasterWhisperASR deployment handle. Each call takes the next
+    (latency, reply) pair, where the reply is a transcription or an exception.
+    """
+    def __init__(self, replies):
+        self.replies = iter(replies)
+        self.calls = []
+        self.cancelled = []
+        self.transcribe = FakeMethod(self.fake_transcribe)
+
+    async def fake_transcribe(self, client, **kwargs):
+        latency_seconds, reply = next(self.replies)
+        call = len(self.calls)
+        self.calls.append(dict(kwargs, started_at=time.monotonic()))
+        try:
+            await asyncio.sleep(latency_seconds)
+        except asyncio.CancelledError:
+            self.cancelled.append(call)
+            raise
+        if isinstance(reply, Exception):
+            raise reply
+        return dict(reply)
+
+def transcription(text, replica="replica-1", real_time_factor=0.1):
+    return {"text": text, "replica": replica, "replica_real_time_factor": real_time_factor}
+
+def one_second_client():
+    return SimpleNamespace(client_id="a", scratch_buffer=bytes(32000), sampling_rate=16000, samples_width=2, config={})
+
+class TestReplicaScores(unittest.TestCase):
+    def test_slow_replicas_are_degraded(self):
+        scores = ReplicaScores(ttl_seconds=30.0, threshold=2.0)
+        self.assertEqual(scores.degraded(), [])
+        self.assertIsNone(scores.max_real_time_factor())
+
+        scores.record("a", 0.1)
+        scores.record("b", 0.1)
+        scores.record("c", 0.5)
+        self.assertEqual(scores.degraded(), ["c"])
+        self.assertAlmostEqual(scores.max_real_time_factor(), 0.2)
+
+    def test_old_reports_are_forgotten(self):
+        scores = ReplicaScores(ttl_seconds=30.0, threshold=2.0)
+        scores.record("a", 0.1)
+        scores.record("b", 0.1)
+        scores.reports["c"] = (0.5, time.monotonic() - 60.0)
+        self.assertEqual(scores.degraded(), [])
+        self.assertEqual(sorted(scores.reports), ["a", "b"])
+
+class TestHedgedASR(unittest.TestCase):
+    def hedged_asr(self, handle, **kwargs):
+        hedged_asr = HedgedASR(handle, min_hedge_delay_seconds=0.1, **kwargs)
+        # Recent calls took a tenth of their audio duration: hedge after 0.1s
+        for _ in range(10):
+            hedged_asr.latencies.record(0.1)
+        return hedged_asr
+
+    def test_slow_request_is_hedged_and_the_first_reply_wins(self):
+        handle = FakeASRHandle([(1.0, transcription("slow")), (0.05, transcription("fast"))])
+        hedged_asr = self.hedged_asr(handle)
+
+        async def run():
+            start = time.monotonic()
+            result = await hedged_asr.transcribe.remote(one_second_client())
+            return result, time.monotonic() - start, start
+
+        result, elapsed, start = asyncio.run(run())
+        self.assertEqual(result["text"], "fast")
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(len(handle.calls), 2)
+        self.assertGreaterEqual(handle.calls[1]["started_at"] - start, 0.1)
+        # The losing request is cancelled
+        self.assertEqual(handle.cancelled, [0])
+
+    def test_fast_request_is_not_hedged(self):
+        handle = FakeASRHandle([(0.02, transcription("fast"))])
+        hedged_asr = self.hedged_asr(handle)
+
+        result = asyncio.run(hedged_asr.transcribe_hedged(one_second_client()))
+        self.assertEqual(result["text"], "fast")
+        self.assertEqual(len(handle.calls), 1)
+
+    def test_deadline(self):
+        handle = FakeASRHandle([(1.0, transcription("slow"))])
+        hedged_asr = HedgedASR(handle, deadline_seconds=0.1)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(hedged_asr.transcribe_hedged(one_second_client()))
+        self.assertEqual(handle.cancelled, [0])
+
+    def test_request_rejected_by_a_degraded_replica_is_sent_again(self):
+        handle = FakeASRHandle([(0.0, ReplicaDegradedError("degraded")), (0.0, transcription("ok", "a", 0.12))])
+        hedged_asr = HedgedASR(handle, hedge_percentile=0)
+        hedged_asr.replica_scores.record("a", 0.1)
+        hedged_asr.replica_scores.record("b", 0.1)
+        hedged_asr.replica_scores.record("slow", 1.0)
+
+        result = asyncio.run(hedged_asr.transcribe_hedged(one_second_client()))
+        self.assertEqual(len(handle.calls), 2)
+        for call in handle.calls:
+            self.assertEqual(call["avoid_replicas"], ["slow"])
+            self.assertAlmostEqual(call["max_real_time_factor"], 0.2)
+        # The report of the replica is recorded, and not sent to the client
+        self.assertEqual(result, {"text": "ok"})
+        self.assertEqual(hedged_asr.replica_scores.reports["a"][0], 0.12)
+
+    def test_last_redirect_accepts_any_replica(self):
+        handle = FakeASRHandle([(0.0, ReplicaDegradedError("degraded"))] * 3)
+        hedged_asr = HedgedASR(handle, hedge_percentile=0, max_redirects=2)
+        hedged_asr.replica_scores.record("a", 0.1)
+        hedged_asr.replica_scores.record("b", 0.1)
+        hedged_asr.replica_scores.record("slow", 1.0)
+
+        with self.assertRaises(ReplicaDegradedError):
+            asyncio.run(hedged_asr.transcribe_hedged(one_second_client()))
+        self.assertEqual([call["avoid_replicas"] for call in handle.calls], [["slow"], ["slow"], []])
+        self.assertIsNone(handle.calls[2]["max_real_time_factor"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import asyncio
+from unittest import mock
+import numpy as np
+from faster_whisper.feature_extractor import FeatureExtractor
+
+from src.asr.log_mel import StreamingLogMel, pcm_to_float, whisper_features
+from src.client import Client
+
+class TestStreamingLogMel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.pcm = (rng.standard_normal(16000 * 12) * 3000).astype(np.int16).tobytes()
+        self.feature_extractor = FeatureExtractor(feature_size=128)
+        self.log_mel = StreamingLogMel(128)
+        # Audio arrives in messages that are not a multiple of the frame hop
+        for start in range(0, len(self.pcm), 4100):
+            self.log_mel.feed(self.pcm[start:start + 4100])
+
+    def assert_features_match(self, start, end):
+        chunk = self.pcm[2 * start:2 * end]
+        expected = self.feature_extractor(pcm_to_float(chunk))
+        features = whisper_features(self.log_mel.chunk_frames(start, chunk), end - start)
+        self.assertEqual(features.shape, expected.shape)
+        np.testing.assert_allclose(features, expected, atol=1e-5)
+
+    def test_chunks_match_faster_whisper(self):
+        # On the frame grid, off the grid, and shorter than a window
+        for start, end in [(0, 48000), (1600, 60000), (1000, 50000), (3200, 3300)]:
+            self.assert_features_match(start, end)
+
+    def test_discarded_audio(self):
+        self.log_mel.discard(16000 * 5)
+        self.log_mel.compute()
+        self.assertEqual(self.log_mel.first_frame, 500)
+        self.assert_features_match(16000 * 5, 16000 * 12)
+        # Frames that were dropped are computed from the chunk
+        self.assert_features_match(16000 * 4, 16000 * 6)
+
+    def test_work_is_queued_in_order_until_computed(self):
+        log_mel = StreamingLogMel(128)
+        chunk = self.pcm[:64000]
+        for start in range(0, len(chunk), 8000):
+            log_mel.feed(chunk[start:start + 8000])
+        frames = log_mel.request_chunk_frames(0, chunk)
+        log_mel.discard(16000)
+        self.assertEqual(log_mel.next_frame, 2)
+
+        log_mel.compute()
+        # The chunk was computed from the frames of the stream, before they were discarded
+        self.assertEqual((log_mel.first_frame, log_mel.next_frame), (100, 199))
+        np.testing.assert_allclose(whisper_features(frames.result(), 32000),
+                                   self.feature_extractor(pcm_to_float(chunk)), atol=1e-5)
+
+    def test_compute_is_due_for_old_or_long_work(self):
+        log_mel = StreamingLogMel(128)
+        log_mel.feed(self.pcm[:3200])
+        self.assertFalse(log_mel.compute_due())
+        log_mel.pending_since -= log_mel.max_pending_seconds
+        self.assertTrue(log_mel.compute_due())
+
+        async def schedule():
+            await log_mel.schedule(asyncio.get_running_loop())
+
+        asyncio.run(schedule())
+        self.assertFalse(log_mel.compute_due())
+        self.assertEqual(log_mel.end, 1600)
+
+        for _ in range(log_mel.max_pending_operations):
+            log_mel.discard(0)
+        self.assertTrue(log_mel.compute_due())
+
+    def test_discards_leave_the_work_queued_until_due(self):
+        async def run():
+            client = Client("a", 16000, 2)
+            client.log_mel = StreamingLogMel(128)
+            with mock.patch.object(client.log_mel, 'schedule') as schedule:
+                # Twenty milliseconds of audio and a discard, like endpointing every message
+                for _ in range(50):
+                    client.append_audio_data(bytes(640))
+                    client.discard_scratch_buffer()
+                schedule.assert_not_called()
+
+                client.log_mel.pending_since -= client.log_mel.max_pending_seconds
+                client.discard_scratch_buffer()
+                schedule.assert_called_once()
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
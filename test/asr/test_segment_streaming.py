@@ -0,0 +1,134 @@
+import unittest
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from src.asr import faster_whisper_asr
+from src.asr.hedged_asr import HedgedASR
+from src.client import Client
+from src.tracing import Tracer, new_trace_context
+from test.fakes import FakeStreamingMethod, FakeVAD, FakeWebSocket
+
+class FakeASRHandle:
+    """
+    Decodes one segment per 0.5s of audio; the websocket must have received the
+    previous segments when the next one is decoded.
+    """
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.transcribe_streaming = FakeStreamingMethod(self.fake_transcribe_streaming)
+
+    def options(self, stream=False):
+        assert stream
+        return self
+
+    async def fake_transcribe_streaming(self, client, **kwargs):
+        seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        words = []
+        for index in range(int(seconds * 2)):
+            sent = len(self.websocket.sent)
+            await asyncio.sleep(0)
+            word = {"word": f" w{index}", "start": index * 0.5, "end": index * 0.5 + 0.4, "probability": 1.0}
+            words.append(word)
+            yield {"type": "segment", "text": word["word"].strip(), "start": word["start"], "end": word["end"], "words": [word]}
+            self.websocket.segments_sent_before_next.append(len(self.websocket.sent) > sent)
+        yield {"text": "".join(word["word"] for word in words).strip(), "words": words,
+               "replica": "replica-1", "replica_real_time_factor": 0.1}
+
+class SegmentWebSocket(FakeWebSocket):
+    def __init__(self):
+        super().__init__()
+        self.segments_sent_before_next = []
+
+class FakeWhisperModel:
+    """
+    Decodes three segments, blocking its thread for 20 ms per segment.
+    """
+    def __init__(self, model_size, device, compute_type):
+        self.feature_extractor = SimpleNamespace(mel_filters=np.zeros((80, 201)))
+
+    def transcribe(self, audio, language=None, initial_prompt=None, **options):
+        def segments():
+            for index in range(3):
+                time.sleep(0.02)
+                yield SimpleNamespace(text=f" w{index}", start=index * 0.5, end=index * 0.5 + 0.4, words=[])
+        return segments(), SimpleNamespace(language="en", language_probability=1.0)
+
+class SpanList(list):
+    def export(self, span):
+        self.append(span)
+
+    def flush(self):
+        pass
+
+class TestSegmentStreaming(unittest.TestCase):
+    def stream(self, processing_strategy):
+        client = Client("test_client", 16000, 2)
+        client.update_config({"stream_segments": True,
+                              "processing_strategy": processing_strategy,
+                              "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1}})
+        websocket = SegmentWebSocket()
+        asr = HedgedASR(FakeASRHandle(websocket), hedge_percentile=0)
+
+        async def run():
+            for _ in range(6):
+                client.append_audio_data(bytes(8000))
+                client.process_audio(websocket, FakeVAD(trailing_silence_seconds=0.3), asr)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        return websocket
+
+    def assert_segments_sent_before_the_transcription(self, websocket):
+        segments = [message for message in websocket.sent if message.get("type") == "segment"]
+        transcriptions = [message for message in websocket.sent if "type" not in message]
+        self.assertEqual(len(transcriptions), 1)
+        self.assertEqual([segment["text"] for segment in segments], transcriptions[0]["text"].split())
+        self.assertLess(websocket.sent.index(segments[-1]), websocket.sent.index(transcriptions[0]))
+        self.assertTrue(all(websocket.segments_sent_before_next))
+        self.assertEqual(segments[1]["start"], 0.5)
+
+    def test_segments_are_sent_before_the_transcription(self):
+        self.assert_segments_sent_before_the_transcription(self.stream("silence_at_end_of_chunk"))
+
+    def test_segments_of_snapshots_are_streamed(self):
+        # The pipelined strategy transcribes snapshots of the client
+        self.assert_segments_sent_before_the_transcription(self.stream("pipelined_silence_at_end_of_chunk"))
+
+    def test_inference_spans_leave_out_the_consumer(self):
+        with mock.patch.object(faster_whisper_asr, 'WhisperModel', FakeWhisperModel):
+            asr = faster_whisper_asr.FasterWhisperASR.func_or_class(model_size="tiny")
+        spans = SpanList()
+        asr.tracer = Tracer(spans)
+        client = SimpleNamespace(scratch_buffer=bytes(32000), sampling_rate=16000, samples_width=2,
+                                 config={"language": None}, log_mel_frames=np.zeros((80, 100), dtype=np.float32),
+                                 trace_context=new_trace_context())
+
+        async def run():
+            async for message in asr.transcribe_streaming(client):
+                if message.get("type") == "segment":
+                    # The ingress is slow to read the segments
+                    await asyncio.sleep(0.2)
+            return message
+
+        transcription = asyncio.run(run())
+        self.assertEqual(transcription["text"], "w0 w1 w2")
+
+        def seconds(span):
+            return (span["endTimeUnixNano"] - span["startTimeUnixNano"]) / 1e9
+
+        inference = [span for span in spans if span["name"] == "asr.inference"]
+        self.assertEqual([span["attributes"]["decode_step"] for span in inference], [0, 1, 2, 3, 4])
+        self.assertLess(sum(seconds(span) for span in inference), 0.2)
+        waits = [span for span in spans if span["name"] == "asr.consumer_wait"]
+        self.assertEqual(len(waits), 3)
+        self.assertTrue(all(seconds(span) >= 0.2 for span in waits))
+        # Nor is the consumer counted as processing time of the replica
+        self.assertLess(transcription["replica_real_time_factor"], 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
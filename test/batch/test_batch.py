@@ -0,0 +1,58 @@
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+
+from src.batch import completed_ids, speech_windows, transcribe_audio
+
+class FakeVAD:
+    async def detect_activity(self, client):
+        return [{"start": 1.0, "end": 2.0}, {"start": 2.5, "end": 3.0}, {"start": 10.0, "end": 11.0}]
+
+class FakeASR:
+    def __init__(self):
+        self.windows = []
+
+    async def transcribe(self, client):
+        self.windows.append(len(client.scratch_buffer) / 32000)
+        return {"language": "en", "text": f"window {len(self.windows)}",
+                "words": [{"word": "window", "start": 0.5, "end": 0.8, "probability": 1.0}]}
+
+class TestBatch(unittest.TestCase):
+    def test_speech_windows(self):
+        segments = [{"start": 1.0, "end": 2.0}, {"start": 2.5, "end": 3.0}, {"start": 10.0, "end": 75.0}]
+        windows = speech_windows(segments, 80.0, max_window_seconds=30.0, padding_seconds=0.0, max_gap_seconds=1.0)
+
+        # Close segments share a window, long speech is cut under Whisper's input length
+        self.assertEqual(windows[0], (1.0, 3.0))
+        self.assertEqual(len(windows), 4)
+        self.assertTrue(all(end - start <= 30.0 for start, end in windows[1:]))
+        self.assertAlmostEqual(windows[1][0], 10.0)
+        self.assertAlmostEqual(windows[-1][1], 75.0)
+
+    def test_transcribe_audio_offsets_words(self):
+        asr = FakeASR()
+        item = {"id": "a", "path": "a.wav", "language": None}
+        result = asyncio.run(transcribe_audio(FakeVAD(), asr, bytes(12 * 32000), item, "batch-test",
+                                              {"padding_seconds": 0.0}))
+
+        self.assertEqual(asr.windows, [2.0, 1.0])
+        self.assertEqual(result['text'], "window 1 window 2")
+        self.assertEqual(result['segments'][1]['words'][0]['start'], 10.5)
+
+    def test_resume_skips_completed_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, "output.jsonl")
+            with open(output_path, 'w') as output:
+                output.write(json.dumps({"id": "a", "text": "done"}) + "\n")
+                output.write(json.dumps({"id": "b", "error": "ValueError()"}) + "\n")
+                output.write('{"id": "c", "te')
+
+            # Failed files are retried and the line cut short by the interruption is dropped
+            self.assertEqual(completed_ids(output_path), {"a"})
+            with open(output_path) as output:
+                self.assertEqual(len(output.read().splitlines()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
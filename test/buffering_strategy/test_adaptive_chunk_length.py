@@ -0,0 +1,28 @@
+import unittest
+
+from src.buffering_strategy.adaptive_chunk_length import AdaptiveChunkLength
+
+def round_trip(chunk_length_seconds, overhead_seconds, seconds_per_audio_second):
+    return overhead_seconds + seconds_per_audio_second * chunk_length_seconds
+
+class TestAdaptiveChunkLength(unittest.TestCase):
+    def run_chunks(self, controller, overhead_seconds, seconds_per_audio_second, chunks=50):
+        for _ in range(chunks):
+            length = controller.chunk_length_seconds
+            controller.observe(round_trip(length, overhead_seconds, seconds_per_audio_second), length)
+        return controller.chunk_length_seconds
+
+    def test_converges_to_the_target_real_time_factor(self):
+        controller = AdaptiveChunkLength(3.0, 1.0, 10.0, target_real_time_factor=0.5)
+        # Idle cluster: chunks get as short as allowed
+        self.assertEqual(self.run_chunks(controller, 0.1, 0.05), 1.0)
+        # Under load the per-chunk overhead grows, chunks get longer to amortize it:
+        # 2s / (L - 0.1 L) = 0.5 at L = 5s
+        self.assertAlmostEqual(self.run_chunks(controller, 2.0, 0.1), 5.0, delta=0.25)
+        # More than the target per audio second, whatever the length: the longest chunks
+        self.assertEqual(self.run_chunks(controller, 0.5, 0.8), 10.0)
+
+    def test_backlog_lengthens_chunks(self):
+        controller = AdaptiveChunkLength(2.0, 1.0, 10.0, target_real_time_factor=0.5)
+        self.assertAlmostEqual(controller.observe(0.2, 2.0, backlog_seconds=4.0), 2.5)
+        self.assertAlmostEqual(controller.observe(0.2, 2.5, backlog_seconds=0.0), 2.0)
@@ -0,0 +1,70 @@
+import unittest
+import asyncio
+from unittest import mock
+
+from src.client import Client
+from src.voice_stream_ai_server import TranscriptionServer
+from test.fakes import FakeWebSocket, PendingDeployment, PendingMethod
+
+SECOND = 16000 * 2
+
+class TestCancellation(unittest.TestCase):
+    def test_disconnect_cancels_the_pending_request(self):
+        async def run():
+            client = Client("a", 16000, 2)
+            method = PendingMethod()
+            call = asyncio.ensure_future(client.call_deployment('vad', method, client.snapshot(bytes(SECOND))))
+            await asyncio.sleep(0)
+            self.assertEqual(len(client.pending_requests), 1)
+
+            client.close()
+            with self.assertRaises(asyncio.CancelledError):
+                await call
+            self.assertTrue(method.responses[0].cancelled)
+            self.assertEqual(client.pending_requests, {})
+
+            # Nothing is sent once the client has disconnected
+            with self.assertRaises(asyncio.CancelledError):
+                await client.call_deployment('vad', method, client)
+            self.assertEqual(len(method.responses), 1)
+
+        asyncio.run(run())
+
+    def test_pipelined_close_drops_the_queued_chunks(self):
+        async def run():
+            client = Client("a", 16000, 2)
+            client.update_config({"processing_strategy": "pipelined_silence_at_end_of_chunk",
+                                  "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1}})
+            vad = PendingDeployment()
+            # Four chunks of 1.25s: the first waits for the VAD, the others are queued
+            for _ in range(4):
+                for _ in range(5):
+                    client.append_audio_data(bytes(SECOND // 4))
+                client.process_audio(FakeWebSocket(), vad, PendingDeployment())
+                await asyncio.sleep(0)
+            self.assertEqual(client.buffering_strategy.vad_queue.qsize(), 3)
+
+            cancelled_seconds = client.close()
+            await asyncio.sleep(0)
+            self.assertEqual(cancelled_seconds, 5.0)
+            self.assertTrue(client.buffering_strategy.vad_queue.empty())
+            self.assertTrue(vad.detect_activity.responses[0].cancelled)
+            self.assertEqual(len(vad.detect_activity.responses), 1)
+
+        asyncio.run(run())
+
+    def test_server_counts_the_cancelled_audio(self):
+        async def run():
+            server = TranscriptionServer.func_or_class(asr_handle=PendingDeployment(), vad_handle=PendingDeployment())
+            client = server.open_client("a")
+            for _ in range(6):
+                client.append_audio_data(bytes(SECOND // 4))
+            with mock.patch.object(server, 'cancelled_audio_seconds') as counter:
+                self.assertEqual(server.close_client("a"), 1.5)
+            counter.inc.assert_called_once_with(1.5)
+            self.assertEqual(server.connected_clients, {})
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import asyncio
+
+from src.client import Client
+from test.fakes import FakeASR, FakeVAD, FakeWebSocket
+
+class WordsASR(FakeASR):
+    """
+    Recognizes one word every 0.25s of audio, named after its position in the stream.
+    """
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    def transcription(self, client):
+        self.prompts.append(client.prompt)
+        offset = client.scratch_offset_bytes / (client.sampling_rate * client.samples_width)
+        seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        words = [{"word": f" w{round((offset + start) * 4)}", "start": start, "end": start + 0.2, "probability": 1.0}
+                 for start in [i * 0.25 for i in range(int(seconds * 4))]]
+        return {"text": "".join(word["word"] for word in words).strip(), "words": words}
+
+
+class TestContextCarryOver(unittest.TestCase):
+    def test_words_are_made_absolute_and_deduplicated(self):
+        client = Client("test_client", 16000, 2)
+        client.committed_until_seconds = 1.3
+        utterance = client.snapshot(bytes(32000))
+        utterance.scratch_offset_bytes = 32000
+        transcription = {"text": "a b", "words": [{"word": " a", "start": 0.0, "end": 0.2},
+                                                  {"word": " b", "start": 0.4, "end": 0.6}]}
+
+        self.assertTrue(client.commit_transcription(transcription, utterance))
+        self.assertEqual(transcription["text"], "b")
+        self.assertEqual(transcription["words"], [{"word": " b", "start": 1.4, "end": 1.6}])
+        self.assertEqual(client.committed_until_seconds, 1.6)
+        self.assertEqual(client.committed_text, "b")
+
+    def test_overlap_is_transcribed_again_without_duplicate_words(self):
+        client = Client("test_client", 16000, 2)
+        client.update_config({"processing_strategy": "silence_at_end_of_chunk",
+                              "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1,
+                                                  "context_overlap_seconds": 0.5,
+                                                  "context_prompt_max_chars": 100}})
+        websocket = FakeWebSocket()
+        asr = WordsASR()
+
+        async def run():
+            frame = bytes(8000)
+            for _ in range(15):
+                client.append_audio_data(frame)
+                client.process_audio(websocket, FakeVAD(trailing_silence_seconds=0.3), asr)
+                await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        words = [word["word"] for transcription in websocket.sent for word in transcription["words"]]
+        self.assertGreater(len(websocket.sent), 1)
+        self.assertEqual(len(words), len(set(words)))
+        self.assertEqual(words, sorted(words, key=lambda word: int(word[2:])))
+        self.assertEqual(websocket.sent[1]["stream_start_seconds"], websocket.sent[0]["stream_end_seconds"] - 0.5)
+        self.assertEqual(asr.prompts[0], None)
+        self.assertEqual(asr.prompts[1], websocket.sent[0]["text"])
+
+if __name__ == '__main__':
+    unittest.main()
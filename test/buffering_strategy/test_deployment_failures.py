@@ -0,0 +1,43 @@
+import unittest
+import asyncio
+
+from src.client import Client
+from test.fakes import FakeASR, FakeVAD, FakeWebSocket
+
+
+class TestDeploymentFailures(unittest.TestCase):
+    def stream(self, vad, asr, seconds=6):
+        client = Client("test_client", 16000, 2)
+        client.update_config({"processing_strategy": "silence_at_end_of_chunk",
+                              "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1}})
+        websocket = FakeWebSocket()
+
+        async def run():
+            for _ in range(seconds * 4):
+                client.append_audio_data(bytes(8000))
+                client.process_audio(websocket, vad, asr)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+        return client, websocket.sent
+
+    def test_stream_recovers_from_a_vad_failure(self):
+        client, sent = self.stream(FakeVAD(failures=1), FakeASR())
+
+        self.assertFalse(client.buffering_strategy.processing_flag)
+        self.assertGreater(len(sent), 0)
+        # The audio of the failed chunk was kept and transcribed with the next one
+        self.assertEqual(sent[0]["stream_start_seconds"], 0.0)
+
+    def test_stream_recovers_from_an_asr_failure(self):
+        client, sent = self.stream(FakeVAD(), FakeASR(failures=1))
+
+        self.assertFalse(client.buffering_strategy.processing_flag)
+        self.assertGreater(len(sent), 0)
+        # The chunk that failed was dropped
+        self.assertGreater(sent[0]["stream_start_seconds"], 0.0)
+        self.assertIsNone(client.trace_context)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import asyncio
+import numpy as np
+
+from src.client import Client
+from test.fakes import FakeASR, FakeWebSocket
+
+class DurationASR(FakeASR):
+    """
+    Transcribes an utterance as its duration in seconds.
+    """
+    def transcription(self, client):
+        seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        return {"text": f"{seconds:.2f}", "words": []}
+
+
+class TestEndpointing(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("test_client", 16000, 2)
+        self.client.update_config({"processing_strategy": "endpointing",
+                                   "processing_args": {"end_silence_seconds": 0.3,
+                                                       "min_utterance_seconds": 0.2,
+                                                       "max_utterance_seconds": 2.0}})
+        self.websocket = FakeWebSocket()
+
+    def tone(self, seconds):
+        t = np.arange(int(seconds * 16000)) / 16000
+        return (np.sin(2 * np.pi * 220 * t) * 8000).astype(np.int16).tobytes()
+
+    def silence(self, seconds):
+        noise = np.random.default_rng(0).normal(0, 30, int(seconds * 16000))
+        return noise.astype(np.int16).tobytes()
+
+    def stream(self, audio, frame_seconds=0.1):
+        async def run():
+            frame_bytes = int(frame_seconds * 16000) * 2
+            for i in range(0, len(audio), frame_bytes):
+                self.client.append_audio_data(audio[i:i + frame_bytes])
+                self.client.process_audio(self.websocket, None, DurationASR())
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.01)
+        asyncio.run(run())
+
+    def test_utterance_is_finalized_after_trailing_silence(self):
+        self.stream(self.silence(0.5) + self.tone(1.0) + self.silence(0.5))
+
+        self.assertEqual(len(self.websocket.sent), 1)
+        self.assertEqual(self.websocket.sent[0]["endpoint"], "end_of_speech")
+        # Pre-speech audio, the speech and the trailing silence that ended it
+        self.assertAlmostEqual(float(self.websocket.sent[0]["text"]), 1.5, delta=0.1)
+
+    def test_short_noise_is_discarded(self):
+        self.stream(self.silence(0.5) + self.tone(0.06) + self.silence(0.5))
+
+        self.assertEqual(self.websocket.sent, [])
+        # Only the pre-speech audio is kept
+        self.assertLessEqual(len(self.client.scratch_buffer), 0.2 * 16000 * 2)
+
+    def test_long_utterance_is_split_at_maximum_length(self):
+        self.stream(self.silence(0.5) + self.tone(3.0) + self.silence(0.5))
+
+        self.assertEqual([message["endpoint"] for message in self.websocket.sent],
+                         ["max_utterance_length", "end_of_speech"])
+        self.assertEqual([message["sequence_number"] for message in self.websocket.sent], [0, 1])
+
+if __name__ == '__main__':
+    unittest.main()
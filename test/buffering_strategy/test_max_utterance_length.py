@@ -0,0 +1,64 @@
+import unittest
+import asyncio
+import numpy as np
+
+from src.client import Client
+from test.fakes import FakeASR, FakeVAD, FakeWebSocket
+
+class UtteranceASR(FakeASR):
+    """
+    Records the stream position and the duration of each utterance, in seconds.
+    """
+    def __init__(self):
+        super().__init__()
+        self.utterances = []
+
+    def transcription(self, client):
+        bytes_per_second = client.sampling_rate * client.samples_width
+        self.utterances.append((client.scratch_offset_bytes / bytes_per_second,
+                                len(client.scratch_buffer) / bytes_per_second))
+        return {"text": f"utterance {len(self.utterances)}", "words": None}
+
+class TestMaxUtteranceLength(unittest.TestCase):
+    def transcribe_monologue(self, processing_strategy, vad):
+        client = Client("test_client", 16000, 2)
+        client.update_config({"processing_strategy": processing_strategy,
+                              "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1,
+                                                  "max_utterance_seconds": 5, "split_search_seconds": 2}})
+        samples = (np.random.default_rng(0).standard_normal(16000 * 12) * 5000).astype(np.int16)
+        # The quietest frame of the first search window, from 3 to 5 seconds
+        samples[int(16000 * 4.2):int(16000 * 4.22)] = 0
+        audio = samples.tobytes()
+        websocket = FakeWebSocket()
+        asr = UtteranceASR()
+
+        async def run():
+            for start in range(0, len(audio), 8000):
+                client.append_audio_data(audio[start:start + 8000])
+                client.process_audio(websocket, vad, asr)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+        return asr.utterances, websocket.sent
+
+    def test_split_at_the_quietest_frame(self):
+        utterances, sent = self.transcribe_monologue("silence_at_end_of_chunk", FakeVAD(trailing_silence_seconds=0.0))
+
+        self.assertGreaterEqual(len(utterances), 2)
+        self.assertEqual(utterances[0][0], 0.0)
+        self.assertAlmostEqual(utterances[0][1], 4.21)
+        # The tail is carried into the next utterance, which is bounded too
+        self.assertAlmostEqual(utterances[1][0], 4.21)
+        self.assertTrue(all(length <= 5.0 for _, length in utterances))
+        self.assertEqual(sent[0]["endpoint"], "max_utterance_length")
+
+    def test_split_in_a_pause(self):
+        utterances, sent = self.transcribe_monologue("pipelined_silence_at_end_of_chunk", FakeVAD(trailing_silence_seconds=0.0, pauses=[(3.5, 3.7)]))
+
+        self.assertAlmostEqual(utterances[0][1], 3.6)
+        self.assertAlmostEqual(utterances[1][0], 3.6)
+        self.assertEqual(sent[0]["stream_end_seconds"], sent[1]["stream_start_seconds"])
+
+if __name__ == '__main__':
+    unittest.main()
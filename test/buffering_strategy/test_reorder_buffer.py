@@ -0,0 +1,60 @@
+import unittest
+import asyncio
+
+from src.buffering_strategy.reorder_buffer import ReorderBuffer
+
+class TestReorderBuffer(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+
+    async def deliver(self, result):
+        # Yield to the event loop so that concurrent puts interleave with sends
+        await asyncio.sleep(0)
+        self.delivered.append(result)
+
+    def test_results_are_delivered_in_sequence_order(self):
+        async def run():
+            reorder_buffer = ReorderBuffer(self.deliver)
+            await reorder_buffer.put(2, "c")
+            await reorder_buffer.put(1, "b")
+            self.assertEqual(self.delivered, [])
+            await reorder_buffer.put(0, "a")
+            self.assertEqual(len(reorder_buffer), 0)
+
+        asyncio.run(run())
+        self.assertEqual(self.delivered, ["a", "b", "c"])
+
+    def test_empty_results_only_advance_the_sequence(self):
+        async def run():
+            reorder_buffer = ReorderBuffer(self.deliver)
+            await reorder_buffer.put(1, "b")
+            await reorder_buffer.put(0, None)
+            await reorder_buffer.put(2, None)
+            self.assertEqual(reorder_buffer.next_sequence_number, 3)
+
+        asyncio.run(run())
+        self.assertEqual(self.delivered, ["b"])
+
+    def test_concurrent_puts_keep_the_order(self):
+        async def put_later(reorder_buffer, sequence_number):
+            await asyncio.sleep(0.001 * (10 - sequence_number))
+            await reorder_buffer.put(sequence_number, sequence_number)
+
+        async def run():
+            reorder_buffer = ReorderBuffer(self.deliver)
+            await asyncio.gather(*[put_later(reorder_buffer, i) for i in range(10)])
+
+        asyncio.run(run())
+        self.assertEqual(self.delivered, list(range(10)))
+
+    def test_already_delivered_sequence_number_is_rejected(self):
+        async def run():
+            reorder_buffer = ReorderBuffer(self.deliver)
+            await reorder_buffer.put(0, "a")
+            with self.assertRaises(ValueError):
+                await reorder_buffer.put(0, "a")
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
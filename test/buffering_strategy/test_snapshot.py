@@ -0,0 +1,30 @@
+import unittest
+import pickle
+
+from src.client import Client
+
+class TestSnapshot(unittest.TestCase):
+    def test_pickled_snapshot_only_carries_the_utterance(self):
+        client = Client("a", 16000, 2)
+        utterance = bytes(32000)
+
+        sizes = []
+        for backlog_bytes in (0, 320000):
+            client.buffer = bytearray(backlog_bytes)
+            snapshot = client.snapshot(utterance)
+            sizes.append(len(pickle.dumps(snapshot)))
+            restored = pickle.loads(pickle.dumps(snapshot))
+            self.assertEqual(bytes(restored.scratch_buffer), utterance)
+            self.assertEqual(len(restored.buffer), 0)
+
+        self.assertEqual(sizes[0], sizes[1])
+        # A snapshot has none of the runtime attributes of the live client
+        for attribute in ('buffering_strategy', 'tasks', 'pending_requests', 'journal', 'log_mel',
+                          'segment_listener'):
+            self.assertFalse(hasattr(snapshot, attribute), attribute)
+        self.assertEqual(len(snapshot.buffer), 0)
+        # The live client keeps its backlog
+        self.assertEqual(len(client.buffer), 320000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import websockets
+
+from src.capture import AUDIO, CONFIG, TrafficCapture, read_capture
+from src.multiplexing import decode_frame
+from src.replay import compare_runs, replay_capture
+
+FRAME = bytes(range(256)) * 31 + bytes(64)  # 8000 bytes, a quarter second
+
+async def capture_sessions(path, capture_audio):
+    capture = TrafficCapture(path, capture_audio=capture_audio, flush_bytes=1024)
+    capture.open_session("a", 16000, 2)
+    capture.record_config("a", {"language": "en"})
+    capture.open_session("b", 16000, 2)
+    for _ in range(4):
+        capture.record_audio("a", FRAME)
+        capture.record_audio("b", FRAME[:4000])
+        await asyncio.sleep(0.05)
+    capture.close_session("a")
+    capture.close_session("b")
+    await capture.close()
+
+async def transcribe_every_second(websocket):
+    """
+    Stands in for the server: sends a transcription for every second of audio received.
+    """
+    received_bytes = 0
+    async for message in websocket:
+        if isinstance(message, bytes):
+            received_bytes += len(message)
+            if received_bytes % 32000 == 0:
+                await websocket.send(json.dumps({"text": "hello", "stream_end_seconds": received_bytes / 32000}))
+
+async def capture_multiplexed_sessions(path):
+    """
+    Captures two streams of a multiplexed connection, one of another, and a session on '/'.
+    """
+    capture = TrafficCapture(path, flush_bytes=1024)
+    capture.open_session("m1/7", 16000, 2, connection_id="m1", stream_id=7)
+    capture.open_session("m1/9", 16000, 2, connection_id="m1", stream_id=9)
+    capture.open_session("m2/7", 16000, 2, connection_id="m2", stream_id=7)
+    capture.open_session("a", 16000, 2)
+    for _ in range(4):
+        for client_id in ("m1/7", "m1/9", "m2/7", "a"):
+            capture.record_audio(client_id, FRAME)
+        await asyncio.sleep(0.01)
+    for client_id in ("m1/7", "m1/9", "m2/7", "a"):
+        capture.close_session(client_id)
+    capture.close_connection("m1")
+    capture.close_connection("m2")
+    await capture.close()
+
+async def transcribe_every_second_per_stream(websocket, paths):
+    """
+    Stands in for the server on both endpoints, recording the path of every connection.
+    """
+    # websockets 14 moved the path of the handshake to websocket.request
+    request = getattr(websocket, 'request', None)
+    path = request.path if request is not None else websocket.path
+    paths.append(path)
+    if path != "/mux":
+        await transcribe_every_second(websocket)
+        return
+    received_bytes = {}
+    async for message in websocket:
+        if isinstance(message, bytes):
+            stream_id, audio = decode_frame(message)
+            received_bytes[stream_id] += len(audio)
+            if received_bytes[stream_id] % 32000 == 0:
+                await websocket.send(json.dumps({"text": "hello", "stream_id": stream_id,
+                                                 "stream_end_seconds": received_bytes[stream_id] / 32000}))
+        else:
+            config = json.loads(message)
+            if config["action"] == "open":
+                received_bytes[config["stream_id"]] = 0
+            elif config["action"] == "close":
+                del received_bytes[config["stream_id"]]
+
+class TestCapture(unittest.TestCase):
+    def test_sessions_are_captured_with_their_timing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "timing.capture")
+            asyncio.run(capture_sessions(path, capture_audio=False))
+            timing_bytes = os.path.getsize(path)
+            a, b = read_capture(path)
+
+            self.assertEqual(a['events'][0][1:], (CONFIG, 18, b'{"language": "en"}'))
+            self.assertEqual([event[1:] for event in a['events'][1:]], [(AUDIO, 8000, b"")] * 4)
+            self.assertEqual([event[2] for event in b['events']], [4000] * 4)
+            arrivals = [event[0] for event in b['events']]
+            self.assertGreater(arrivals[-1] - arrivals[0], 0.14)
+            self.assertGreaterEqual(b['close_seconds'], arrivals[-1])
+
+            path = os.path.join(directory, "audio.capture")
+            asyncio.run(capture_sessions(path, capture_audio=True))
+            a, _ = read_capture(path)
+            self.assertEqual(a['events'][1][3], FRAME)
+            self.assertEqual(os.path.getsize(path) - timing_bytes, 6 * 8000)
+
+    def test_replay_measures_latency_at_the_captured_pace(self):
+        async def replay(path):
+            async with websockets.serve(transcribe_every_second, "127.0.0.1", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                start = time.monotonic()
+                results = await replay_capture(path, f"ws://127.0.0.1:{port}", speedup=2.0, drain_seconds=0.2)
+                return results, time.monotonic() - start
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "timing.capture")
+            asyncio.run(capture_sessions(path, capture_audio=False))
+            results, wall_seconds = asyncio.run(replay(path))
+
+        self.assertEqual(results['sessions'], 2)
+        self.assertEqual(results['failed_sessions'], 0)
+        # Session a sent one second of audio, session b half a second
+        self.assertEqual(results['transcriptions'], 1)
+        self.assertLess(results['latency_seconds']['max'], 0.1)
+        # Four frames 50 ms apart, replayed twice as fast, then the drain
+        self.assertGreater(wall_seconds, 0.07 + 0.2)
+
+        comparison = compare_runs(results, dict(results, transcriptions=2))
+        self.assertEqual(comparison['transcriptions']['difference'], 1)
+        self.assertEqual(comparison['p50']['difference'], 0.0)
+
+    def test_multiplexed_streams_are_replayed_over_one_connection(self):
+        paths = []
+
+        async def replay(path):
+            async def handler(websocket):
+                await transcribe_every_second_per_stream(websocket, paths)
+
+            async with websockets.serve(handler, "127.0.0.1", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                return await replay_capture(path, f"ws://127.0.0.1:{port}", speedup=2.0, drain_seconds=0.2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mux.capture")
+            asyncio.run(capture_multiplexed_sessions(path))
+            sessions = read_capture(path)
+            results = asyncio.run(replay(path))
+
+        self.assertEqual([(session['connection'], session['stream_id']) for session in sessions],
+                         [(0, 7), (0, 9), (1, 7), (None, None)])
+        self.assertEqual(sorted(paths), ["/", "/mux", "/mux"])
+        self.assertEqual(results['multiplexed_connections'], 2)
+        self.assertEqual(results['failed_sessions'], 0)
+        # Every session sent one second of audio
+        self.assertEqual([result['transcriptions'] for result in results['session_results']], [1] * 4)
+        self.assertEqual(results['latency_seconds']['count'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
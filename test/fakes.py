@@ -0,0 +1,239 @@
+# test/fakes.py
+
+"""
+Stand-ins for the Ray Serve deployment handles of the VAD and ASR and for the
+WebSocket of a client, shared by the tests that run the buffering strategies and
+the TranscriptionServer in process, and by the soak harness.
+"""
+
+import asyncio
+import json
+import random
+
+
+class FakeResponse:
+    """
+    Stands in for a DeploymentResponse: awaitable and cancellable.
+    """
+
+    def __init__(self, coro):
+        self.task = asyncio.ensure_future(coro)
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def cancel(self):
+        self.task.cancel()
+
+
+class FakeMethod:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def remote(self, **kwargs):
+        return FakeResponse(self.fn(**kwargs))
+
+
+class FakeStreamingResponse:
+    """
+    Stands in for the DeploymentResponseGenerator of a streaming call.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __aiter__(self):
+        return self.generator
+
+    def cancel(self):
+        pass
+
+
+class FakeStreamingMethod:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def remote(self, **kwargs):
+        return FakeStreamingResponse(self.fn(**kwargs))
+
+
+class PendingResponse:
+    """
+    A DeploymentResponse that never completes, and records whether it was cancelled.
+    """
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def cancel(self):
+        self.cancelled = True
+        self.future.cancel()
+
+
+class PendingMethod:
+    def __init__(self):
+        self.responses = []
+
+    def remote(self, **kwargs):
+        response = PendingResponse()
+        self.responses.append(response)
+        return response
+
+
+class PendingDeployment:
+    """
+    A VAD or ASR deployment that never answers.
+    """
+
+    def __init__(self):
+        self.detect_activity = PendingMethod()
+        self.transcribe = PendingMethod()
+
+
+class FakeVAD:
+    """
+    Stand-in for the PyannoteVAD deployment. Reports speech from the start of the
+    audio until `trailing_silence_seconds` before its end, so every chunk closes an
+    utterance, except for the given pauses.
+
+    Attributes:
+        latency_seconds (float): Fixed latency of every call.
+        trailing_silence_seconds (float): Silence detected at the end of the audio.
+        pauses (list): (start, end) of the pauses in the speech, in stream seconds.
+        failures (int): Number of calls left to fail.
+        calls (int): Number of calls served.
+    """
+
+    def __init__(self, latency_seconds=0.0, trailing_silence_seconds=0.5, pauses=(), failures=0):
+        self.latency_seconds = latency_seconds
+        self.trailing_silence_seconds = trailing_silence_seconds
+        self.pauses = pauses
+        self.failures = failures
+        self.calls = 0
+        self.detect_activity = FakeMethod(self.fake_detect_activity)
+
+    async def fake_detect_activity(self, client):
+        self.calls += 1
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("VAD replica died")
+        bytes_per_second = client.sampling_rate * client.samples_width
+        offset = client.scratch_offset_bytes / bytes_per_second
+        seconds = len(client.scratch_buffer) / bytes_per_second
+        end = max(0.0, seconds - self.trailing_silence_seconds)
+        segments = [{"start": 0.0, "end": end, "confidence": 1.0}]
+        for pause_start, pause_end in self.pauses:
+            if offset < pause_start and pause_end < offset + seconds:
+                segments = [{"start": 0.0, "end": pause_start - offset, "confidence": 1.0},
+                            {"start": pause_end - offset, "end": end, "confidence": 1.0}]
+        return segments
+
+
+class FakeASR:
+    """
+    Stand-in for the FasterWhisperASR deployment, with a configurable latency.
+
+    The latency of a call is `latency_seconds` plus `real_time_factor` times the
+    audio duration, plus a jitter drawn from a seeded generator, so that results
+    complete out of order in a reproducible way. The text of a result is the index
+    of the utterance in its stream, which lets the tests check ordering; tests that
+    need other transcriptions override transcription().
+
+    Attributes:
+        failures (int): Number of calls left to fail.
+        calls (int): Number of calls served.
+        cancelled (int): Number of calls cancelled before they completed.
+        clients (list): The clients, or snapshots of them, that were transcribed.
+    """
+
+    def __init__(self, latency_seconds=0.0, real_time_factor=0.0, jitter_seconds=0.0, seed=0, failures=0):
+        self.latency_seconds = latency_seconds
+        self.real_time_factor = real_time_factor
+        self.jitter_seconds = jitter_seconds
+        self.random = random.Random(seed)
+        self.failures = failures
+        self.calls = 0
+        self.cancelled = 0
+        self.clients = []
+        self.transcribe = FakeMethod(self.fake_transcribe)
+
+    async def fake_transcribe(self, client, **kwargs):
+        self.calls += 1
+        audio_seconds = len(client.scratch_buffer) / (client.sampling_rate * client.samples_width)
+        latency_seconds = (self.latency_seconds + self.real_time_factor * audio_seconds
+                           + self.random.uniform(0, self.jitter_seconds))
+        if latency_seconds:
+            try:
+                await asyncio.sleep(latency_seconds)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("ASR replica died")
+        self.clients.append(client)
+        return self.transcription(client)
+
+    def transcription(self, client):
+        return {
+            "language": "en",
+            "language_probability": 1.0,
+            "text": str(client.file_counter),
+            "words": [],
+            "audio_seconds": len(client.scratch_buffer) / (client.sampling_rate * client.samples_width),
+            "replica": "fake",
+            "replica_real_time_factor": self.real_time_factor,
+        }
+
+
+class FakeWebSocket:
+    """
+    Stands in for the WebSocket of a client. Plays the given messages, the first
+    audio frames after `pace_seconds` each, and disconnects `drain_seconds` after
+    the last one, leaving time for the outstanding transcriptions.
+
+    Attributes:
+        messages (list): The ASGI messages left to receive.
+        sent (list): The JSON messages sent to the client.
+    """
+
+    def __init__(self, messages=(), pace_seconds=0.0, drain_seconds=0.0):
+        self.messages = list(messages)
+        self.pace_seconds = pace_seconds
+        self.drain_seconds = drain_seconds
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def receive(self):
+        if self.messages:
+            message = self.messages.pop(0)
+            if "bytes" in message:
+                await asyncio.sleep(self.pace_seconds)
+            return message
+        await asyncio.sleep(self.drain_seconds)
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def config_message(config):
+    """
+    Returns the ASGI message of a client sending its configuration.
+    """
+    return {"type": "websocket.receive", "text": json.dumps({"type": "config", "data": config})}
+
+
+def audio_messages(chunks):
+    """
+    Returns the ASGI messages of a client sending the given audio chunks.
+    """
+    return [{"type": "websocket.receive", "bytes": chunk} for chunk in chunks]
@@ -0,0 +1,112 @@
+import unittest
+import asyncio
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from src.journal.journal import Journal, read_segment
+from src.journal.local_filesystem_backend import LocalFilesystemBackend
+
+class BlockedBackend:
+    """
+    Storage that does not complete writes until released.
+    """
+    def __init__(self):
+        self.released = threading.Event()
+        self.segments = []
+
+    def write_segment(self, day, name, data):
+        self.released.wait()
+        self.segments.append(data)
+
+    def append_index(self, day, entry):
+        pass
+
+class TestJournal(unittest.TestCase):
+    def test_sessions_are_written_as_indexed_segments(self):
+        async def run(directory):
+            journal = Journal(LocalFilesystemBackend(directory, fsync=False), segment_bytes=64000)
+            journal.start()
+            journal.record_event("a", "open", {"language": "en"})
+            for _ in range(5):
+                await journal.record_audio("a", bytes(32000))
+                await journal.record_audio("b", bytes(16000))
+            journal.record_event("a", "transcript", {"text": "hello"})
+            journal.end_session("a")
+            await journal.close()
+
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(run(directory))
+            [day_directory] = glob.glob(os.path.join(directory, "*"))
+            with open(os.path.join(day_directory, "index.jsonl")) as index_file:
+                index = [json.loads(line) for line in index_file]
+            self.assertGreater(len(index), 1)
+
+            records = []
+            for entry in index:
+                with open(os.path.join(day_directory, entry['segment']), 'rb') as segment_file:
+                    data = segment_file.read()
+                self.assertEqual(len(data), entry['compressed_bytes'])
+                records.extend(read_segment(data))
+
+        audio = [(header['offset_bytes'], len(payload)) for header, payload in records
+                 if header['type'] == "audio" and header['session_id'] == "a"]
+        self.assertEqual(audio, [(offset, 32000) for offset in range(0, 160000, 32000)])
+        self.assertEqual(index[0]['sessions']['a']['audio_start_bytes'], 0)
+        self.assertEqual(max(entry['sessions']['a']['audio_end_bytes'] or 0 for entry in index), 160000)
+        self.assertEqual(records[-2][0]['type'], "transcript")
+        self.assertEqual(json.loads(records[-1][1]), {"audio_bytes": 160000})
+
+    def test_segment_and_index_entry_share_a_day(self):
+        async def run(directory):
+            journal = Journal(LocalFilesystemBackend(directory, fsync=False))
+            journal.start()
+            await journal.record_audio("a", bytes(32000))
+            await journal.close()
+
+        just_before_midnight = time.strptime("2024-03-15 23:59:59", "%Y-%m-%d %H:%M:%S")
+        after_midnight = time.strptime("2024-03-16 00:00:00", "%Y-%m-%d %H:%M:%S")
+        with tempfile.TemporaryDirectory() as directory:
+            # Midnight passes while the segment is being written
+            clock = mock.Mock(side_effect=lambda *args: just_before_midnight if clock.call_count <= 2 else after_midnight)
+            with mock.patch("time.gmtime", clock):
+                asyncio.run(run(directory))
+            self.assertEqual(os.listdir(directory), ["2024-03-15"])
+            [segment_name] = [name for name in os.listdir(os.path.join(directory, "2024-03-15")) if name.endswith(".gz")]
+            with open(os.path.join(directory, "2024-03-15", "index.jsonl")) as index_file:
+                self.assertEqual(json.loads(index_file.readline())['segment'], segment_name)
+
+    def test_full_queue_drops_or_blocks_audio(self):
+        async def run(overflow_policy):
+            backend = BlockedBackend()
+            journal = Journal(backend, max_queue_bytes=64000, segment_bytes=32000,
+                              overflow_policy=overflow_policy, block_timeout_seconds=0.2)
+            journal.start()
+            # The first segment is stuck in storage, the next two chunks fill the queue
+            for _ in range(4):
+                await journal.record_audio("a", bytes(32000))
+                await asyncio.sleep(0.01)
+            queued_bytes = journal.queued_bytes
+
+            if overflow_policy == "block":
+                blocked = asyncio.create_task(journal.record_audio("a", bytes(32000)))
+                await asyncio.sleep(0.05)
+                self.assertFalse(blocked.done())
+                backend.released.set()
+                await blocked
+            else:
+                backend.released.set()
+            await journal.close()
+            return queued_bytes, len(backend.segments)
+
+        queued_bytes, segments = asyncio.run(run("drop"))
+        self.assertEqual(queued_bytes, 64000)
+        # One chunk was dropped
+        self.assertEqual(segments, 3)
+
+        queued_bytes, segments = asyncio.run(run("block"))
+        self.assertEqual(segments, 4)
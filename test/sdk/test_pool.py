@@ -0,0 +1,76 @@
+import unittest
+import asyncio
+import json
+
+import websockets
+
+from src.multiplexing import decode_frame
+from src.sdk import ConnectionPool, pcm_chunks
+
+BYTES_PER_SECOND = 16000 * 2
+
+class FakeMuxServer:
+    """
+    Acknowledges every second of audio of a stream with a transcription, and
+    drops the first connection after `drop_after_frames` audio frames.
+    """
+
+    def __init__(self, drop_after_frames=None):
+        self.drop_after_frames = drop_after_frames
+        self.connections = 0
+        self.open_messages = []
+
+    async def handle(self, websocket):
+        self.connections += 1
+        frames = 0
+        positions = {}
+        async for message in websocket:
+            if isinstance(message, str):
+                config = json.loads(message)
+                if config.get("action") == "close":
+                    await websocket.send(json.dumps({"type": "closed", "stream_id": config["stream_id"]}))
+                else:
+                    self.open_messages.append(config)
+                    offset = config["data"].get("stream_offset_seconds", 0.0)
+                    positions[config["stream_id"]] = [int(offset * BYTES_PER_SECOND)] * 2
+                continue
+
+            stream_id, audio = decode_frame(message)
+            position = positions[stream_id]
+            position[1] += len(audio)
+            frames += 1
+            if self.connections == 1 and frames == self.drop_after_frames:
+                await websocket.close()
+                return
+            while position[1] - position[0] >= BYTES_PER_SECOND:
+                position[0] += BYTES_PER_SECOND
+                await websocket.send(json.dumps({"stream_id": stream_id, "text": str(position[0] // BYTES_PER_SECOND),
+                                                 "stream_end_seconds": position[0] / BYTES_PER_SECOND}))
+
+    async def transcribe(self, streams, audio_seconds):
+        async with websockets.serve(self.handle, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with ConnectionPool(f"ws://127.0.0.1:{port}/mux", size=2, reconnect_backoff_seconds=0.01) as pool:
+                async def transcribe_one():
+                    audio = pcm_chunks(bytes(int(audio_seconds * BYTES_PER_SECOND)), chunk_seconds=0.25)
+                    return [t["text"] async for t in pool.transcribe(audio, trailing_silence_seconds=0,
+                                                                      drain_timeout_seconds=0.5)]
+                return await asyncio.gather(*[transcribe_one() for _ in range(streams)])
+
+class TestConnectionPool(unittest.TestCase):
+    def test_streams_are_multiplexed_over_the_pool(self):
+        server = FakeMuxServer()
+        results = asyncio.run(server.transcribe(streams=5, audio_seconds=3))
+        self.assertEqual(results, [["1", "2", "3"]] * 5)
+        self.assertEqual(server.connections, 2)
+
+    def test_unacknowledged_audio_is_resent_after_a_reconnect(self):
+        server = FakeMuxServer(drop_after_frames=7)
+        results = asyncio.run(server.transcribe(streams=1, audio_seconds=3))
+        self.assertEqual(results, [["1", "2", "3"]])
+        self.assertEqual(server.connections, 2)
+        # The second second was sent but not acknowledged when the connection dropped
+        self.assertEqual(server.open_messages[-1]["data"]["stream_offset_seconds"], 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
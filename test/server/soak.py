@@ -0,0 +1,147 @@
+# test/server/soak.py
+
+"""
+GPU-free soak test harness for src.voice_stream_ai_server.TranscriptionServer.
+
+Drives many concurrent streams through TranscriptionServer.handle_websocket in
+process, with the deterministic stand-ins of test.fakes for the PyannoteVAD and
+FasterWhisperASR deployment handles and the WebSocket connections. No model, GPU or Ray cluster is
+needed, only the packages the server imports.
+
+The run reports regression-trackable numbers: transcription ordering violations,
+untranscribed audio, ASR processing latency, ingress event-loop lag, ingress
+memory growth and connections or tasks left behind after every client left.
+
+Usage:
+    python -m test.server.soak --streams 300 --audio-seconds 10 --output soak.json
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+from src.voice_stream_ai_server import TranscriptionServer
+from test.fakes import FakeASR, FakeVAD, FakeWebSocket, audio_messages, config_message
+
+SAMPLING_RATE = 16000
+SAMPLES_WIDTH = 2
+
+
+async def run_soak(streams=100, audio_seconds=5.0, frame_seconds=0.25, speedup=1.0,
+                   processing_strategy="pipelined_silence_at_end_of_chunk", chunk_length_seconds=1.0,
+                   vad_latency_seconds=0.02, asr_latency_seconds=0.1, asr_real_time_factor=0.05,
+                   asr_jitter_seconds=0.05, seed=0):
+    """
+    Run `streams` concurrent streams against one TranscriptionServer and measure it.
+
+    Returns:
+        dict: The measurements, see the module docstring.
+    """
+    vad = FakeVAD(vad_latency_seconds)
+    asr = FakeASR(asr_latency_seconds, asr_real_time_factor, asr_jitter_seconds, seed)
+    server = TranscriptionServer.func_or_class(asr_handle=asr, vad_handle=vad)
+    server.event_loop_lag_monitor.interval_seconds = 0.02
+
+    config = {"processing_strategy": processing_strategy,
+              "processing_args": {"chunk_length_seconds": chunk_length_seconds, "chunk_offset_seconds": 0.1}}
+    # Outstanding transcriptions of a stream are waited for before disconnecting
+    drain_seconds = 1.0 + 2 * (vad_latency_seconds + asr_latency_seconds + asr_jitter_seconds
+                               + asr_real_time_factor * chunk_length_seconds * 2)
+    frames = int(round(audio_seconds / frame_seconds))
+    audio_seconds = frames * frame_seconds
+    messages = [config_message(config)] + audio_messages([bytes(int(frame_seconds * SAMPLING_RATE) * SAMPLES_WIDTH)] * frames)
+    websockets = [FakeWebSocket(messages, frame_seconds / speedup, drain_seconds) for _ in range(streams)]
+
+    gc.collect()
+    tracemalloc.start()
+    baseline_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    start = time.monotonic()
+    await asyncio.gather(*[server.handle_websocket(websocket) for websocket in websockets])
+    wall_seconds = time.monotonic() - start
+    lag = server.event_loop_lag_monitor.stats()
+    server.event_loop_lag_monitor.stop()
+    if server.journal is not None:
+        await server.journal.close()
+    await asyncio.sleep(0.1)
+    tasks_left = sum(1 for task in asyncio.all_tasks() if task is not asyncio.current_task())
+
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    gc.collect()
+    retained_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ordering_violations = 0
+    transcribed_audio_seconds = 0.0
+    processing_times = []
+    for websocket in websockets:
+        indices = [int(message["text"]) for message in websocket.sent]
+        ordering_violations += sum(1 for a, b in zip(indices, indices[1:]) if b <= a)
+        transcribed_audio_seconds += sum(message["audio_seconds"] for message in websocket.sent)
+        processing_times += [message["processing_time"] for message in websocket.sent]
+    processing_times.sort()
+
+    def percentile(values, p):
+        return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+    sent_audio_seconds = audio_seconds * streams
+    return {
+        "streams": streams,
+        "processing_strategy": processing_strategy,
+        "wall_seconds": wall_seconds,
+        "sent_audio_seconds": sent_audio_seconds,
+        "transcriptions": sum(len(websocket.sent) for websocket in websockets),
+        "ordering_violations": ordering_violations,
+        "untranscribed_audio_seconds": sent_audio_seconds - transcribed_audio_seconds,
+        "max_untranscribed_audio_seconds_per_stream": max(
+            audio_seconds - sum(message["audio_seconds"] for message in websocket.sent)
+            for websocket in websockets),
+        "vad_calls": vad.calls,
+        "asr_calls": asr.calls,
+        "asr_calls_cancelled": asr.cancelled,
+        "processing_time_p50_seconds": percentile(processing_times, 50),
+        "processing_time_p99_seconds": percentile(processing_times, 99),
+        "event_loop_lag_p99_seconds": lag.get("p99_lag_seconds", 0.0),
+        "event_loop_lag_max_seconds": lag.get("max_lag_seconds", 0.0),
+        "ingress_peak_memory_growth_bytes": peak_bytes - baseline_bytes,
+        "ingress_retained_memory_growth_bytes": retained_bytes - baseline_bytes,
+        "connected_clients_left": len(server.connected_clients),
+        "tasks_left": tasks_left,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GPU-free soak test of the TranscriptionServer ingress")
+    parser.add_argument("--streams", type=int, default=300, help="Number of concurrent streams")
+    parser.add_argument("--audio-seconds", type=float, default=10.0, help="Audio sent by every stream")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Send audio this many times faster than real time")
+    parser.add_argument("--processing-strategy", type=str, default="pipelined_silence_at_end_of_chunk", help="Buffering strategy of the streams")
+    parser.add_argument("--chunk-length-seconds", type=float, default=1.0, help="Chunk length of the buffering strategy")
+    parser.add_argument("--vad-latency", type=float, default=0.02, help="Latency of the fake VAD in seconds")
+    parser.add_argument("--asr-latency", type=float, default=0.1, help="Base latency of the fake ASR in seconds")
+    parser.add_argument("--asr-real-time-factor", type=float, default=0.05, help="Fake ASR latency per audio second")
+    parser.add_argument("--asr-jitter", type=float, default=0.05, help="Maximum random jitter of the fake ASR in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake ASR jitter")
+    parser.add_argument("--output", type=str, default=None, help="Also write the results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run_soak(
+        streams=args.streams, audio_seconds=args.audio_seconds, speedup=args.speedup,
+        processing_strategy=args.processing_strategy, chunk_length_seconds=args.chunk_length_seconds,
+        vad_latency_seconds=args.vad_latency, asr_latency_seconds=args.asr_latency,
+        asr_real_time_factor=args.asr_real_time_factor, asr_jitter_seconds=args.asr_jitter, seed=args.seed))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
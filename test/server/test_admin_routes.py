@@ -0,0 +1,37 @@
+import unittest
+import asyncio
+import os
+from unittest import mock
+
+from fastapi import HTTPException
+
+from src.voice_stream_ai_server import TranscriptionServer
+from test.fakes import FakeASR, FakeVAD
+
+class TestAdminRoutes(unittest.TestCase):
+    def create_server(self, **environment):
+        with mock.patch.dict(os.environ, environment):
+            return TranscriptionServer.func_or_class(asr_handle=FakeASR(), vad_handle=FakeVAD())
+
+    def status_code(self, server, authorization):
+        try:
+            asyncio.run(server.list_connections(authorization=authorization))
+        except HTTPException as e:
+            return e.status_code
+        return 200
+
+    def test_admin_routes_are_disabled_by_default(self):
+        server = self.create_server()
+        self.assertEqual(self.status_code(server, None), 404)
+
+    def test_admin_routes_need_a_token(self):
+        server = self.create_server(ADMIN_ROUTES_ENABLED="true")
+        self.assertEqual(self.status_code(server, "Bearer "), 404)
+
+        server = self.create_server(ADMIN_ROUTES_ENABLED="true", ADMIN_TOKEN="secret")
+        self.assertEqual(self.status_code(server, None), 401)
+        self.assertEqual(self.status_code(server, "Bearer wrong"), 401)
+        self.assertEqual(self.status_code(server, "Bearer secret"), 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import asyncio
+import json
+
+from src.multiplexing import decode_frame, encode_frame
+from test.fakes import FakeASR, FakeVAD
+from test.server.soak import SAMPLES_WIDTH, SAMPLING_RATE
+from src.voice_stream_ai_server import TranscriptionServer
+
+class FakeMultiplexedWebSocket:
+    def __init__(self, messages):
+        self.messages = messages
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def receive(self):
+        while self.messages:
+            message = self.messages.pop(0)
+            if isinstance(message, float):
+                await asyncio.sleep(message)
+                continue
+            return message
+        await asyncio.sleep(1.0)
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+def config_message(stream_id, **kwargs):
+    return {"type": "websocket.receive", "text": json.dumps({"type": "config", "stream_id": stream_id, **kwargs})}
+
+class TestMultiplexing(unittest.TestCase):
+    def test_frames_round_trip(self):
+        stream_id, audio = decode_frame(encode_frame(70000, b"\x01\x02"))
+        self.assertEqual(stream_id, 70000)
+        self.assertEqual(bytes(audio), b"\x01\x02")
+        with self.assertRaises(ValueError):
+            decode_frame(b"\x00\x01")
+
+    def test_streams_share_one_connection(self):
+        data = {"processing_strategy": "pipelined_silence_at_end_of_chunk",
+                "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1}}
+        second = bytes(SAMPLING_RATE * SAMPLES_WIDTH)
+        messages = [config_message(1, data=data), config_message(2, data=data)]
+        for _ in range(4):
+            messages += [{"type": "websocket.receive", "bytes": encode_frame(1, second)},
+                         {"type": "websocket.receive", "bytes": encode_frame(2, second)}]
+        messages += [{"type": "websocket.receive", "bytes": encode_frame(3, second)}, 1.0, config_message(2, action="close")]
+        websocket = FakeMultiplexedWebSocket(messages)
+        server = TranscriptionServer.func_or_class(asr_handle=FakeASR(), vad_handle=FakeVAD())
+
+        async def run():
+            await server.handle_multiplexed_websocket(websocket)
+            server.event_loop_lag_monitor.stop()
+
+        asyncio.run(run())
+        transcriptions = [message for message in websocket.sent if "text" in message]
+        stream_ids = [message["stream_id"] for message in transcriptions]
+        self.assertGreater(stream_ids.count(1), 0)
+        self.assertEqual(stream_ids.count(1), stream_ids.count(2))
+        self.assertIn({"type": "error", "stream_id": 3, "message": "Stream is not open"}, websocket.sent)
+        self.assertEqual([message["type"] for message in websocket.sent if message.get("type") == "closed"], ["closed"])
+        self.assertEqual(server.connected_clients, {})
+
+    def test_a_bad_config_only_fails_its_stream(self):
+        data = {"processing_strategy": "pipelined_silence_at_end_of_chunk",
+                "processing_args": {"chunk_length_seconds": 1, "chunk_offset_seconds": 0.1}}
+        second = bytes(SAMPLING_RATE * SAMPLES_WIDTH)
+        messages = [config_message(1, data=data), config_message(2, data=data),
+                    config_message(2, data={"processing_strategy": "unknown"}),
+                    config_message(2, data="not a config"),
+                    {"type": "websocket.receive", "text": "{not json"},
+                    {"type": "websocket.receive", "text": "[1, 2]"}]
+        for _ in range(4):
+            messages += [{"type": "websocket.receive", "bytes": encode_frame(1, second)},
+                         {"type": "websocket.receive", "bytes": encode_frame(2, second)}]
+        messages += [1.0]
+        websocket = FakeMultiplexedWebSocket(messages)
+        server = TranscriptionServer.func_or_class(asr_handle=FakeASR(), vad_handle=FakeVAD())
+
+        async def run():
+            await server.handle_multiplexed_websocket(websocket)
+            server.event_loop_lag_monitor.stop()
+
+        asyncio.run(run())
+        errors = [message for message in websocket.sent if message.get("type") == "error"]
+        self.assertEqual([message.get("stream_id") for message in errors], [2, 2, None, None])
+        # Both streams kept transcribing, stream 2 with its previous config
+        stream_ids = [message["stream_id"] for message in websocket.sent if "text" in message]
+        self.assertGreater(stream_ids.count(1), 0)
+        self.assertEqual(stream_ids.count(1), stream_ids.count(2))
+        self.assertEqual(server.connected_clients, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,141 +4,142 @@ import unittest
 import os
 import json
 import asyncio
-import websockets
-from pydub import AudioSegment
-from sentence_transformers import SentenceTransformer, util
 
-from src.server import Server
-from src.vad.vad_factory import VADFactory
-from src.asr.asr_factory import ASRFactory
+from src.sdk.sources import file_chunks
+from src.voice_stream_ai_server import TranscriptionServer
+from test.fakes import FakeASR, FakeMethod, FakeVAD, FakeWebSocket, audio_messages, config_message
 
-class TestServer(unittest.TestCase):
+ANNOTATIONS_PATH = os.path.join(os.path.dirname(__file__), "../audio_files/annotations.json")
+
+async def stream_audio_file(server, audio_file, config, pace_seconds, drain_seconds):
     """
-    Test suite for testing the Server class responsible for real-time audio transcription.
-
-    This test suite contains tests that verify the functionality of the Server class, particularly
-    focusing on its ability to handle audio data, process it through VAD (Voice Activity Detection)
-    and ASR (Automatic Speech Recognition) pipelines, and return accurate transcriptions.
-
-    Methods:
-        setUp: Prepares the test environment before each test method is executed.
-        receive_transcriptions: Asynchronously receives transcriptions from the server and stores them.
-        mock_client: Simulates a client sending audio data to the server for processing.
-        test_server_response: Tests the server's response accuracy by comparing received and expected transcriptions.
-        load_annotations: Loads transcription annotations for comparison with server responses.
+    Simulates a client sending its configuration, then an audio file in 250 ms
+    chunks followed by two seconds of silence.
+
+    Args:
+        pace_seconds (float): Time between two chunks, 0.25 for real time.
+        drain_seconds (float): Time waited for the last transcriptions before disconnecting.
+
+    Returns:
+        FakeWebSocket: The connection, with the transcriptions it was sent.
     """
-    @classmethod
-    def setUpClass(cls):
-        # Use an environment variable to get the ASR model type
-        cls.asr_type = os.getenv('ASR_TYPE', 'faster_whisper')
-        cls.vad_type = os.getenv('VAD_TYPE', 'pyannote')
+    chunks = list(file_chunks(audio_file)) + [bytes(8000)] * 8
+    websocket = FakeWebSocket([config_message(config)] + audio_messages(chunks), pace_seconds, drain_seconds)
+    await server.handle_websocket(websocket)
+    return websocket
 
-    def setUp(self):
-        """
-        Set up the test environment.
+def load_annotations():
+    """
+    Load annotations from a JSON file for transcription comparison.
 
-        Initializes the VAD and ASR pipelines, the server, the path to the annotations,
-        a list to store received transcriptions, and the sentence similarity model.
-        """
-        self.vad_pipeline = VADFactory.create_vad_pipeline(self.vad_type)
-        self.asr_pipeline = ASRFactory.create_asr_pipeline(self.asr_type)
-        self.server = Server(self.vad_pipeline, self.asr_pipeline, host='127.0.0.1', port=8767)
-        self.annotations_path = os.path.join(os.path.dirname(__file__), "../audio_files/annotations.json")
-        self.received_transcriptions = []
-        self.similarity_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-
-    async def receive_transcriptions(self, websocket):
-        """
-        Asynchronously receive and store transcriptions from the server.
+    Returns:
+        dict: A dictionary containing expected transcriptions for test audio files.
+    """
+    with open(ANNOTATIONS_PATH, 'r') as file:
+        return json.load(file)
 
-        Args:
-            websocket (Websocket): The websocket connection to receive transcriptions from.
-        """
-        try:
-            while True:
-                transcription_str = await websocket.recv()
-                transcription = json.loads(transcription_str) 
-                self.received_transcriptions.append(transcription['text'])
-                print(f"Received transcription: {transcription['text']}, processing time: {transcription['processing_time']}")
-        except websockets.exceptions.ConnectionClosed:
-            pass  # Expected when server closes the connection
-
-    async def mock_client(self, audio_file):
-        """
-        Simulate a client sending audio data to the server.
+class LocalDeployment:
+    """
+    Calls a deployment instantiated in this process like its DeploymentHandle.
+    """
+    def __init__(self, deployment):
+        self.deployment = deployment
 
-        Streams audio data in chunks to the server and then streams silence to signify the end of the audio.
+    def __getattr__(self, name):
+        return FakeMethod(getattr(self.deployment, name))
 
-        Args:
-            audio_file (str): Path to the audio file to be sent to the server.
-        """
-        uri = "ws://127.0.0.1:8767"
-        async with websockets.connect(uri) as websocket:
-            # Start receiving transcriptions in a separate task
-            receive_task = asyncio.create_task(self.receive_transcriptions(websocket))
-
-            # Stream the entire audio file in chunks
-            with open(audio_file, 'rb') as file:
-                audio = AudioSegment.from_file(file, format="wav")
-            
-            for i in range(0, len(audio), 250):  # 4000 samples = 250 ms at 16000 Hz
-                chunk = audio[i:i+250]
-                await websocket.send(chunk.raw_data)
-                await asyncio.sleep(0.25)  # Wait for the chunk duration
-                
-            # Stream 10 seconds of silence
-            silence = AudioSegment.silent(duration=10000)
-            await websocket.send(silence.raw_data)
-            await asyncio.sleep(10)  # Wait for the silence duration
-
-            # Close the receive task
-            receive_task.cancel()
+class TestServer(unittest.TestCase):
+    """
+    Test suite for the TranscriptionServer deployment, run in process.
 
-    def test_server_response(self):
-        """
-        Test the server's response accuracy.
+    The annotated audio files are streamed through handle_websocket() with the
+    deterministic VAD and ASR stand-ins of test.fakes, so the test needs no
+    model, GPU or Ray cluster. It checks what the server adds around the models:
+    every utterance is transcribed once, in order, with its position in the stream,
+    and nothing is left behind once the client disconnects.
+    """
+    def setUp(self):
+        self.vad = FakeVAD()
+        self.asr = FakeASR()
+        self.server = TranscriptionServer.func_or_class(asr_handle=self.asr, vad_handle=self.vad)
 
-        Compares the received transcriptions from the server with expected transcriptions from annotations.
-        Validates the similarity of these transcriptions using a sentence transformer model.
+    def mock_client(self, audio_file, config):
+        """
+        Streams an audio file fifty times faster than real time.
         """
-        # Start the server
-        start_server = self.server.start()
-        asyncio.get_event_loop().run_until_complete(start_server)
+        return asyncio.run(stream_audio_file(self.server, audio_file, config, 0.005, 1.0))
 
-        annotations = self.load_annotations()
-        for audio_file_name, data in annotations.items():
-            audio_file_path = os.path.join(os.path.dirname(__file__), f"../audio_files/{audio_file_name}")
+    def test_server_response(self):
+        annotations = load_annotations()
+        for processing_strategy in ("silence_at_end_of_chunk", "pipelined_silence_at_end_of_chunk"):
+            for audio_file_name in annotations:
+                audio_file_path = os.path.join(os.path.dirname(__file__), f"../audio_files/{audio_file_name}")
+                config = {"processing_strategy": processing_strategy,
+                          "processing_args": {"chunk_length_seconds": 3, "chunk_offset_seconds": 0.1}}
+                sent = self.mock_client(audio_file_path, config).sent
+
+                with self.subTest(processing_strategy=processing_strategy, audio_file=audio_file_name):
+                    self.assertGreater(len(sent), 0)
+                    # The fake ASR transcribes each utterance as its index in the stream
+                    self.assertEqual([int(message["text"]) for message in sent], list(range(len(sent))))
+                    for previous, message in zip(sent, sent[1:]):
+                        self.assertEqual(message["stream_start_seconds"], previous["stream_end_seconds"])
+                    self.assertEqual(self.server.connected_clients, {})
+
+@unittest.skipUnless(os.environ.get('RUN_MODEL_TESTS'), "Set RUN_MODEL_TESTS to run the models, on a GPU")
+class TestServerAccuracy(unittest.TestCase):
+    """
+    Checks the transcriptions of TranscriptionServer with the real models.
 
-            # Run the mock client for each audio file
-            asyncio.get_event_loop().run_until_complete(self.mock_client(audio_file_path))
+    The PyannoteVAD and FasterWhisperASR deployments are instantiated in process
+    and the annotated audio files are streamed in real time. The transcriptions
+    of a file must be similar in meaning to its reference transcription, as
+    measured by a sentence transformer. Needs PYANNOTE_AUTH_TOKEN, a GPU and
+    sentence-transformers.
+    """
+    @classmethod
+    def setUpClass(cls):
+        from sentence_transformers import SentenceTransformer
+        from src.asr.faster_whisper_asr import FasterWhisperASR
+        from src.vad.pyannote_vad import PyannoteVAD
+
+        cls.vad = PyannoteVAD.func_or_class()
+        cls.asr = FasterWhisperASR.func_or_class()
+        cls.similarity_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
 
-            # Compare received transcriptions with expected transcriptions
+    def test_server_response(self):
+        from sentence_transformers import util
+
+        server = TranscriptionServer.func_or_class(asr_handle=LocalDeployment(self.asr), vad_handle=LocalDeployment(self.vad))
+        annotations = load_annotations()
+        config = {"processing_strategy": "silence_at_end_of_chunk",
+                  "processing_args": {"chunk_length_seconds": 3, "chunk_offset_seconds": 0.1}}
+
+        # One event loop for all the files, the batching of the VAD is bound to it
+        async def stream_audio_files():
+            received = {}
+            for audio_file_name in annotations:
+                audio_file_path = os.path.join(os.path.dirname(__file__), f"../audio_files/{audio_file_name}")
+                websocket = await stream_audio_file(server, audio_file_path, config, 0.25, 10.0)
+                received[audio_file_name] = websocket.sent
+            return received
+
+        received = asyncio.run(stream_audio_files())
+        for audio_file_name, data in annotations.items():
             expected_transcriptions = ' '.join([seg["transcription"] for seg in data['segments']])
-            received_transcriptions = ' '.join(self.received_transcriptions)
+            received_transcriptions = ' '.join([message["text"] for message in received[audio_file_name]])
 
             embedding_1 = self.similarity_model.encode(expected_transcriptions.lower().strip(), convert_to_tensor=True)
             embedding_2 = self.similarity_model.encode(received_transcriptions.lower().strip(), convert_to_tensor=True)
             similarity = util.pytorch_cos_sim(embedding_1, embedding_2).item()
 
-            # Print summary before assertion
             print(f"Test file: {audio_file_name}")
             print(f"Expected Transcriptions: {expected_transcriptions}")
             print(f"Received Transcriptions: {received_transcriptions}")
             print(f"Similarity Score: {similarity}")
 
-            self.received_transcriptions = []
-
-            self.assertGreaterEqual(similarity, 0.7)
-
-    def load_annotations(self):
-        """
-        Load annotations from a JSON file for transcription comparison.
-
-        Returns:
-            dict: A dictionary containing expected transcriptions for test audio files.
-        """
-        with open(self.annotations_path, 'r') as file:
-            return json.load(file)
+            with self.subTest(audio_file=audio_file_name):
+                self.assertGreaterEqual(similarity, 0.7)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+import asyncio
+
+from test.server.soak import run_soak
+
+class TestSoak(unittest.TestCase):
+    """
+    Runs the GPU-free soak harness at a small scale and checks the properties that
+    must hold at any scale: in-order transcriptions, no lost audio and nothing left
+    behind once every client has disconnected.
+    """
+
+    def check_results(self, results):
+        self.assertEqual(results["ordering_violations"], 0)
+        self.assertGreater(results["transcriptions"], 0)
+        self.assertEqual(results["connected_clients_left"], 0)
+        self.assertEqual(results["tasks_left"], 0)
+        self.assertLess(results["event_loop_lag_max_seconds"], 0.5)
+
+    def test_pipelined_streams_are_transcribed_in_order(self):
+        results = asyncio.run(run_soak(streams=50, audio_seconds=4.0, speedup=4.0,
+                                       asr_jitter_seconds=0.2))
+        self.check_results(results)
+        # Only the audio after the last detected speech end may stay untranscribed
+        self.assertLess(results["max_untranscribed_audio_seconds_per_stream"], 1.0)
+
+    def test_silence_at_end_of_chunk_streams(self):
+        results = asyncio.run(run_soak(streams=20, audio_seconds=4.0, speedup=4.0,
+                                       processing_strategy="silence_at_end_of_chunk"))
+        self.check_results(results)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+import time
+import asyncio
+from unittest import mock
+
+from src import tracing
+from src.tracing import JsonlSpanExporter, Tracer, new_trace_context
+from src.voice_stream_ai_server import TranscriptionServer
+from test.fakes import FakeASR, FakeVAD
+
+class TestTracing(unittest.TestCase):
+    def test_spans_are_written_by_the_writer_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exporter = JsonlSpanExporter(os.path.join(directory, "spans.jsonl"), batch_size=2)
+            writers = []
+            write = exporter.write
+            with mock.patch.object(exporter, 'write', lambda spans: (writers.append(threading.current_thread()), write(spans))):
+                tracer = Tracer(exporter)
+                context = new_trace_context()
+                for name in ("vad.request", "asr.request", "send"):
+                    tracer.record(name, context, 1.0, 2.0)
+                tracer.flush()
+
+            with open(exporter.path) as file:
+                spans = [json.loads(line) for line in file]
+        self.assertEqual([span["name"] for span in spans], ["vad.request", "asr.request", "send"])
+        self.assertEqual({span["traceId"] for span in spans}, {context["trace_id"]})
+        self.assertEqual(writers, [exporter.writer] * 2)
+
+    def test_spans_of_an_idle_process_are_written(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exporter = JsonlSpanExporter(os.path.join(directory, "spans.jsonl"), flush_interval_seconds=0.05)
+            Tracer(exporter).record("send", new_trace_context(), 1.0, 2.0)
+            # No further span and no flush() call
+            time.sleep(0.3)
+            with open(exporter.path) as file:
+                self.assertEqual([json.loads(line)["name"] for line in file], ["send"])
+
+    def test_server_shutdown_flushes_the_spans(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exporter = JsonlSpanExporter(os.path.join(directory, "spans.jsonl"))
+            with mock.patch.object(tracing, '_tracer', Tracer(exporter)):
+                server = TranscriptionServer.func_or_class(asr_handle=FakeASR(), vad_handle=FakeVAD())
+                tracing.get_tracer().record("send", new_trace_context(), 1.0, 2.0)
+                # The destructor of the server itself; the one of the FastAPI ingress waits for its HTTP server
+                asyncio.run(type(server).__bases__[0].__del__(server))
+            with open(exporter.path) as file:
+                self.assertEqual([json.loads(line)["name"] for line in file], ["send"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,13 +4,99 @@ import unittest
 import os
 import json
 import asyncio
+from unittest import mock
+import numpy as np
+import torch
 from pydub import AudioSegment
 from src.vad.pyannote_vad import PyannoteVAD
 from src.client import Client
 
+# The queue of @serve.batch is shared by all the instances and bound to the event
+# loop of its first call, so every test of the module runs on this loop
+event_loop = asyncio.new_event_loop()
+
+class StubAudio:
+    sample_rate = 16000
+
+    def get_num_samples(self, duration):
+        return round(duration * self.sample_rate)
+
+class StubModel:
+    audio = StubAudio()
+
+class StubSegmentation:
+    """
+    Stands in for the pyannote Inference: one second windows every quarter of a
+    second, and an output per window that is the first sample of the window.
+    """
+    duration = 1.0
+    step = 0.25
+    batch_size = 32
+
+    def __init__(self):
+        self.forward_passes = []
+
+    def infer(self, windows):
+        self.forward_passes.append(len(windows))
+        return windows[:, :, :1].numpy()
+
+def stub_vad(max_windows=32):
+    """
+    Builds a PyannoteVAD around the stub segmentation model, without loading pyannote.
+    """
+    vad = object.__new__(PyannoteVAD.func_or_class)
+    vad.model = StubModel()
+    vad.segmentation = StubSegmentation()
+    vad.sample_rate = StubAudio.sample_rate
+    vad.max_windows = max_windows
+    vad.batch_requests = mock.Mock()
+    vad.batch_windows = mock.Mock()
+    return vad
+
+class TestWindows(unittest.TestCase):
+    def test_windows_follow_the_sliding_window(self):
+        vad = stub_vad()
+        # Three full windows and the padded rest of the last quarter second
+        waveform = torch.arange(25000, dtype=torch.float32)[None]
+        windows = vad.windows(waveform)
+
+        self.assertEqual(tuple(windows.shape), (4, 1, 16000))
+        for i in range(3):
+            self.assertTrue(torch.equal(windows[i, 0], waveform[0, i * 4000:i * 4000 + 16000]))
+        self.assertTrue(torch.equal(windows[3, 0, :13000], waveform[0, 12000:]))
+        self.assertTrue(torch.equal(windows[3, 0, 13000:], torch.zeros(3000)))
+
+    def test_windows_of_a_short_waveform(self):
+        waveform = torch.ones(1, 8000)
+        windows = stub_vad().windows(waveform)
+
+        self.assertEqual(tuple(windows.shape), (1, 1, 16000))
+        self.assertEqual(windows.sum().item(), 8000)
+
+    def test_concurrent_requests_share_the_forward_passes(self):
+        vad = stub_vad(max_windows=2)
+        # The windows of each request are filled with the number of the request
+        requests = [torch.full((3, 1, 16000), 1.0), torch.full((2, 1, 16000), 2.0)]
+
+        async def infer_all():
+            return await asyncio.gather(*[vad.infer_windows(windows) for windows in requests])
+
+        outputs = event_loop.run_until_complete(infer_all())
+
+        # Five windows in one batch, through the model two at a time
+        vad.batch_requests.observe.assert_called_once_with(2)
+        vad.batch_windows.observe.assert_called_once_with(5)
+        self.assertEqual(vad.segmentation.forward_passes, [2, 2, 1])
+        # Each request gets the outputs of its own windows back
+        self.assertEqual(outputs[0].shape, (3, 1, 1))
+        self.assertTrue(np.all(outputs[0] == 1.0))
+        self.assertEqual(outputs[1].shape, (2, 1, 1))
+        self.assertTrue(np.all(outputs[1] == 2.0))
+
+@unittest.skipUnless(os.environ.get('PYANNOTE_AUTH_TOKEN'), "Set PYANNOTE_AUTH_TOKEN to download the pyannote model")
 class TestPyannoteVAD(unittest.TestCase):
     def setUp(self):
-        self.vad = PyannoteVAD()
+        self.vad = PyannoteVAD.func_or_class()
         self.annotations_path = os.path.join(os.path.dirname(__file__), "../audio_files/annotations.json")
         self.client = Client("test_client", 16000, 2)  # Example client
 
@@ -29,7 +115,7 @@ class TestPyannoteVAD(unittest.TestCase):
                 audio_segment = self.get_audio_segment(audio_file_path, annotated_segment["start"], annotated_segment["end"])
                 self.client.scratch_buffer = bytearray(audio_segment.raw_data)
 
-                vad_results = asyncio.run(self.vad.detect_activity(self.client))
+                vad_results = event_loop.run_until_complete(self.vad.detect_activity(self.client))
 
                 # Adjust VAD-detected times by adding the start time of the annotated segment
                 adjusted_vad_results = [{"start": segment["start"] + annotated_segment["start"],
@@ -48,6 +134,30 @@ class TestPyannoteVAD(unittest.TestCase):
                 # Assert that at least one detected segment meets the condition
                 self.assertTrue(len(detected_segments) > 0, "No detected segment matches the annotated segment")
 
+    def test_batched_detection_matches_the_pipeline(self):
+        annotations = self.load_annotations()
+        clients = []
+        for audio_file, data in annotations.items():
+            audio_file_path = os.path.join(os.path.dirname(__file__), f"../audio_files/{audio_file}")
+            for annotated_segment in data["segments"]:
+                audio_segment = self.get_audio_segment(audio_file_path, annotated_segment["start"], annotated_segment["end"])
+                client = Client(f"test_client_{len(clients)}", 16000, 2)
+                client.scratch_buffer = bytearray(audio_segment.raw_data)
+                clients.append(client)
+
+        async def detect_all():
+            # Concurrent requests go through the model in one batch
+            return await asyncio.gather(*[self.vad.detect_activity(client) for client in clients])
+
+        batched_results = event_loop.run_until_complete(detect_all())
+        self.vad.batching_enabled = False
+        for client, batched_result in zip(clients, batched_results):
+            expected = event_loop.run_until_complete(self.vad.detect_activity(client))
+            self.assertEqual(len(batched_result), len(expected))
+            for segment, expected_segment in zip(batched_result, expected):
+                self.assertAlmostEqual(segment["start"], expected_segment["start"], places=2)
+                self.assertAlmostEqual(segment["end"], expected_segment["end"], places=2)
+
     def get_audio_segment(self, file_path, start, end):
         with open(file_path, 'rb') as file:
             audio = AudioSegment.from_file(file, format="wav")
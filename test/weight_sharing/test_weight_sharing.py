@@ -0,0 +1,46 @@
+import unittest
+import os
+import glob
+import tempfile
+from unittest import mock
+
+import torch
+
+from src.weight_sharing import load_shared_module
+
+class TinyModule(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 2)
+
+class TestLoadSharedModule(unittest.TestCase):
+    def setUp(self):
+        self.built = []
+
+    def build(self):
+        module = TinyModule()
+        self.built.append(module)
+        return module
+
+    def test_module_is_built_once_and_mapped_by_every_load(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {"WEIGHT_SHARING_ENABLED": "true", "WEIGHT_SHARING_DIR": directory}):
+            first = load_shared_module("tiny", self.build)
+            second = load_shared_module("tiny", self.build)
+
+            self.assertEqual(len(self.built), 1)
+            self.assertEqual(glob.glob(os.path.join(directory, "*.tmp")), [])
+            self.assertTrue(os.path.exists(os.path.join(directory, "tiny.pt")))
+            for name, tensor in self.built[0].state_dict().items():
+                self.assertTrue(torch.equal(first.state_dict()[name], tensor))
+                self.assertTrue(torch.equal(second.state_dict()[name], tensor))
+
+    def test_module_is_built_when_disabled(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {"WEIGHT_SHARING_ENABLED": "false", "WEIGHT_SHARING_DIR": directory}):
+            module = load_shared_module("tiny", self.build)
+            self.assertIs(module, self.built[0])
+            self.assertEqual(os.listdir(directory), [])
+
+if __name__ == '__main__':
+    unittest.main()